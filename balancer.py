@@ -0,0 +1,74 @@
+from dataclasses import dataclass
+from typing import Optional, Sequence
+
+from loguru import logger
+
+from plugins.DifyPlus.health import HealthTracker
+
+LEAST_OUTSTANDING = "least-outstanding"
+LATENCY = "latency"
+
+
+@dataclass(frozen=True, slots=True)
+class Endpoint:
+    """智能体的一个Dify部署"""
+    base_url: str
+    api_key: str
+    weight: float = 1
+
+
+class EndpointBalancer:
+    """在智能体的多个Dify端点之间分配请求
+
+    按 HealthTracker 记录的进行中请求数和延迟选择端点，跳过熔断中的端点：
+    least-outstanding 选择 进行中请求数/权重 最小的端点，相同时选延迟较低的；
+    latency 选择 延迟EWMA×(进行中请求数+1)/权重 最小的端点，尚无延迟数据的端点优先尝试。
+    会话ID只在创建它的Dify实例上有效，已有会话的请求传入创建会话的端点（与会话ID一起保存，
+    见 ConversationCache），该端点可用时总是选中它；只有它熔断时才换到其他端点，由调用方先清空会话。
+    """
+
+    def __init__(self, tracker: HealthTracker, strategy: str = LEAST_OUTSTANDING):
+        """
+        Args:
+            tracker: 端点健康状态
+            strategy: 选择策略，least-outstanding 或 latency
+        """
+        if strategy not in (LEAST_OUTSTANDING, LATENCY):
+            logger.warning(f"未知的端点选择策略 '{strategy}'，使用 {LEAST_OUTSTANDING}")
+            strategy = LEAST_OUTSTANDING
+        self.tracker = tracker
+        self.strategy = strategy
+
+    def _score(self, endpoint: Endpoint):
+        health = self.tracker.get(endpoint.base_url)
+        latency = health.latency or 0.0
+        if self.strategy == LATENCY:
+            return latency * (health.outstanding + 1) / endpoint.weight, health.outstanding
+        return health.outstanding / endpoint.weight, latency
+
+    def select(self, model_name: str, endpoints: Sequence[Endpoint], bound: Optional[str] = None) -> Endpoint:
+        """
+        为一次请求选择端点
+
+        Args:
+            model_name: 智能体名称
+            endpoints: 智能体的端点列表
+            bound: 已有会话所在端点的 base_url，为 None 时自由选择
+
+        Returns:
+            选中的端点；与 bound 不同时表示会话必须换到新端点。
+            所有端点都熔断时返回绑定的或第一个端点，由调用方处理熔断
+        """
+        if len(endpoints) == 1:
+            return endpoints[0]
+        bound_endpoint = next((endpoint for endpoint in endpoints if endpoint.base_url == bound), None)
+        if bound_endpoint is not None and self.tracker.available(bound_endpoint.base_url):
+            return bound_endpoint
+
+        candidates = [endpoint for endpoint in endpoints if self.tracker.available(endpoint.base_url)]
+        if not candidates:
+            return bound_endpoint or endpoints[0]
+        endpoint = min(candidates, key=self._score)
+        if bound_endpoint is not None:
+            logger.warning(f"智能体 '{model_name}' 的会话所在端点 {bound} 熔断中，切换到 {endpoint.base_url}")
+        return endpoint
@@ -0,0 +1,375 @@
+import asyncio
+import json
+import os
+import time
+from collections import OrderedDict
+from typing import Awaitable, Callable, Dict, Hashable, Optional
+
+from loguru import logger
+
+
+class TTLDedupStore:
+    """已处理消息ID的去重表
+
+    按插入顺序保存 (消息ID -> 时间戳)，由于过期时间固定，最早插入的记录总是最先过期，
+    每次操作只需从队首弹出过期记录，插入/查询/过期均摊 O(1)。超过容量上限时淘汰最早的记录。
+    """
+
+    def __init__(self, ttl: float = 60, max_size: int = 10000):
+        """
+        Args:
+            ttl: 记录过期时间（秒）
+            max_size: 最多保存的记录数
+        """
+        self.ttl = ttl
+        self.max_size = max_size
+        self._entries: "OrderedDict[Hashable, float]" = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def __len__(self):
+        return len(self._entries)
+
+    def _expire(self, now: float):
+        entries = self._entries
+        while entries:
+            key, timestamp = next(iter(entries.items()))
+            if now - timestamp <= self.ttl:
+                break
+            entries.popitem(last=False)
+            self.evictions += 1
+
+    def contains(self, key: Hashable) -> bool:
+        """检查消息是否已处理"""
+        self._expire(time.time())
+        if key in self._entries:
+            self.hits += 1
+            return True
+        self.misses += 1
+        return False
+
+    def add(self, key: Hashable):
+        """标记消息为已处理"""
+        now = time.time()
+        self._expire(now)
+        self._entries[key] = now
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_size:
+            self._entries.popitem(last=False)
+            self.evictions += 1
+
+    def stats(self) -> dict:
+        return {"size": len(self._entries), "hits": self.hits, "misses": self.misses, "evictions": self.evictions}
+
+    def save(self, path: str):
+        """保存未过期的记录，重启后用于识别重复投递的消息"""
+        self._expire(time.time())
+        tmp_path = f"{path}.tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump(list(self._entries.items()), f)
+        os.replace(tmp_path, path)
+
+    def load(self, path: str) -> Optional[int]:
+        """从快照恢复未过期的记录，返回恢复的条数"""
+        if not os.path.exists(path):
+            return None
+        try:
+            with open(path, "r", encoding="utf-8") as f:
+                items = json.load(f)
+        except Exception as e:
+            logger.warning(f"读取消息去重快照失败: {e}")
+            return None
+        now = time.time()
+        for key, timestamp in sorted(items, key=lambda item: item[1]):
+            if now - timestamp <= self.ttl and key not in self._entries:
+                self._entries[key] = timestamp
+        while len(self._entries) > self.max_size:
+            self._entries.popitem(last=False)
+        return len(self._entries)
+
+
+class TTLCache:
+    """固定过期时间的键值缓存
+
+    与 TTLDedupStore 相同，按写入顺序保存，最早写入的记录最先过期，过期与容量淘汰均摊 O(1)。
+    """
+
+    def __init__(self, ttl: float = 3600, max_size: int = 10000):
+        """
+        Args:
+            ttl: 记录过期时间（秒）
+            max_size: 最多保存的记录数
+        """
+        self.ttl = ttl
+        self.max_size = max_size
+        # key -> (value, 写入时间)
+        self._entries: "OrderedDict[Hashable, tuple]" = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def __len__(self):
+        return len(self._entries)
+
+    def _expire(self, now: float):
+        entries = self._entries
+        while entries:
+            value, timestamp = next(iter(entries.values()))
+            if now - timestamp <= self.ttl:
+                break
+            entries.popitem(last=False)
+            self.evictions += 1
+
+    def get(self, key: Hashable, default=None):
+        """读取缓存，不存在或已过期返回 default"""
+        self._expire(time.time())
+        entry = self._entries.get(key)
+        if entry is None:
+            self.misses += 1
+            return default
+        self.hits += 1
+        return entry[0]
+
+    def set(self, key: Hashable, value):
+        """写入缓存，重新写入会重新计算过期时间"""
+        now = time.time()
+        self._expire(now)
+        self._entries[key] = (value, now)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_size:
+            self._entries.popitem(last=False)
+            self.evictions += 1
+
+    def pop(self, key: Hashable, default=None):
+        """删除记录，返回其内容"""
+        entry = self._entries.pop(key, None)
+        return default if entry is None else entry[0]
+
+    def items(self):
+        """未过期的 (key, value)"""
+        self._expire(time.time())
+        return [(key, entry[0]) for key, entry in self._entries.items()]
+
+    def stats(self) -> dict:
+        return {"size": len(self._entries), "hits": self.hits, "misses": self.misses, "evictions": self.evictions}
+
+
+class MediaCache:
+    """按字节预算限制的 LRU 媒体缓存（图片、文件）
+
+    每条记录有自己的过期时间，读取时刷新；总字节数超过预算时淘汰最久未使用的记录，
+    单条超过 max_entry_bytes 的内容不缓存。过期记录在读取时或由 sweep() 定期清理。
+    """
+
+    def __init__(self, max_bytes: int = 256 * 1024 * 1024, max_entry_bytes: int = 50 * 1024 * 1024):
+        """
+        Args:
+            max_bytes: 缓存总字节数上限
+            max_entry_bytes: 单条记录字节数上限
+        """
+        self.max_bytes = max_bytes
+        self.max_entry_bytes = max_entry_bytes
+        # key -> [value, 字节数, 过期时长, 最近访问时间]
+        self._entries: "OrderedDict[Hashable, list]" = OrderedDict()
+        self.bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def __contains__(self, key: Hashable) -> bool:
+        return key in self._entries
+
+    def _remove(self, key: Hashable):
+        entry = self._entries.pop(key)
+        self.bytes -= entry[1]
+
+    def put(self, key: Hashable, value, size: int, ttl: float) -> bool:
+        """写入缓存，返回是否缓存成功"""
+        if size > self.max_entry_bytes:
+            logger.warning(f"缓存内容 {size} 字节超过单条上限 {self.max_entry_bytes} 字节，不缓存")
+            return False
+        if key in self._entries:
+            self._remove(key)
+        self._entries[key] = [value, size, ttl, time.time()]
+        self.bytes += size
+        while self.bytes > self.max_bytes and len(self._entries) > 1:
+            oldest = next(iter(self._entries))
+            self._remove(oldest)
+            self.evictions += 1
+            logger.debug(f"媒体缓存超过 {self.max_bytes} 字节，淘汰 {oldest}")
+        return True
+
+    def get(self, key: Hashable, refresh: bool = True):
+        """读取缓存，过期返回 None；refresh 为真时刷新访问时间"""
+        entry = self._entries.get(key)
+        if entry is None:
+            self.misses += 1
+            return None
+        now = time.time()
+        if now - entry[3] > entry[2]:
+            self._remove(key)
+            self.evictions += 1
+            self.misses += 1
+            return None
+        if refresh:
+            entry[3] = now
+            self._entries.move_to_end(key)
+        self.hits += 1
+        return entry[0]
+
+    def age(self, key: Hashable) -> Optional[float]:
+        """记录距最近访问的秒数，不存在返回 None"""
+        entry = self._entries.get(key)
+        return None if entry is None else time.time() - entry[3]
+
+    def pop(self, key: Hashable):
+        """删除记录，返回其内容"""
+        entry = self._entries.get(key)
+        if entry is None:
+            return None
+        self._remove(key)
+        return entry[0]
+
+    def sweep(self) -> int:
+        """清理所有过期记录，返回清理条数"""
+        now = time.time()
+        expired = [key for key, entry in self._entries.items() if now - entry[3] > entry[2]]
+        for key in expired:
+            self._remove(key)
+        self.evictions += len(expired)
+        return len(expired)
+
+    def stats(self) -> dict:
+        return {"entries": len(self._entries), "bytes": self.bytes, "hits": self.hits, "misses": self.misses,
+                "evictions": self.evictions}
+
+
+class AsyncLoadingCache:
+    """带请求合并和后台刷新的异步缓存，用于昵称、群成员列表等协议端查询
+
+    未命中时调用 loader 加载，同一个键同时只有一个加载任务，并发的未命中共享同一次加载；
+    记录超过 refresh_after 秒后仍直接返回，同时在后台刷新；超过 ttl 秒的记录需要重新加载，
+    重新加载失败时返回过期的旧值。loader 返回 None 表示没有结果，不缓存。
+    """
+
+    def __init__(self, ttl: float = 3600, max_size: int = 10000, refresh_after: Optional[float] = None):
+        """
+        Args:
+            ttl: 记录过期时间（秒）
+            max_size: 最多保存的记录数，超过时淘汰最久未使用的记录
+            refresh_after: 记录超过该时间（秒）后在后台刷新，默认为 ttl 的80%
+        """
+        self.ttl = ttl
+        self.max_size = max_size
+        self.refresh_after = ttl * 0.8 if refresh_after is None else refresh_after
+        # key -> (value, 加载时间)
+        self._entries: "OrderedDict[Hashable, tuple]" = OrderedDict()
+        self._loading: Dict[Hashable, asyncio.Task] = {}
+        self.hits = 0
+        self.misses = 0
+        self.refreshes = 0
+
+    def __len__(self):
+        return len(self._entries)
+
+    async def get(self, key: Hashable, loader: Callable[[], Awaitable]):
+        """读取缓存，未命中或已过期时通过 loader 加载"""
+        entry = self._entries.get(key)
+        if entry is not None:
+            age = time.monotonic() - entry[1]
+            if age <= self.ttl:
+                self.hits += 1
+                self._entries.move_to_end(key)
+                if age > self.refresh_after and key not in self._loading:
+                    self.refreshes += 1
+                    self._start(key, loader)
+                return entry[0]
+
+        self.misses += 1
+        task = self._loading.get(key) or self._start(key, loader)
+        try:
+            # 调用方被取消时不取消共享的加载任务
+            return await asyncio.shield(task)
+        except Exception as e:
+            if entry is None:
+                raise
+            logger.warning(f"刷新缓存 {key} 失败，使用过期数据: {e}")
+            return entry[0]
+
+    def _start(self, key: Hashable, loader: Callable[[], Awaitable]) -> asyncio.Task:
+        task = asyncio.create_task(self._load(key, loader))
+        self._loading[key] = task
+        task.add_done_callback(self._loaded)
+        return task
+
+    async def _load(self, key: Hashable, loader: Callable[[], Awaitable]):
+        try:
+            value = await loader()
+            if value is not None:
+                self._entries[key] = (value, time.monotonic())
+                self._entries.move_to_end(key)
+                while len(self._entries) > self.max_size:
+                    self._entries.popitem(last=False)
+            return value
+        finally:
+            self._loading.pop(key, None)
+
+    @staticmethod
+    def _loaded(task: asyncio.Task):
+        # 后台刷新没有等待者，在这里取出异常，避免 "exception was never retrieved"
+        if not task.cancelled() and task.exception() is not None:
+            logger.debug(f"缓存加载失败: {task.exception()}")
+
+    def pop(self, key: Hashable):
+        """删除记录，返回其内容"""
+        entry = self._entries.pop(key, None)
+        return None if entry is None else entry[0]
+
+    def stats(self) -> dict:
+        return {"size": len(self._entries), "loading": len(self._loading), "hits": self.hits, "misses": self.misses,
+                "refreshes": self.refreshes}
+
+
+class JsonFileCache:
+    """JSON文件的缓存
+
+    只有文件的修改时间或大小变化时才重新读取解析；两次检查间隔不小于 check_interval 秒，
+    间隔内直接返回缓存内容。文件不存在或解析失败时返回 None。
+    """
+
+    def __init__(self, path: str, check_interval: float = 2):
+        """
+        Args:
+            path: 文件路径
+            check_interval: 检查文件变化的最小间隔（秒）
+        """
+        self.path = path
+        self.check_interval = check_interval
+        self._signature = None
+        self._value = None
+        self._checked_at = None
+        self.loads = 0
+
+    def get(self):
+        """读取文件内容"""
+        now = time.monotonic()
+        if self._checked_at is not None and now - self._checked_at < self.check_interval:
+            return self._value
+        self._checked_at = now
+        try:
+            stat = os.stat(self.path)
+        except OSError:
+            self._signature = self._value = None
+            return None
+        signature = (stat.st_mtime_ns, stat.st_size)
+        if signature != self._signature:
+            self._signature = signature
+            self.loads += 1
+            try:
+                with open(self.path, "r", encoding="utf-8") as f:
+                    self._value = json.load(f)
+            except Exception as e:
+                logger.error(f"读取文件 {self.path} 失败: {e}")
+                self._value = None
+        return self._value
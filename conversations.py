@@ -0,0 +1,149 @@
+import asyncio
+from collections import OrderedDict
+from typing import Dict, Optional, Tuple
+
+from loguru import logger
+
+
+class ConversationCache:
+    """XYBotDB 中Dify会话ID的内存缓存
+
+    读取时先查内存，未命中才在线程中访问数据库，并发查询同一对象只读取一次；写入只更新内存并记为待写回，
+    由 flush() 定期批量写回数据库（write_behind 为假时立即写回）。待写回和正在写回的记录不会被淘汰，
+    读取总能得到最新值。
+    会话ID只在创建它的Dify端点上有效，端点的 base_url 与会话ID一起保存（"会话ID@base_url"），
+    重启后仍能把会话发到原来的端点；旧版本保存的会话ID没有端点部分。
+    """
+
+    def __init__(self, db, namespace: str = "dify", max_size: int = 10000, write_behind: bool = True):
+        """
+        Args:
+            db: XYBotDB实例
+            namespace: 会话ID的命名空间
+            max_size: 最多缓存的会话ID数
+            write_behind: 是否延迟批量写回数据库
+        """
+        self.db = db
+        self.namespace = namespace
+        self.max_size = max_size
+        self.write_behind = write_behind
+        self._ids: "OrderedDict[str, str]" = OrderedDict()
+        self._dirty: Dict[str, str] = {}
+        self._flushing: Dict[str, str] = {}
+        self._loading: Dict[str, asyncio.Task] = {}
+        self._flush_lock = asyncio.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def _cached(self, wxid: str) -> Optional[str]:
+        if wxid in self._ids:
+            self._ids.move_to_end(wxid)
+            return self._ids[wxid]
+        for pending in (self._dirty, self._flushing):
+            if wxid in pending:
+                return pending[wxid]
+        return None
+
+    def _read(self, wxid: str) -> str:
+        return self.db.get_llm_thread_id(wxid, namespace=self.namespace) or ""
+
+    @staticmethod
+    def _encode(conversation_id: str, base_url: Optional[str]) -> str:
+        return f"{conversation_id}@{base_url}" if conversation_id and base_url else conversation_id
+
+    @staticmethod
+    def _decode(value: str) -> Tuple[str, Optional[str]]:
+        conversation_id, _, base_url = value.partition("@")
+        return conversation_id, base_url or None
+
+    async def get(self, wxid: str) -> str:
+        """获取会话ID，没有时返回空字符串"""
+        return self._decode(await self._get(wxid))[0]
+
+    async def get_with_endpoint(self, wxid: str) -> Tuple[str, Optional[str]]:
+        """获取会话ID和创建会话的端点 base_url，没有会话时返回 ("", None)，旧数据没有端点时端点为 None"""
+        return self._decode(await self._get(wxid))
+
+    async def _get(self, wxid: str) -> str:
+        conversation_id = self._cached(wxid)
+        if conversation_id is not None:
+            self.hits += 1
+            return conversation_id
+
+        self.misses += 1
+        task = self._loading.get(wxid)
+        if task is None:
+            task = self._loading[wxid] = asyncio.create_task(asyncio.to_thread(self._read, wxid))
+            task.add_done_callback(lambda _: self._loading.pop(wxid, None))
+        try:
+            loaded = await asyncio.shield(task)
+        except Exception as e:
+            logger.error(f"读取 {wxid} 的会话ID失败: {e}")
+            return ""
+
+        # 读取期间可能已经写入了新的会话ID
+        conversation_id = self._cached(wxid)
+        if conversation_id is None:
+            conversation_id = loaded
+            self._remember(wxid, conversation_id)
+        return conversation_id
+
+    def set(self, wxid: str, conversation_id: str, base_url: Optional[str] = None):
+        """保存会话ID及创建会话的端点"""
+        conversation_id = self._encode(conversation_id, base_url)
+        self._remember(wxid, conversation_id)
+        if self.write_behind:
+            self._dirty[wxid] = conversation_id
+        else:
+            self.db.save_llm_thread_id(wxid, conversation_id, self.namespace)
+
+    def reset(self, wxid: str):
+        """清空会话ID，下次请求由Dify创建新会话"""
+        self.set(wxid, "")
+
+    def _remember(self, wxid: str, conversation_id: str):
+        self._ids[wxid] = conversation_id
+        self._ids.move_to_end(wxid)
+        while len(self._ids) > self.max_size:
+            self._ids.popitem(last=False)
+
+    def _write(self, batch: Dict[str, str]):
+        for wxid, conversation_id in batch.items():
+            self.db.save_llm_thread_id(wxid, conversation_id, self.namespace)
+
+    def _restore(self, batch: Dict[str, str]):
+        # 写回失败，未被新值覆盖的记录重新标记为待写回
+        for wxid, conversation_id in batch.items():
+            self._dirty.setdefault(wxid, conversation_id)
+
+    async def flush_async(self) -> int:
+        """在线程中批量写回待写回的会话ID，返回写回的记录数"""
+        async with self._flush_lock:
+            if not self._dirty:
+                return 0
+            batch, self._dirty = self._dirty, {}
+            self._flushing = batch
+            try:
+                await asyncio.to_thread(self._write, batch)
+            except Exception as e:
+                logger.error(f"会话ID写回数据库失败: {e}")
+                self._restore(batch)
+                return 0
+            finally:
+                self._flushing = {}
+            return len(batch)
+
+    def flush(self) -> int:
+        """同步写回待写回的会话ID（插件卸载时调用），返回写回的记录数"""
+        batch = {**self._flushing, **self._dirty}
+        self._dirty = {}
+        try:
+            self._write(batch)
+        except Exception as e:
+            logger.error(f"会话ID写回数据库失败: {e}")
+            self._restore(batch)
+            return 0
+        return len(batch)
+
+    def stats(self) -> dict:
+        return {"entries": len(self._ids), "dirty": len(self._dirty), "hits": self.hits, "misses": self.misses}
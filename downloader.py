@@ -0,0 +1,141 @@
+import asyncio
+import base64
+from typing import Optional
+
+import aiohttp
+from loguru import logger
+
+from plugins.DifyPlus.httpclient import HttpClientPool
+
+# 协议端的两种文件下载接口路径，依次尝试
+DOWNLOAD_FILE_PATHS = ("/api/Tools/DownloadFile", "/VXAPI/Tools/DownloadFile")
+
+
+def _decode_section(data) -> Optional[bytes]:
+    """从 Tools/DownloadFile 的 Data 字段中取出分段数据，兼容几种返回格式"""
+    if isinstance(data, dict):
+        if "buffer" in data:
+            return base64.b64decode(data["buffer"])
+        if isinstance(data.get("data"), dict) and "buffer" in data["data"]:
+            return base64.b64decode(data["data"]["buffer"])
+        return base64.b64decode(str(data))
+    if isinstance(data, str):
+        return base64.b64decode(data)
+    return None
+
+
+class ChunkedDownloader:
+    """通过协议端 Tools/DownloadFile 接口并发分段下载附件
+
+    文件按 chunk_size 切分，最多 window 个分段同时请求，每段按偏移写入预先分配的缓冲区，
+    单段失败时重试 retries 次。任一分段最终失败则放弃当前接口，尝试下一个接口路径。
+    """
+
+    def __init__(self, http_pool: HttpClientPool, chunk_size: int = 64 * 1024, window: int = 8,
+                 retries: int = 2, timeout: float = 60):
+        """
+        Args:
+            http_pool: 共享的HTTP连接池
+            chunk_size: 每段大小（字节）
+            window: 同时下载的最大分段数
+            retries: 单段失败后的重试次数
+            timeout: 单段请求超时时间（秒）
+        """
+        self.http_pool = http_pool
+        self.chunk_size = max(1, chunk_size)
+        self.window = max(1, window)
+        self.retries = max(0, retries)
+        self.timeout = aiohttp.ClientTimeout(total=timeout)
+
+    async def download(self, base_url: str, wxid: str, attach_id: str, total_len: int,
+                       app_id: str = "") -> Optional[bytes]:
+        """
+        下载附件
+
+        Args:
+            base_url: 协议端地址，如 http://127.0.0.1:9011
+            wxid: 机器人wxid
+            attach_id: 附件ID
+            total_len: 文件总大小（字节）
+            app_id: 应用ID（可选）
+
+        Returns:
+            bytes: 完整的文件内容，所有接口都失败时返回 None
+        """
+        if total_len <= 0:
+            logger.warning(f"文件大小无效: {total_len}，无法分段下载")
+            return None
+
+        sections = (total_len + self.chunk_size - 1) // self.chunk_size
+        for path in DOWNLOAD_FILE_PATHS:
+            url = f"{base_url}{path}"
+            logger.info(f"尝试使用 {url} 下载文件，总大小: {total_len} 字节，分 {sections} 段，"
+                        f"并发 {min(self.window, sections)} 段")
+            try:
+                file_data = await self._download_from(url, wxid, attach_id, total_len, app_id)
+            except Exception as e:
+                logger.error(f"使用 {url} 下载文件时出错: {e}")
+                file_data = None
+            if file_data is not None:
+                logger.info(f"文件下载成功: AttachId={attach_id}, 实际大小: {len(file_data)} 字节")
+                return file_data
+            logger.warning(f"使用 {url} 下载文件失败，尝试下一个API端点")
+        return None
+
+    async def _download_from(self, url: str, wxid: str, attach_id: str, total_len: int,
+                             app_id: str) -> Optional[bytes]:
+        buffer = bytearray(total_len)
+        offsets = iter(range(0, total_len, self.chunk_size))
+        failed = False
+
+        async def worker(session: aiohttp.ClientSession):
+            nonlocal failed
+            # 所有 worker 共享同一个偏移迭代器，取到哪段下载哪段
+            for start in offsets:
+                if failed:
+                    return
+                length = min(self.chunk_size, total_len - start)
+                chunk = await self._fetch_section(session, url, wxid, attach_id, total_len, app_id, start, length)
+                if chunk is None:
+                    failed = True
+                    return
+                buffer[start:start + length] = chunk
+
+        async with self.http_pool.session(url) as session:
+            workers = min(self.window, (total_len + self.chunk_size - 1) // self.chunk_size)
+            await asyncio.gather(*(worker(session) for _ in range(workers)))
+        return None if failed else bytes(buffer)
+
+    async def _fetch_section(self, session: aiohttp.ClientSession, url: str, wxid: str, attach_id: str,
+                             total_len: int, app_id: str, start: int, length: int) -> Optional[bytes]:
+        """下载一段，返回恰好 length 字节的数据，重试后仍失败返回 None"""
+        json_param = {
+            "AppID": app_id,
+            "AttachId": attach_id,
+            "DataLen": total_len,
+            "Section": {
+                "DataLen": length,
+                "StartPos": start
+            },
+            "UserName": "",  # 可选参数
+            "Wxid": wxid
+        }
+        for attempt in range(self.retries + 1):
+            try:
+                async with session.post(url, json=json_param, timeout=self.timeout) as resp:
+                    if resp.status != 200:
+                        raise ValueError(f"API请求失败: {resp.status}")
+                    json_resp = await resp.json(content_type=None)
+                if not json_resp.get("Success"):
+                    raise ValueError(f"API返回错误: {json_resp.get('Message', 'Unknown error')}")
+                chunk = _decode_section(json_resp.get("Data"))
+                if not chunk or len(chunk) < length:
+                    raise ValueError(f"分段数据不完整: {len(chunk or b'')}/{length} 字节")
+                logger.debug(f"分段下载成功，起始位置: {start}，大小: {length} 字节")
+                return chunk[:length]
+            except Exception as e:
+                logger.warning(f"下载分段失败（起始位置: {start}，第 {attempt + 1} 次）: {e}")
+                if attempt < self.retries:
+                    await asyncio.sleep(0.5 * 2 ** attempt)
+        logger.error(f"分段下载失败，起始位置: {start}，大小: {length} 字节")
+        return None
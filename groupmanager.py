@@ -1,5 +1,7 @@
-import pickle
-from typing import Dict, Optional
+import asyncio
+import sqlite3
+import threading
+from typing import Callable, Dict, List, Optional, Tuple
 from loguru import logger
 
 # 假设 ModelConfig 是一个类或 TypedDict
@@ -8,11 +10,86 @@ class ModelConfig:
 
 
 class UserGroupModelManager:
-    def __init__(self):
-        # 三级字典结构：user_id -> group_id -> ModelConfig
-        self._user_group_models: Dict[str, Dict[str, ModelConfig]] = {}
+    """用户在各群组的默认模型
 
-    def set_user_group_model(self, user_id: str, group_id: str, model: ModelConfig) -> None:
+    只保存模型名称，查询时通过 resolve 换成当前配置中的 ModelConfig，配置重载或模型删除后不会返回过期的配置。
+    指定 path 时持久化到 SQLite：某个用户的记录在第一次查询时才在线程中从数据库读取，并发查询同一用户只读取一次；
+    设置和清除只更新内存并记为待写回，由 flush_async() 定期在线程中批量写回，事件循环上不访问数据库。
+    """
+
+    def __init__(self, resolve: Callable[[str], Optional[ModelConfig]], path: Optional[str] = None):
+        """
+        :param resolve: 模型名称 -> 模型配置，找不到时返回 None
+        :param path: SQLite数据库文件路径，为 None 时只保存在内存中
+        """
+        self.resolve = resolve
+        self.path = path
+        # 二级字典结构：user_id -> group_id -> 模型名称，只包含已从数据库加载的用户
+        self._user_group_models: Dict[str, Dict[str, str]] = {}
+        # 待写回和正在写回的修改：user_id -> group_id -> 模型名称（None 表示删除）
+        self._dirty: Dict[str, Dict[str, Optional[str]]] = {}
+        self._flushing: Dict[str, Dict[str, Optional[str]]] = {}
+        self._loading: Dict[str, asyncio.Task] = {}
+        self._flush_lock = asyncio.Lock()
+        self._conn: Optional[sqlite3.Connection] = None
+        self._lock = threading.Lock()
+
+    def _db(self) -> sqlite3.Connection:
+        # 调用方持有 self._lock
+        if self._conn is None:
+            conn = sqlite3.connect(self.path, check_same_thread=False, isolation_level=None)
+            # 新建的数据库启用增量回收，compact() 归还删除记录占用的空间
+            conn.execute("PRAGMA auto_vacuum=INCREMENTAL")
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS user_group_models ("
+                "user_id TEXT NOT NULL, group_id TEXT NOT NULL, model_name TEXT NOT NULL, "
+                "PRIMARY KEY (user_id, group_id)) WITHOUT ROWID"
+            )
+            self._conn = conn
+        return self._conn
+
+    def _read(self, user_id: str) -> List[Tuple[str, str]]:
+        with self._lock:
+            return self._db().execute("SELECT group_id, model_name FROM user_group_models WHERE user_id = ?",
+                                      (user_id,)).fetchall()
+
+    async def _user_models(self, user_id: str) -> Dict[str, str]:
+        user_models = self._user_group_models.get(user_id)
+        if user_models is not None:
+            return user_models
+        if self.path is None:
+            return self._user_group_models.setdefault(user_id, {})
+
+        task = self._loading.get(user_id)
+        if task is None:
+            task = self._loading[user_id] = asyncio.create_task(asyncio.to_thread(self._read, user_id))
+            task.add_done_callback(lambda _: self._loading.pop(user_id, None))
+        try:
+            rows = await asyncio.shield(task)
+        except Exception as e:
+            logger.error(f"读取用户 {user_id} 的群组默认模型失败: {e}")
+            return {}
+
+        user_models = self._user_group_models.get(user_id)
+        if user_models is None:
+            user_models = dict(rows)
+            # 尚未写回的修改覆盖数据库中的旧值
+            for pending in (self._flushing, self._dirty):
+                for group_id, model_name in pending.get(user_id, {}).items():
+                    if model_name is None:
+                        user_models.pop(group_id, None)
+                    else:
+                        user_models[group_id] = model_name
+            self._user_group_models[user_id] = user_models
+        return user_models
+
+    def _mark_dirty(self, user_id: str, group_id: str, model_name: Optional[str]):
+        if self.path is not None:
+            self._dirty.setdefault(user_id, {})[group_id] = model_name
+
+    async def set_user_group_model(self, user_id: str, group_id: str, model: ModelConfig) -> None:
         """
         设置用户在某群组的模型配置
         :param user_id: 用户ID
@@ -20,43 +97,112 @@ class UserGroupModelManager:
         :param model: 模型配置对象
         """
         if group_id is None: group_id = "0"
-        if user_id not in self._user_group_models:
-            self._user_group_models[user_id] = {}
-
-        self._user_group_models[user_id][group_id] = model
+        user_models = await self._user_models(user_id)
+        if user_models.get(group_id) == model.name:
+            return
+        user_models[group_id] = model.name
+        self._mark_dirty(user_id, group_id, model.name)
         logger.debug(f"已为用户 {user_id} 在群组 {group_id} 设置默认模型配置")
 
-    def get_user_group_model(self, user_id: str, group_id: str) -> Optional[ModelConfig]:
+    async def get_user_group_model(self, user_id: str, group_id: str) -> Optional[ModelConfig]:
         """
         获取用户在某群组的模型配置
         :param user_id: 用户ID
         :param group_id: 群组ID
-        :return: 模型配置对象，如果不存在则返回 None
+        :return: 模型配置对象，如果不存在（或模型已从配置中删除）则返回 None
         """
         if group_id is None: group_id = "0"
-        user_configs = self._user_group_models.get(user_id, {})
-        model = user_configs.get(group_id)
+        model_name = (await self._user_models(user_id)).get(group_id)
+        if model_name is None:
+            # logger.debug(f"DifyEher | 未找到用户 {user_id} 在群组 {group_id} 的默认模型配置")
+            return None
+        return self.resolve(model_name)
 
-        # if model is None:
-        #     logger.debug(f"DifyEher | 未找到用户 {user_id} 在群组 {group_id} 的默认模型配置")
-        return model
-
-    def clear_user_group_model(self, user_id: str, group_id: str) -> bool:
+    async def clear_user_group_model(self, user_id: str, group_id: str) -> bool:
         """
         清除用户在某群组的模型配置
         :return: 是否成功清除
         """
         if group_id is None: group_id = "0"
-        if user_id in self._user_group_models and group_id in self._user_group_models[user_id]:
-            del self._user_group_models[user_id][group_id]
+        user_models = await self._user_models(user_id)
+        if group_id in user_models:
+            del user_models[group_id]
+            self._mark_dirty(user_id, group_id, None)
             print(f"已清除用户 {user_id} 在群组 {group_id} 的默认模型配置")
             return True
         return False
 
-    def save_to_file(self, path: str):
-        with open(path, 'wb') as f:
-            pickle.dump(self._user_group_models, f)
+    def _write(self, batch: Dict[str, Dict[str, Optional[str]]]):
+        upserts = [(user_id, group_id, model_name) for user_id, groups in batch.items()
+                   for group_id, model_name in groups.items() if model_name is not None]
+        deletes = [(user_id, group_id) for user_id, groups in batch.items()
+                   for group_id, model_name in groups.items() if model_name is None]
+        with self._lock:
+            db = self._db()
+            db.execute("BEGIN")
+            try:
+                db.executemany("INSERT INTO user_group_models (user_id, group_id, model_name) VALUES (?, ?, ?) "
+                               "ON CONFLICT (user_id, group_id) DO UPDATE SET model_name = excluded.model_name",
+                               upserts)
+                db.executemany("DELETE FROM user_group_models WHERE user_id = ? AND group_id = ?", deletes)
+                db.execute("COMMIT")
+            except Exception:
+                db.execute("ROLLBACK")
+                raise
+
+    def _restore(self, batch: Dict[str, Dict[str, Optional[str]]]):
+        # 写回失败，未被新值覆盖的修改重新标记为待写回
+        for user_id, groups in batch.items():
+            dirty = self._dirty.setdefault(user_id, {})
+            for group_id, model_name in groups.items():
+                dirty.setdefault(group_id, model_name)
+
+    async def flush_async(self) -> int:
+        """在线程中批量写回待写回的修改，返回写回的用户数"""
+        async with self._flush_lock:
+            if not self._dirty:
+                return 0
+            batch, self._dirty = self._dirty, {}
+            self._flushing = batch
+            try:
+                await asyncio.to_thread(self._write, batch)
+            except Exception as e:
+                logger.error(f"群组默认模型写回数据库失败: {e}")
+                self._restore(batch)
+                return 0
+            finally:
+                self._flushing = {}
+            return len(batch)
+
+    def flush(self) -> int:
+        """同步写回待写回的修改（插件卸载时调用），返回写回的用户数"""
+        batch = {user_id: {**self._flushing.get(user_id, {}), **self._dirty.get(user_id, {})}
+                 for user_id in {*self._flushing, *self._dirty}}
+        self._dirty = {}
+        if not batch:
+            return 0
+        try:
+            self._write(batch)
+        except Exception as e:
+            logger.error(f"群组默认模型写回数据库失败: {e}")
+            self._restore(batch)
+            return 0
+        return len(batch)
+
+    def _vacuum(self):
+        with self._lock:
+            if self._conn is not None:
+                self._conn.execute("PRAGMA incremental_vacuum")
+                self._conn.execute("PRAGMA wal_checkpoint(TRUNCATE)")
+
+    async def compact(self) -> None:
+        """释放内存中没有任何设置的用户（下次查询时重新读取），并在线程中归还已删除记录占用的数据库空间"""
+        for user_id in [user_id for user_id, user_models in self._user_group_models.items() if not user_models]:
+            del self._user_group_models[user_id]
+        await asyncio.to_thread(self._vacuum)
 
-    def load_from_file(self, path: str):
-        with open(path, 'rb') as f:
-            self._user_group_models = pickle.load(f)
\ No newline at end of file
+    def close(self) -> None:
+        with self._lock:
+            if self._conn is not None:
+                self._conn.close()
+                self._conn = None
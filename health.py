@@ -0,0 +1,153 @@
+import time
+from contextlib import asynccontextmanager
+from typing import Dict
+
+from loguru import logger
+
+CLOSED = "closed"
+OPEN = "open"
+HALF_OPEN = "half-open"
+
+
+class CircuitOpenError(Exception):
+    """端点熔断中，请求未发出"""
+
+
+class EndpointHealth:
+    """单个Dify端点的健康状态：错误率和延迟的指数加权平均、熔断状态、进行中的请求数"""
+
+    def __init__(self, base_url: str):
+        self.base_url = base_url
+        self.state = CLOSED
+        self.error_rate = 0.0
+        self.latency = None  # 秒，EWMA
+        self.samples = 0
+        self.consecutive_failures = 0
+        self.opened_at = 0.0
+        self.outstanding = 0
+        self.probing = False
+
+    def stats(self) -> dict:
+        return {"state": self.state, "error_rate": round(self.error_rate, 3),
+                "latency": None if self.latency is None else round(self.latency, 3),
+                "outstanding": self.outstanding, "consecutive_failures": self.consecutive_failures}
+
+
+class _Call:
+    def __init__(self, tracker: "HealthTracker", health: EndpointHealth):
+        self._tracker = tracker
+        self._health = health
+        self._start = time.monotonic()
+        self.finished = False
+
+    def finish(self, ok: bool):
+        """记录请求结果，只有第一次调用生效；应在收到响应头时调用，延迟不包含流式读取时间"""
+        if not self.finished:
+            self.finished = True
+            self._tracker._record(self._health, ok, time.monotonic() - self._start)
+
+
+class HealthTracker:
+    """按 base-url 跟踪Dify端点健康状态的熔断器
+
+    连续失败 failure_threshold 次，或样本足够时错误率超过 error_rate_threshold，端点进入熔断（open），
+    open_seconds 内的请求直接失败；之后进入半开（half-open），只放行一个探测请求，成功则恢复，失败则继续熔断。
+    失败指连接错误、超时和 5xx 响应。
+    """
+
+    def __init__(self, failure_threshold: int = 5, error_rate_threshold: float = 0.5, min_samples: int = 10,
+                 open_seconds: float = 30, alpha: float = 0.2):
+        """
+        Args:
+            failure_threshold: 触发熔断的连续失败次数
+            error_rate_threshold: 触发熔断的错误率
+            min_samples: 按错误率判断熔断前至少需要的样本数
+            open_seconds: 熔断持续时间（秒）
+            alpha: 指数加权平均的平滑系数
+        """
+        self.failure_threshold = failure_threshold
+        self.error_rate_threshold = error_rate_threshold
+        self.min_samples = min_samples
+        self.open_seconds = open_seconds
+        self.alpha = alpha
+        self._endpoints: Dict[str, EndpointHealth] = {}
+
+    def get(self, base_url: str) -> EndpointHealth:
+        health = self._endpoints.get(base_url)
+        if health is None:
+            health = self._endpoints[base_url] = EndpointHealth(base_url)
+        return health
+
+    def available(self, base_url: str) -> bool:
+        """端点当前是否可以接收请求（熔断中且未到探测时间时返回 False）"""
+        health = self._endpoints.get(base_url)
+        if health is None or health.state == CLOSED:
+            return True
+        if health.state == OPEN:
+            return time.monotonic() - health.opened_at >= self.open_seconds
+        return not health.probing
+
+    def retry_after(self, base_url: str) -> float:
+        """距离下次允许探测的秒数"""
+        health = self._endpoints.get(base_url)
+        if health is None or health.state != OPEN:
+            return 0.0
+        return max(0.0, self.open_seconds - (time.monotonic() - health.opened_at))
+
+    @asynccontextmanager
+    async def call(self, base_url: str):
+        """
+        包裹一次请求。端点熔断中时抛出 CircuitOpenError；
+        请求内可调用 call.finish(ok) 提前记录结果，否则正常退出记为成功、异常退出记为失败。
+        """
+        health = self.get(base_url)
+        if not self.available(base_url):
+            raise CircuitOpenError(f"{base_url} 熔断中，{self.retry_after(base_url):.0f}秒后重试")
+        if health.state != CLOSED:
+            health.state = HALF_OPEN
+            health.probing = True
+            logger.info(f"Dify端点 {base_url} 半开，发送探测请求")
+
+        call = _Call(self, health)
+        health.outstanding += 1
+        try:
+            yield call
+        except Exception:
+            call.finish(False)
+            raise
+        except BaseException:
+            # 请求被取消，不计入统计，允许下一个请求继续探测
+            if not call.finished:
+                call.finished = True
+                health.probing = False
+            raise
+        else:
+            call.finish(True)
+        finally:
+            health.outstanding -= 1
+
+    def _record(self, health: EndpointHealth, ok: bool, latency: float):
+        alpha = self.alpha
+        health.samples += 1
+        health.error_rate = (1 - alpha) * health.error_rate + alpha * (0.0 if ok else 1.0)
+        health.latency = latency if health.latency is None else (1 - alpha) * health.latency + alpha * latency
+        if ok:
+            health.consecutive_failures = 0
+            if health.state != CLOSED:
+                logger.info(f"Dify端点 {health.base_url} 探测成功，恢复正常")
+                health.error_rate = 0.0
+            health.state = CLOSED
+            health.probing = False
+            return
+
+        health.consecutive_failures += 1
+        if (health.state == HALF_OPEN or health.consecutive_failures >= self.failure_threshold or
+                (health.samples >= self.min_samples and health.error_rate >= self.error_rate_threshold)):
+            if health.state != OPEN:
+                logger.warning(f"Dify端点 {health.base_url} 熔断 {self.open_seconds} 秒: {health.stats()}")
+            health.state = OPEN
+            health.opened_at = time.monotonic()
+            health.probing = False
+
+    def stats(self) -> Dict[str, dict]:
+        return {base_url: health.stats() for base_url, health in self._endpoints.items()}
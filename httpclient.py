@@ -0,0 +1,72 @@
+import asyncio
+from contextlib import asynccontextmanager
+from typing import Dict, Optional, Tuple
+from urllib.parse import urlsplit
+
+import aiohttp
+from loguru import logger
+
+
+class HttpClientPool:
+    """插件生命周期内共享的 aiohttp 连接池
+
+    按 (目标源站, 代理) 复用 ClientSession，同一个 Dify 服务或本地微信 API 的请求共用
+    keep-alive 连接，避免每条消息都重新建立 TCP/TLS 连接。插件卸载时调用 close() 统一关闭。
+    """
+
+    def __init__(self, limit: int = 100, limit_per_host: int = 20, keepalive_timeout: float = 30,
+                 dns_cache_ttl: int = 300):
+        """
+        Args:
+            limit: 每个连接池的最大连接数
+            limit_per_host: 每个主机的最大连接数
+            keepalive_timeout: 空闲连接保活时间（秒）
+            dns_cache_ttl: DNS 缓存时间（秒）
+        """
+        self.limit = limit
+        self.limit_per_host = limit_per_host
+        self.keepalive_timeout = keepalive_timeout
+        self.dns_cache_ttl = dns_cache_ttl
+        self._sessions: Dict[Tuple[str, str], aiohttp.ClientSession] = {}
+
+    @staticmethod
+    def _origin(base_url: Optional[str]) -> str:
+        """提取 scheme://host:port 作为连接池的键，未指定时使用共享的默认池"""
+        if not base_url:
+            return ""
+        parts = urlsplit(base_url)
+        return f"{parts.scheme}://{parts.netloc}".lower()
+
+    def get(self, base_url: Optional[str] = None, proxy: Optional[str] = None) -> aiohttp.ClientSession:
+        """获取 (base_url, proxy) 对应的共享会话，不存在或已关闭时新建"""
+        key = (self._origin(base_url), proxy or "")
+        session = self._sessions.get(key)
+        if session is None or session.closed:
+            connector = aiohttp.TCPConnector(
+                limit=self.limit,
+                limit_per_host=self.limit_per_host,
+                keepalive_timeout=self.keepalive_timeout,
+                ttl_dns_cache=self.dns_cache_ttl,
+                use_dns_cache=True,
+            )
+            session = aiohttp.ClientSession(connector=connector)
+            self._sessions[key] = session
+            logger.debug(f"创建HTTP连接池: {key[0] or '默认'}{' (代理: ' + key[1] + ')' if key[1] else ''}")
+        return session
+
+    @asynccontextmanager
+    async def session(self, base_url: Optional[str] = None, proxy: Optional[str] = None):
+        """以 async with 方式使用共享会话，退出时不关闭会话"""
+        yield self.get(base_url, proxy)
+
+    async def close(self):
+        """关闭所有会话，插件卸载时调用"""
+        sessions = list(self._sessions.values())
+        self._sessions.clear()
+        for session in sessions:
+            if not session.closed:
+                await session.close()
+        if sessions:
+            # 给底层 SSL 连接留出关闭时间，避免 "Unclosed connection" 警告
+            await asyncio.sleep(0.25)
+            logger.info(f"已关闭 {len(sessions)} 个HTTP连接池")
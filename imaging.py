@@ -0,0 +1,127 @@
+import asyncio
+import io
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+from typing import Optional, Tuple
+
+from loguru import logger
+from PIL import Image, ImageFile
+
+MAX_DIMENSION = 1600  # 最大尺寸限制
+MAX_UPLOAD_SIZE = 1024 * 1024 * 2  # 上传Dify的图片大小限制 2MB
+# 超过大小限制时在这些质量中二分查找能满足限制的最高质量
+QUALITY_STEPS = tuple(range(45, 95, 5))
+
+
+def _flatten_alpha(image: Image.Image) -> Image.Image:
+    """转换为RGB模式(去除alpha通道)"""
+    if image.mode in ('RGBA', 'LA'):
+        background = Image.new('RGB', image.size, (255, 255, 255))
+        background.paste(image, mask=image.split()[-1])
+        return background
+    return image
+
+
+def _limit_dimension(image: Image.Image, max_dimension: int) -> Image.Image:
+    width, height = image.size
+    if width > max_dimension or height > max_dimension:
+        ratio = min(max_dimension / width, max_dimension / height)
+        return image.resize((int(width * ratio), int(height * ratio)), Image.LANCZOS)
+    return image
+
+
+def _encode_jpeg(image: Image.Image, quality: int) -> bytes:
+    output = io.BytesIO()
+    image.save(output, format='JPEG', quality=quality, optimize=True)
+    return output.getvalue()
+
+
+def normalize_for_upload(data: bytes, max_dimension: int = MAX_DIMENSION,
+                         max_size: int = MAX_UPLOAD_SIZE) -> Tuple[bytes, int]:
+    """
+    把图片处理为适合上传Dify的JPEG：去除alpha通道、限制尺寸、限制文件大小
+
+    先以质量95编码，仍超过大小限制时在 QUALITY_STEPS 中二分查找满足限制的最高质量，
+    都不满足时使用最低质量。
+
+    Returns:
+        (JPEG数据, 使用的质量)
+    """
+    ImageFile.LOAD_TRUNCATED_IMAGES = True  # 允许加载截断的图片
+    image = Image.open(io.BytesIO(data))
+    image = _limit_dimension(_flatten_alpha(image), max_dimension)
+
+    content = _encode_jpeg(image, 95)
+    if len(content) <= max_size:
+        return content, 95
+
+    best = lowest = None
+    low, high = 0, len(QUALITY_STEPS) - 1
+    while low <= high:
+        middle = (low + high) // 2
+        quality = QUALITY_STEPS[middle]
+        encoded = _encode_jpeg(image, quality)
+        if len(encoded) <= max_size:
+            best = (encoded, quality)
+            low = middle + 1
+        else:
+            high = middle - 1
+            if middle == 0:
+                lowest = (encoded, quality)
+    # 所有质量都不满足时，查找必然经过最低质量
+    return best or lowest
+
+
+def shrink_for_send(data: bytes, max_dimension: int = MAX_DIMENSION) -> Optional[bytes]:
+    """尺寸超过限制时缩小并转为JPEG，未超过返回 None（直接发送原图）"""
+    ImageFile.LOAD_TRUNCATED_IMAGES = True
+    image = Image.open(io.BytesIO(data))
+    width, height = image.size
+    if width <= max_dimension and height <= max_dimension:
+        return None
+    image = _flatten_alpha(_limit_dimension(image, max_dimension))
+    return _encode_jpeg(image, 95)
+
+
+class ImageProcessor:
+    """图片处理执行器
+
+    PIL 的缩放和编码是CPU密集型操作，放到独立进程池中执行，避免阻塞事件循环；
+    workers 为 0 时退化为线程执行。
+    """
+
+    def __init__(self, workers: int = 2):
+        """
+        Args:
+            workers: 进程池大小，0 表示使用线程
+        """
+        self.workers = workers
+        self._executor: Optional[ProcessPoolExecutor] = None
+
+    def _get_executor(self) -> Optional[ProcessPoolExecutor]:
+        if self.workers > 0 and self._executor is None:
+            # 使用 spawn，避免在已有线程和事件循环的进程中 fork
+            self._executor = ProcessPoolExecutor(max_workers=self.workers,
+                                                 mp_context=multiprocessing.get_context("spawn"))
+            logger.info(f"已创建图片处理进程池，进程数: {self.workers}")
+        return self._executor
+
+    async def _run(self, func, *args):
+        executor = self._get_executor()
+        if executor is None:
+            return await asyncio.to_thread(func, *args)
+        return await asyncio.get_running_loop().run_in_executor(executor, func, *args)
+
+    async def normalize_for_upload(self, data: bytes) -> Tuple[bytes, int]:
+        """见 normalize_for_upload()"""
+        return await self._run(normalize_for_upload, data)
+
+    async def shrink_for_send(self, data: bytes) -> Optional[bytes]:
+        """见 shrink_for_send()"""
+        return await self._run(shrink_for_send, data)
+
+    def shutdown(self):
+        """关闭进程池"""
+        if self._executor is not None:
+            self._executor.shutdown(wait=False, cancel_futures=True)
+            self._executor = None
@@ -1,29 +1,44 @@
+import hashlib
 import io
 import json
 import re
-import subprocess
 import tomllib
 from typing import Optional, Union, Dict, List, Tuple, Any
 import time
 from dataclasses import dataclass, field
 import asyncio
+import functools
 from collections import defaultdict
 import urllib.parse
 import mimetypes
 import base64
-import uuid
 import aiohttp
 import filetype
 from loguru import logger
 import speech_recognition as sr
 import os
 import traceback
-import shutil
 import xml.etree.ElementTree as ET
 import utils
 from WechatAPI import WechatAPIClient
 from database.XYBotDB import XYBotDB
+from plugins.DifyPlus.balancer import Endpoint, EndpointBalancer
+from plugins.DifyPlus.cache import AsyncLoadingCache, JsonFileCache, MediaCache, TTLCache, TTLDedupStore
+from plugins.DifyPlus.conversations import ConversationCache
+from plugins.DifyPlus.downloader import ChunkedDownloader
 from plugins.DifyPlus.groupmanager import UserGroupModelManager
+from plugins.DifyPlus.health import CircuitOpenError, HealthTracker
+from plugins.DifyPlus.httpclient import HttpClientPool
+from plugins.DifyPlus.imaging import ImageProcessor
+from plugins.DifyPlus.mention import MentionMatcher
+from plugins.DifyPlus.outbound import AT, QUOTE, OutboundMessage, OutboundQueue
+from plugins.DifyPlus.outbox import Outbox
+from plugins.DifyPlus.rendering import ReplyRenderer
+from plugins.DifyPlus.retry import RetryPolicy
+from plugins.DifyPlus.router import ModelRouter
+from plugins.DifyPlus.scheduler import AdmissionController, AdmissionRejected, ConversationScheduler
+from plugins.DifyPlus.streaming import AnswerBuffer, StreamChunker, StreamSender, iter_sse_events
+from plugins.DifyPlus.transcoder import FfmpegTranscoder, TranscodeError
 from utils.decorators import *
 from utils.plugin_base import PluginBase
 from PIL import Image
@@ -49,13 +64,23 @@ VOICE_TRANSCRIPTION_FAILED = "\n语音转文字失败"
 TEXT_TO_VOICE_FAILED = "\n文本转语音失败"
 
 
-@dataclass
+@dataclass(eq=False, slots=True)
 class ModelConfig:
     api_key: str
     base_url: str
     trigger_words: list[str]
     description: str
     wakeup_words: list[str] = field(default_factory=list)  # 添加唤醒词列表字段
+    max_concurrency: int = 0  # 智能体并发上限，0表示使用 model-max-concurrency
+    endpoints: list[Endpoint] = field(default_factory=list)  # Dify端点列表，第一个与 api_key/base_url 相同
+    name: str = ""  # 智能体名称（config.toml中的键）
+    id: int = -1  # 智能体编号（配置顺序），用于相等比较和哈希
+
+    def __eq__(self, other):
+        return isinstance(other, ModelConfig) and self.id == other.id
+
+    def __hash__(self):
+        return hash(self.id)
 
 
 @dataclass
@@ -76,9 +101,12 @@ class DifyPlus(PluginBase):
     def __init__(self):
         super().__init__()
         self.user_models = {}  # 存储用户当前使用的智能体
-        self.processed_messages = {}  # 存储已处理的消息ID，避免重复处理
         self.message_expiry = 60  # 消息处理记录的过期时间（秒）
-        self.user_group_manager = UserGroupModelManager()
+        # 用户在各群组的默认智能体，只保存智能体名称，持久化到SQLite，查询时按名称取当前配置
+        self.user_group_manager = UserGroupModelManager(
+            resolve=lambda model_name: self.models.get(model_name),
+            path=os.path.join(os.path.dirname(__file__), "user_group_models.db")
+        )
 
         try:
             with open("main_config.toml", "rb") as f:
@@ -104,17 +132,38 @@ class DifyPlus(PluginBase):
             self.support_agent_mode = plugin_config.get("support_agent_mode", True)  # 添加Agent模式支持开关
             self.need_wakeup = plugin_config.get("need-wakeup", True)  # 私聊默认需要唤醒
             self.reply_title = plugin_config.get("reply-title", '')  # 私聊需要唤醒词，则回复内容添加抬头
+            # 流式发送配置：Dify仍在生成时就把已完成的段落发送给用户
+            self.stream_reply = plugin_config.get("stream-reply", False)
+            self.stream_chunk_size = plugin_config.get("stream-chunk-size", 0)  # 段落内按句切分的长度阈值，0为不切分
+            self.stream_flush_interval = plugin_config.get("stream-flush-interval", 0)  # 段落内按句切分的时间阈值（秒）
+            # HTTP连接池配置
+            self.http_pool_limit = plugin_config.get("http-pool-limit", 100)  # 每个连接池的最大连接数
+            self.http_pool_limit_per_host = plugin_config.get("http-pool-limit-per-host", 20)  # 每个主机的最大连接数
+            self.http_keepalive_timeout = plugin_config.get("http-keepalive-timeout", 30)  # 空闲连接保活时间（秒）
+            self.http_dns_cache_ttl = plugin_config.get("http-dns-cache-ttl", 300)  # DNS缓存时间（秒）
+            # 消息去重配置
+            self.dedup_max_size = plugin_config.get("dedup-max-size", 10000)  # 最多记录的已处理消息数
+            self.dedup_snapshot = plugin_config.get("dedup-snapshot", True)  # 是否保存去重快照，重启后继续去重
 
             # 加载所有智能体配置
             self.models = {}
-            for model_name, model_config in plugin_config.get("models", {}).items():
+            for model_id, (model_name, model_config) in enumerate(plugin_config.get("models", {}).items()):
+                # 配置了多个端点时在端点间负载均衡，否则使用 base-url 和 api-key
+                endpoints = [
+                    Endpoint(base_url=item["base-url"], api_key=item["api-key"], weight=item.get("weight", 1))
+                    for item in model_config.get("endpoints", []) if item.get("weight", 1) > 0
+                ] or [Endpoint(base_url=model_config["base-url"], api_key=model_config["api-key"])]
                 self.models[model_name] = ModelConfig(
-                    api_key=model_config["api-key"],
-                    base_url=model_config["base-url"],
+                    api_key=endpoints[0].api_key,
+                    base_url=endpoints[0].base_url,
                     trigger_words=model_config["trigger-words"],
                     # 如果有唤醒词配置则加载,否则使用空列表
                     wakeup_words=model_config.get("wakeup-words", []),
-                    description=model_config.get("description", [])
+                    description=model_config.get("description", []),
+                    max_concurrency=model_config.get("max-concurrency", 0),
+                    endpoints=endpoints,
+                    name=model_name,
+                    id=model_id
                 )
 
             # 加载所有群组配置
@@ -136,12 +185,113 @@ class DifyPlus(PluginBase):
             logger.error(f"加载DifyPlus插件配置文件失败: {e}")
             raise
 
+        # 存储已处理的消息ID，避免重复处理
+        self.processed_messages = TTLDedupStore(ttl=self.message_expiry, max_size=self.dedup_max_size)
+        self.dedup_snapshot_path = os.path.join(os.path.dirname(__file__), "processed_messages.json")
+        if self.dedup_snapshot:
+            restored = self.processed_messages.load(self.dedup_snapshot_path)
+            if restored:
+                logger.info(f"从快照恢复 {restored} 条已处理消息记录")
+
         self.db = XYBotDB()
-        self.image_cache = {}
-        self.image_cache_timeout = 120
-        # 添加文件缓存
-        self.file_cache = {}
-        self.file_cache_timeout = 300  # 5分钟文件缓存超时
+        # 会话ID缓存在内存中，新会话ID定期批量写回数据库，回复路径上不再访问数据库
+        self.conversations = ConversationCache(
+            self.db,
+            max_size=plugin_config.get("conversation-cache-size", 10000),
+            write_behind=plugin_config.get("conversation-write-behind", True)
+        )
+        # 插件生命周期内共享的HTTP连接池，按 base-url 和代理复用连接
+        self.http_pool = HttpClientPool(
+            limit=self.http_pool_limit,
+            limit_per_host=self.http_pool_limit_per_host,
+            keepalive_timeout=self.http_keepalive_timeout,
+            dns_cache_ttl=self.http_dns_cache_ttl
+        )
+        # 图片和文件共用一个按字节预算限制的LRU缓存，键为 ("image"/"file", wxid)
+        self.image_cache_timeout = plugin_config.get("image-cache-timeout", 120)
+        self.file_cache_timeout = plugin_config.get("file-cache-timeout", 300)  # 5分钟文件缓存超时
+        self.media_cache = MediaCache(
+            max_bytes=plugin_config.get("media-cache-max-mb", 256) * 1024 * 1024,
+            max_entry_bytes=plugin_config.get("media-cache-max-entry-mb", 50) * 1024 * 1024
+        )
+        # 已上传到Dify的文件，(智能体名称, 内容SHA-256) -> {"id": 文件ID, "type": 文件类型}
+        # 同一内容再次引用时直接复用文件ID，0表示不缓存
+        self.upload_cache_ttl = plugin_config.get("upload-cache-ttl", 3600)
+        self.upload_cache = TTLCache(ttl=self.upload_cache_ttl, max_size=plugin_config.get("upload-cache-max-size", 1000))
+        # 昵称和群成员列表缓存，并发查询同一对象只请求协议端一次，快过期时在后台刷新
+        self.nickname_cache = AsyncLoadingCache(ttl=plugin_config.get("nickname-cache-ttl", 3600))
+        self.member_cache = AsyncLoadingCache(ttl=plugin_config.get("member-cache-ttl", 600))
+        # 回复中的文件链接同时下载的最大数量
+        self.media_fetch_concurrency = max(1, plugin_config.get("media-fetch-concurrency", 4))
+        # 文本回复按会话排队限速发送，同一回复中相邻的短段落合并为一条消息
+        self.outbound = OutboundQueue(
+            rate=plugin_config.get("send-rate", 2),
+            max_length=plugin_config.get("send-coalesce-length", 2000)
+        )
+        # 文本回复发送前先写入发件箱，插件重启后继续发送未发送完的回复
+        self.outbox = None
+        self.outbox_replayed = False
+        if plugin_config.get("outbox", True):
+            self.outbox = Outbox(os.path.join(os.path.dirname(__file__), "outbox.db"),
+                                 retention=plugin_config.get("outbox-retention", 86400))
+        # 协议端附件并发分段下载
+        self.downloader = ChunkedDownloader(
+            self.http_pool,
+            chunk_size=plugin_config.get("download-chunk-kb", 64) * 1024,
+            window=plugin_config.get("download-window", 8),
+            retries=plugin_config.get("download-retries", 2)
+        )
+        # 语音转码，限制同时运行的ffmpeg进程数
+        self.transcoder = FfmpegTranscoder(
+            max_concurrency=plugin_config.get("ffmpeg-max-concurrency", 2),
+            timeout=plugin_config.get("ffmpeg-timeout", 60)
+        )
+        # 图片缩放和编码在独立进程池中执行，0表示使用线程
+        self.image_processor = ImageProcessor(workers=plugin_config.get("image-workers", 2))
+        # 同一会话（群聊或私聊对象）的Dify请求排队依次处理，不同会话并行
+        self.conversation_scheduler = ConversationScheduler(
+            supersede=plugin_config.get("cancel-superseded-request", False)
+        )
+        # Dify调用准入控制：全局并发上限和每个智能体独立的并发上限，超出时排队，排队已满或超时回复忙碌提示
+        model_max_concurrency = plugin_config.get("model-max-concurrency", 0)
+        self.admission = AdmissionController(
+            global_limit=plugin_config.get("max-concurrency", 0),
+            model_limits={name: cfg.max_concurrency or model_max_concurrency for name, cfg in self.models.items()},
+            max_queue=plugin_config.get("admission-queue-size", 100),
+            queue_timeout=plugin_config.get("admission-timeout", 30)
+        )
+        self.busy_reply = plugin_config.get("busy-reply", "当前请求较多，请稍后再试。")
+        # 按 base-url 跟踪Dify端点健康状态，连续失败时熔断，熔断期间请求直接回复服务不可用
+        self.endpoint_health = HealthTracker(
+            failure_threshold=plugin_config.get("circuit-failure-threshold", 5),
+            error_rate_threshold=plugin_config.get("circuit-error-rate", 0.5),
+            open_seconds=plugin_config.get("circuit-open-seconds", 30)
+        )
+        # 智能体配置了多个端点时按进行中请求数或延迟选择端点，已有会话使用与会话ID一起保存的端点
+        self.endpoint_balancer = EndpointBalancer(
+            self.endpoint_health,
+            strategy=plugin_config.get("endpoint-strategy", "least-outstanding")
+        )
+        # 对话请求的连接超时和两次数据之间的读取超时，服务异常时尽快失败而不是等待整体超时
+        self.dify_timeout = aiohttp.ClientTimeout(
+            total=None,
+            sock_connect=plugin_config.get("dify-connect-timeout", 10),
+            sock_read=plugin_config.get("dify-read-timeout", 120)
+        )
+        # 对话、上传、语音转换共用的重试策略：只重试限流、网关错误和连接失败，次数和总时间都有上限
+        self.retry_policy = RetryPolicy(
+            max_attempts=plugin_config.get("retry-max-attempts", 3),
+            base_delay=plugin_config.get("retry-base-delay", 0.5),
+            max_delay=plugin_config.get("retry-max-delay", 8),
+            deadline=plugin_config.get("retry-deadline", 60),
+            retry_statuses=plugin_config.get("retry-statuses", [429, 502, 503, 504])
+        )
+        # 机器人状态文件，按修改时间判断是否需要重新读取
+        plugins_dir = Path(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+        self.bot_status_files = [
+            JsonFileCache(str(plugins_dir / "../bot_status.json")),
+            JsonFileCache(str(plugins_dir / "../admin/bot_status.json"))
+        ]
         # 添加文件存储目录配置
         self.files_dir = "files"
         # 创建文件存储目录
@@ -164,8 +314,7 @@ class DifyPlus(PluginBase):
         # 如果有重复唤醒词，记录日志但不覆盖
         for wakeup_word, models in self.wakeup_word_to_models.items():
             if len(models) > 1:
-                model_names = [next((name for name, config in self.models.items()
-                                     if config == model), '未知') for model in models]
+                model_names = [model.name for model in models]
                 logger.warning(f"唤醒词 '{wakeup_word}' 被多个智能体共享: {', '.join(model_names)}")
         logger.info(f"唤醒词映射完成，共加载 {len(self.wakeup_word_to_models)} 个唤醒词")
 
@@ -186,6 +335,15 @@ class DifyPlus(PluginBase):
                     logger.info(f"群聊：'{group_name}({group_id})' 添加到群组配置 '{groups_name}' 的群聊列表")
         logger.info(f"群聊加载完成，共加载 {len(self.groupid_to_groupsconfig)} 个群聊")
 
+        # 构建触发词/唤醒词路由索引
+        self.router = ModelRouter(
+            self.models,
+            {group_id: groups_config.models for group_id, groups_config in self.groupid_to_groupsconfig.items()}
+        )
+
+        # 编译@机器人检测
+        self.mention_matcher = MentionMatcher(self.robot_names)
+
         # 加载配置文件
         self.config_path = os.path.join(os.path.dirname(__file__), "config.toml")
         logger.info(f"加载DifyPlus插件配置文件：{self.config_path}")
@@ -207,6 +365,80 @@ class DifyPlus(PluginBase):
                 logger.error(f"获取API代理实例失败: {e}")
                 logger.error(traceback.format_exc())
 
+    async def on_enable(self, bot=None):
+        """插件启用时继续发送发件箱中未发送完的回复"""
+        await super().on_enable(bot)
+        if self.outbox and bot and not self.outbox_replayed:
+            asyncio.create_task(self.replay_outbox(bot))
+
+    async def on_disable(self):
+        """插件卸载时释放共享资源"""
+        await super().on_disable()
+        self.save_dedup_snapshot()
+        flushed = self.conversations.flush()
+        if flushed:
+            logger.info(f"已写回 {flushed} 个会话ID")
+        await self.http_pool.close()
+        self.image_processor.shutdown()
+        if self.outbox:
+            self.outbox.close()
+        self.user_group_manager.flush()
+        self.user_group_manager.close()
+
+    @schedule('interval', seconds=30)
+    async def dedup_snapshot_job(self, bot: WechatAPIClient):
+        """定期保存消息去重快照"""
+        self.save_dedup_snapshot()
+
+    @schedule('interval', seconds=5)
+    async def conversation_flush_job(self, bot: WechatAPIClient):
+        """定期批量写回新的会话ID和用户群组默认智能体"""
+        flushed = await self.conversations.flush_async()
+        if flushed:
+            logger.debug(f"已写回 {flushed} 个会话ID: {self.conversations.stats()}")
+        flushed = await self.user_group_manager.flush_async()
+        if flushed:
+            logger.debug(f"已写回 {flushed} 个用户的群组默认智能体")
+
+    @schedule('interval', seconds=60)
+    async def outbox_job(self, bot: WechatAPIClient):
+        """启用时没有拿到bot实例则在这里继续发送发件箱，并定期删除过期的已完成记录"""
+        if not self.outbox:
+            return
+        if not self.outbox_replayed:
+            await self.replay_outbox(bot)
+        try:
+            removed = await self.outbox.purge()
+            if removed:
+                logger.debug(f"已删除 {removed} 条过期发件箱记录")
+        except Exception as e:
+            logger.error(f"清理发件箱失败: {e}")
+
+    @schedule('interval', hours=6)
+    async def user_group_compact_job(self, bot: WechatAPIClient):
+        """定期整理用户群组默认智能体数据库"""
+        try:
+            await self.user_group_manager.compact()
+        except Exception as e:
+            logger.error(f"整理用户群组默认智能体数据库失败: {e}")
+
+    @schedule('interval', seconds=60)
+    async def media_cache_sweep_job(self, bot: WechatAPIClient):
+        """定期清理过期的图片和文件缓存"""
+        removed = self.media_cache.sweep()
+        if removed:
+            logger.debug(f"已清理 {removed} 条过期媒体缓存: {self.media_cache.stats()}")
+
+    def save_dedup_snapshot(self):
+        """保存消息去重快照"""
+        if not self.dedup_snapshot:
+            return
+        try:
+            self.processed_messages.save(self.dedup_snapshot_path)
+            logger.debug(f"已保存消息去重快照: {self.processed_messages.stats()}")
+        except Exception as e:
+            logger.error(f"保存消息去重快照失败: {e}")
+
     def get_user_model(self, user_id: str) -> ModelConfig:
         """获取用户当前使用的智能体"""
         if self.remember_user_model and user_id in self.user_models:
@@ -218,34 +450,25 @@ class DifyPlus(PluginBase):
         if self.remember_user_model:
             self.user_models[user_id] = model
 
-    def get_user_group_model(self, user_id: str, group_id: str) -> ModelConfig:
+    async def get_user_group_model(self, user_id: str, group_id: str) -> ModelConfig:
         """获取用户群聊默认智能体"""
         if self.remember_user_model:
-            model_config = self.user_group_manager.get_user_group_model(user_id, group_id)
+            model_config = await self.user_group_manager.get_user_group_model(user_id, group_id)
             if model_config is None:
                 return self.get_group_default_model(group_id)
             else:
                 return model_config
         return self.get_group_default_model(group_id)
 
-    def set_user_group_model(self, user_id: str, group_id: str, model: ModelConfig):
+    async def set_user_group_model(self, user_id: str, group_id: str, model: ModelConfig):
         """设置用户群聊默认智能体"""
         if self.remember_user_model:
-            self.user_group_manager.set_user_group_model(user_id, group_id, model)
+            await self.user_group_manager.set_user_group_model(user_id, group_id, model)
 
     # 辅助函数：检查智能体是否可用于当前群组
     def is_model_allowed(self, group_id, model_config: ModelConfig) -> bool:
-        # 私聊不受限制
-        if group_id is None:
-            return True
-
-        groups_config = self.groupid_to_groupsconfig.get(group_id, None)
-        if not groups_config:
-            return False
-        for model_name in groups_config.models:
-            if self.models[model_name] == model_config:
-                return True
-        return False
+        # 私聊不受限制，群聊查询预先计算的群聊可用智能体集合
+        return self.router.is_allowed(group_id, model_config.name)
 
     # 辅助函数：获取群聊默认智能体（群组配置智能体的第一个）
     def get_group_default_model(self, group_id) -> ModelConfig | None:
@@ -264,33 +487,23 @@ class DifyPlus(PluginBase):
 
     def is_message_processed(self, message: dict) -> bool:
         """检查消息是否已经处理过"""
-        # 清理过期的消息记录
-        current_time = time.time()
-        expired_keys = []
-        for msg_id, timestamp in self.processed_messages.items():
-            if current_time - timestamp > self.message_expiry:
-                expired_keys.append(msg_id)
-
-        for key in expired_keys:
-            del self.processed_messages[key]
-
         # 获取消息ID
         msg_id = message.get("MsgId") or message.get("NewMsgId")
         if not msg_id:
             return False  # 如果没有消息ID，视为未处理过
 
-        # 检查消息是否已处理
-        return msg_id in self.processed_messages
+        # 检查消息是否已处理（过期记录在查询时均摊清理）
+        return self.processed_messages.contains(msg_id)
 
     def mark_message_processed(self, message: dict):
         """标记消息为已处理"""
         msg_id = message.get("MsgId") or message.get("NewMsgId")
         if msg_id:
-            self.processed_messages[msg_id] = time.time()
+            self.processed_messages.add(msg_id)
             logger.debug(f"标记消息 {msg_id} 为已处理")
 
     # 根据消息内容和群组ID判断使用哪个智能体
-    def get_model_from_message(self, content: str, user_id: str, group_id: str = None):
+    async def get_model_from_message(self, content: str, user_id: str, group_id: str = None):
         #    -> tuple[ModelConfig, str, bool, bool] | \
         #       tuple[None, str, bool, bool] | \
         #       tuple[Any, str, bool, bool]:
@@ -311,83 +524,55 @@ class DifyPlus(PluginBase):
             情况4： 未唤醒内容   （内容返回，返回默认智能体，不唤醒，后续处       model为默认，切换FALSE，唤醒FALSE）
             情况5： 没有可用的智能体（内容返回                               model为None，切换FALSE，唤醒FALSE）
         """
-        original_content = content  # 保留原始内容
-        content = content.lower()  # 只在检测时使用小写版本
-
-        # 1. 检查是否是切换智能体的命令
-        if content.endswith("切换"):
-            for model_name, model_config in self.models.items():
-                for trigger in model_config.trigger_words:
-                    if content.startswith(trigger.lower()):
-                        if not self.is_model_allowed(group_id, model_config):
-                            continue  # 群组无权限使用此智能体
-                        if group_id is None:
-                            self.set_user_model(user_id, model_config)
-                        else:
-                            self.set_user_group_model(user_id, group_id, model_config)
-                        logger.info(f"用户 {user_id} 群组{group_id} 切换智能体到 {model_name}")
-                        return model_config, original_content, True, False
-            # 没有找到可用的切换目标智能体, 可能是非切换命令
-            logger.warning(f"用户: {user_id} 群组: {group_id} 尝试切换智能体，但没有该可用智能体，继续检查是否有唤醒词")
-            # return None, original_content, True, False
-
-        # 2. 检查是否使用了唤醒词
-        logger.debug(f"检查是否包含唤醒词 '{content}' ")
-        for wakeup_word, model_configs in self.wakeup_word_to_models.items():
-            wakeup_lower = wakeup_word.lower()
-            content_lower = content.lower()
-            if content_lower.startswith(wakeup_lower) or f" {wakeup_lower}" in content_lower:
-                # 过滤出当前群组可用的智能体
-                available_models = [
-                    config for config in model_configs
-                    if self.is_model_allowed(group_id, config)
-                ]
-                if not available_models:
-                    continue  # 没有可用智能体
-                # 如果有多个可用智能体，使用第一个（或可以添加优先级逻辑）
-                model_config = available_models[0]
-                model_name = next((name for name, config in self.models.items()
-                                   if config == model_config), '未知')
-                logger.info(f"消息中检测到唤醒词 '{wakeup_word}'，使用智能体 '{model_name}'")
-                # 精确替换唤醒词（保持原逻辑）
-                original_wakeup = None
-                if content_lower.startswith(wakeup_lower):
-                    original_wakeup = original_content[:len(wakeup_lower)]
+        # 1~3. 切换命令、唤醒词、触发词，由预编译的路由索引一次扫描完成
+        route = self.router.route(content, group_id)
+        if route:
+            model_config = self.models[route.model_name]
+            if route.is_switch:
+                if group_id is None:
+                    self.set_user_model(user_id, model_config)
                 else:
-                    wakeup_pos = content_lower.find(f" {wakeup_lower}") + 1
-                    if wakeup_pos > 0:
-                        original_wakeup = original_content[wakeup_pos:wakeup_pos + len(wakeup_lower)]
-                if original_wakeup:
-                    query = original_content.replace(original_wakeup, "", 1).strip()
-                    logger.debug(f"唤醒词处理后的查询: '{query}'")
-                    return model_config, query, False, True
-
-        # 3. 使用了触发词，但不是切换的，类似唤醒词触发
-        logger.debug(f"检查是否包含触发词: '{content}'")
-        for model_name, model_config in self.models.items():
-            for trigger in model_config.trigger_words:
-                if trigger.lower() in content:
-                    if not self.is_model_allowed(group_id, model_config):
-                        continue  # 群组无权限使用此智能体
-                    logger.info(f"消息中包含触发词 '{trigger}'，使用智能体 '{model_name}'")
-                    query = original_content.replace(trigger, "", 1).strip()
-                    logger.debug(f"触发词处理后的查询: '{query}'")
-                    return model_config, query, False, True
+                    await self.set_user_group_model(user_id, group_id, model_config)
+                logger.info(f"用户 {user_id} 群组{group_id} 切换智能体到 {route.model_name}")
+                return model_config, content, True, False
+            logger.info(f"消息中检测到 '{route.word}'，使用智能体 '{route.model_name}'")
+            logger.debug(f"处理后的查询: '{route.query}'")
+            return model_config, route.query, False, True
 
         # 4. 使用用户当前的智能体，但要检查群组权限
         if group_id is None:
             current_model = self.get_user_model(user_id)
         else:
-            current_model = self.get_user_group_model(user_id, group_id)
+            current_model = await self.get_user_group_model(user_id, group_id)
         if current_model and self.is_model_allowed(group_id, current_model):
-            model_name = next((name for name, config in self.models.items() if config == current_model), '默认')
+            model_name = current_model.name
             logger.debug(f"未检测到特定智能体，使用用户 {user_id} 当前默认智能体 '{model_name}'")
-            return current_model, original_content, False, False
+            return current_model, content, False, False
 
         # 5. 没有可用智能体的情况
         logger.warning(f"用户 {user_id} 在群组 {group_id} 没有可用智能体")
-        return None, original_content, False, False
+        return None, content, False, False
+
 
+    async def conversation_endpoint(self, model: ModelConfig, conversation_key: str) -> Optional[str]:
+        """返回已有会话所在端点的 base_url，没有会话时返回 None"""
+        conversation_id, base_url = await self.conversations.get_with_endpoint(conversation_key)
+        if conversation_id and base_url is None:
+            # 旧版本保存的会话ID没有端点，当时智能体只有 base-url 一个端点
+            base_url = model.endpoints[0].base_url
+        return base_url
+
+    async def select_endpoint(self, model: ModelConfig, conversation_key: str = None) -> Endpoint:
+        """选择智能体本次请求使用的Dify端点，已有会话时使用创建会话的端点
+
+        会话所在端点熔断而换到其他端点时先清空会话，由新端点创建新会话，不会把会话ID发给不认识它的端点
+        """
+        bound = await self.conversation_endpoint(model, conversation_key) if conversation_key else None
+        endpoint = self.endpoint_balancer.select(model.name, model.endpoints, bound)
+        if bound is not None and endpoint.base_url != bound:
+            logger.warning(f"{conversation_key} 的会话所在端点 {bound} 不可用，清空会话后使用 {endpoint.base_url}")
+            self.conversations.reset(conversation_key)
+        return endpoint
 
     async def reset_conversation(self, bot: WechatAPIClient, message: dict, model_config=None):
         """重置与Dify的对话
@@ -414,7 +599,7 @@ class DifyPlus(PluginBase):
                 user_id = message["SenderWxid"]
 
             # 从数据库获取会话ID
-            conversation_id = self.db.get_llm_thread_id(user_id, "dify")
+            conversation_id = await self.conversations.get(user_id)
 
             if not conversation_id:
                 logger.info(f"用户 {user_id} 没有活跃的对话，无需重置")
@@ -422,20 +607,23 @@ class DifyPlus(PluginBase):
 
             logger.info(f"准备重置用户 {user_id} 的对话，会话ID: {conversation_id}")
 
-            # 构建API请求
-            url = f"{model.base_url}/conversations/{conversation_id}"
-            headers = {"Authorization": f"Bearer {model.api_key}", "Content-Type": "application/json"}
+            # 构建API请求，会话只存在于创建它的端点上，不切换端点
+            bound = await self.conversation_endpoint(model, user_id)
+            endpoint = next((endpoint for endpoint in model.endpoints if endpoint.base_url == bound),
+                            model.endpoints[0])
+            url = f"{endpoint.base_url}/conversations/{conversation_id}"
+            headers = {"Authorization": f"Bearer {endpoint.api_key}", "Content-Type": "application/json"}
             data = {"user": user_id}
 
             # 发送DELETE请求
-            async with aiohttp.ClientSession() as session:
-                # 正确的方式是在请求时设置代理，而不是在创建会话时
-                proxy = self.http_proxy if self.http_proxy and self.http_proxy.strip() else None
+            # 正确的方式是在请求时设置代理，而不是在创建会话时
+            proxy = self.http_proxy if self.http_proxy and self.http_proxy.strip() else None
+            async with self.http_pool.session(endpoint.base_url, proxy) as session:
                 async with session.delete(url, headers=headers, json=data, proxy=proxy) as resp:
                     if resp.status in (200, 201, 204):
                         if resp.ok:
                             # 重置成功，清除数据库中的会话ID
-                            self.db.save_llm_thread_id(user_id, "", "dify")
+                            self.conversations.reset(user_id)
                             logger.success(f"成功重置用户 {user_id} 的对话")
                             return True
                         else:
@@ -465,7 +653,7 @@ class DifyPlus(PluginBase):
                         await bot.send_at_message(group_id, self.groupid_to_groupsconfig[group_id].command_tip,
                                                   [user_wxid])
                     if command == '/重置会话':
-                        model = self.get_user_group_model(user_wxid, group_id)
+                        model = await self.get_user_group_model(user_wxid, group_id)
                         # 执行重置对话操作
                         success = await self.reset_conversation(bot, message, model)
                         if success:
@@ -496,8 +684,7 @@ class DifyPlus(PluginBase):
                         final_output = ""
                         for i, line in enumerate(output_lines, 1):
                             final_output += f"{i}. {line}\n"
-                        default_model = next(name for name, config in self.models.items()
-                                             if config == self.get_user_group_model(user_wxid, group_id))
+                        default_model = (await self.get_user_group_model(user_wxid, group_id)).name
                         final_output += f"输入相应智能体的'触发词 切换'可以切换默认智能体。\n\n"
                         final_output += f"您在当前群默认的智能体：\n[{default_model}]\n"
                         await bot.send_at_message(group_id, final_output, [user_wxid])
@@ -536,8 +723,7 @@ class DifyPlus(PluginBase):
                         final_output = ""
                         for i, line in enumerate(output_lines, 1):
                             final_output += f"{i}. {line}\n"
-                        default_model = next(name for name, config in self.models.items()
-                                             if config == self.get_user_model(message["FromWxid"]))
+                        default_model = self.get_user_model(message["FromWxid"]).name
                         final_output += f"输入相应智能体的'触发词 切换'可以切换默认智能体。\n\n"
                         final_output += f"您当前默认的智能体：\n[{default_model}]\n"
                         await bot.send_text_message(message["FromWxid"], final_output)
@@ -554,58 +740,17 @@ class DifyPlus(PluginBase):
         if content is None:
             content = message["Content"].strip()
 
-        bot_status = self.get_bot_status()
+        bot_status = self.bot_status
         bot_wxid = None
         bot_nickname = None
         if bot_status and bot_status['status'] == 'ready':
             bot_wxid = bot_status['wxid']
             if bot_wxid and bot:
-                bot_nickname = await bot.get_nickname(bot_wxid)
+                bot_nickname = await self.get_nickname(bot, bot_wxid)
                 logger.debug(f"获取到bot的昵称：{bot_nickname}")
 
-        is_at = self.is_at_message(message, bot_wxid, bot_nickname)
-
+        is_at, query = self.mention_matcher.match(message, content, bot_wxid, bot_nickname)
         if is_at:
-            query = content
-            if content.startswith('@'):
-                # 先检查是否是@机器人
-                at_bot_prefix = None
-                for robot_name in self.robot_names:
-                    if content.startswith(f'@{robot_name}'):
-                        at_bot_prefix = f'@{robot_name}'
-                        break
-
-                # 是不是@了bot的nickname
-                if not at_bot_prefix and bot_nickname:
-                    at_bot_prefix = f'@{bot_nickname}'
-
-                if at_bot_prefix:
-                    # 如果是@机器人，移除@机器人部分
-                    query = content[len(at_bot_prefix):].strip()
-                    logger.debug(f"移除@{at_bot_prefix}后的查询内容: {query}")
-                else:
-                    # 如果不是@机器人，则尝试找空格
-                    space_index = content.find(' ')
-                    if space_index > 0:
-                        # 只保留空格后面的内容
-                        query = content[space_index + 1:].strip()
-                        logger.debug(f"移除@前缀后的查询内容: {query}")
-                    else:
-                        # 如果没有空格，尝试提取@后面的内容
-                        # 找到第一个非空格字符的位置
-                        for i in range(1, len(content)):
-                            if content[i] != '@' and content[i] != ' ':
-                                query = content[i:].strip()
-                                logger.debug(f"提取@后面的内容: {query}")
-                                break
-                        else:
-                            # 如果整个内容都是@，将query设为空
-                            query = ""
-            else:
-                # 如果不是以@开头，则尝试移除@机器人名称
-                for robot_name in self.robot_names:
-                    query = query.replace(f"@{robot_name}", "").strip()
-
             logger.debug(f"@提取到的 query: {query}")
             return True, query
         return False, content
@@ -679,6 +824,8 @@ class DifyPlus(PluginBase):
                         logger.error("引用图片上传失败")
                 else:
                     logger.warning(f"未找到MD5为 {image_md5} 的图片")
+            except AdmissionRejected:
+                raise
             except Exception as e:
                 logger.error(f"处理引用图片失败: {e}")
 
@@ -728,6 +875,8 @@ class DifyPlus(PluginBase):
                         logger.error("引用文件上传失败")
                 else:
                     logger.warning(f"未找到MD5为 {filename_md5} 的文件")
+            except AdmissionRejected:
+                raise
             except Exception as e:
                 logger.error(f"处理引用文件失败: {e}")
 
@@ -752,6 +901,8 @@ class DifyPlus(PluginBase):
                     else:
                         logger.error("图片上传失败")
                         return files
+                except AdmissionRejected:
+                    raise
                 except Exception as e:
                     logger.error(f"处理图片失败: {e}")
                     return files
@@ -773,7 +924,7 @@ class DifyPlus(PluginBase):
         user_wxid = message["SenderWxid"]
 
         # 检查该群聊是否有对应的智能体，是否有唤醒词或触发词，是否是切换模型命令
-        wakeup_model, processed_wakeup_query, is_switch, wakeup_detected = self.get_model_from_message(
+        wakeup_model, processed_wakeup_query, is_switch, wakeup_detected = await self.get_model_from_message(
             content,
             user_wxid,
             group_id
@@ -787,7 +938,7 @@ class DifyPlus(PluginBase):
         # 如果是切换命令，切换
         if is_switch:
             if wakeup_model:
-                model_name = next(name for name, config in self.models.items() if config == wakeup_model)
+                model_name = wakeup_model.name
                 await bot.send_at_message(
                     group_id,
                     f"\n已切换到{model_name}智能体，将一直使用该智能体直到下次切换。",
@@ -801,7 +952,11 @@ class DifyPlus(PluginBase):
             return False
 
         # 检查是否有最近的图片 - 无论聊天室功能是否启用都获取图片
-        files = await self.file_message_process(bot, message, wakeup_model, image_md5, filename_md5)
+        try:
+            files = await self.file_message_process(bot, message, wakeup_model, image_md5, filename_md5)
+        except AdmissionRejected as e:
+            await self.reply_busy(bot, message, e)
+            return False
 
         # 如果检测到唤醒（唤醒词或触发词），处理唤醒请求
         if wakeup_detected and wakeup_model and processed_wakeup_query:
@@ -809,7 +964,7 @@ class DifyPlus(PluginBase):
                 logger.info(f"唤醒对应智能体处理请求")
                 await self.dify(bot, message, processed_wakeup_query, files=files, specific_model=wakeup_model)
             else:
-                model_name = next((name for name, config in self.models.items() if config == wakeup_model), '未知')
+                model_name = wakeup_model.name
                 logger.error(f"唤醒对应智能体 '{model_name}' 的API密钥未配置")
                 await bot.send_at_message(group_id, f"\n此智能体API密钥未配置，请联系管理员", [user_wxid])
             return False
@@ -838,7 +993,7 @@ class DifyPlus(PluginBase):
             content = message["Content"].strip()
 
         # 先检查唤醒词或触发词，获取对应智能体
-        model, processed_query, is_switch, wakeup_detected = self.get_model_from_message(
+        model, processed_query, is_switch, wakeup_detected = await self.get_model_from_message(
             content,
             message["FromWxid"],
             None
@@ -852,7 +1007,7 @@ class DifyPlus(PluginBase):
         # 如果是切换命令，切换
         if is_switch:
             if model:
-                model_name = next(name for name, config in self.models.items() if config == model)
+                model_name = model.name
                 await bot.send_text_message(
                     message["FromWxid"],
                     f"已切换到{model_name.upper()}智能体，将一直使用该智能体直到下次切换。"
@@ -865,14 +1020,18 @@ class DifyPlus(PluginBase):
             return False
 
         # 检查是否有最近的图片
-        files = await self.file_message_process(bot, message, model, image_md5, filename_md5)
+        try:
+            files = await self.file_message_process(bot, message, model, image_md5, filename_md5)
+        except AdmissionRejected as e:
+            await self.reply_busy(bot, message, e)
+            return False
 
         if wakeup_detected and model and processed_query:
             if model.api_key:  # 检查唤醒词对应智能体的API密钥
                 logger.info(f"使用唤醒对应智能体处理请求")
                 await self.dify(bot, message, processed_query, files=files, specific_model=model)
             else:
-                model_name = next((name for name, config in self.models.items() if config == model), '未知')
+                model_name = model.name
                 logger.error(f"唤醒对应智能体 '{model_name}' 的API密钥未配置")
                 await bot.send_message(message["FromWxid"], f"\n此智能体API密钥未配置，请联系管理员")
             return False
@@ -1019,7 +1178,11 @@ class DifyPlus(PluginBase):
             await bot.send_text_message(message["FromWxid"], "你还没配置Dify API密钥！")
             return False
 
-        query = await self.audio_to_text(bot, message)
+        try:
+            query = await self.audio_to_text(bot, message)
+        except AdmissionRejected as e:
+            await self.reply_busy(bot, message, e)
+            return False
         if not query:
             await bot.send_text_message(message["FromWxid"], VOICE_TRANSCRIPTION_FAILED)
             return False
@@ -1029,216 +1192,119 @@ class DifyPlus(PluginBase):
         logger.info(f'<<<[handle_voice] return:{ret}')
         return ret
 
-    def get_bot_status(self):
-        """获取机器人状态"""
-        status_file = Path(os.path.dirname(os.path.dirname(os.path.abspath(__file__)))) / "../bot_status.json"
-        admin_status_file = Path(
-            os.path.dirname(os.path.dirname(os.path.abspath(__file__)))) / "../admin/bot_status.json"
-        if status_file.exists():
-            try:
-                with open(status_file, "r", encoding="utf-8") as f:
-                    return json.load(f)
-            except Exception as e:
-                logger.error(f"读取状态文件失败: {e}")
-        if admin_status_file.exists():
-            try:
-                with open(admin_status_file, "r", encoding="utf-8") as f:
-                    return json.load(f)
-            except Exception as e:
-                logger.error(f"读取状态文件失败: {e}")
-        # 无法获取状态
-        return None
+    async def get_nickname(self, bot: WechatAPIClient, wxid: str) -> Optional[str]:
+        """获取昵称（带缓存），获取失败返回 None"""
 
-    def is_at_message(self, message: dict, bot_wxid=None, bot_nickname=None) -> bool:
-        """检查消息是否@了机器人
+        async def load():
+            return await bot.get_nickname(wxid) or None
 
-        支持检测普通消息和引用消息中的@
-        """
-        if not message["IsGroup"]:
-            return False
+        return await self.nickname_cache.get(wxid, load)
 
-        # 获取消息内容
-        content = message["Content"]
-
-        # 记录原始消息信息便于调试
-        logger.debug(f"检查消息是否@机器人: {content[:50]}...")
-
-        # 检查消息类型
-        msg_type = message.get("MsgType")
-        logger.debug(f"消息类型: {msg_type}, 是否有Quote字段: {'Quote' in message}")
-
-        # 增强对XML引用消息的处理
-        if "Quote" in message:
-            logger.info(f"详细检查引用消息是否@机器人: {content[:50]}...")
-
-            # 直接检查消息内容中是否包含@机器人
-            for robot_name in self.robot_names:
-                # 检查格式: "@小球子 xxx"
-                if f"@{robot_name}" in content:
-                    logger.info(f"在引用消息内容中发现@{robot_name}")
-                    return True
-
-                # 检查格式: "@小球子"（消息开头）
-                if content.startswith(f'@{robot_name}'):
-                    logger.info(f"引用消息内容以@{robot_name}开头")
-                    return True
-
-                # 特殊处理：检查是否是@小球子这样的格式（忽略大小写）
-                if content.lower().startswith(f'@{robot_name.lower()}'):
-                    logger.info(f"引用消息内容以@{robot_name}开头（忽略大小写）")
-                    return True
-
-                # 检查格式: "@小球子"（消息中间）
-                at_pattern = re.compile(f'@{robot_name}\\b')
-                if at_pattern.search(content):
-                    logger.info(f"在引用消息内容中发现@{robot_name}（正则匹配）")
-                    return True
-
-            # 检查消息内容是否以@开头，后面跟着空格和其他内容
-            if content.startswith('@'):
-                # 提取@后面的名称部分
-                space_index = content.find(' ')
-                if space_index > 0:
-                    at_name = content[1:space_index].strip()
-                    logger.info(f"提取到@名称: {at_name}")
-
-                    # 检查提取的名称是否是机器人名称
-                    for robot_name in self.robot_names:
-                        if at_name == robot_name or at_name.lower() == robot_name.lower():
-                            logger.info(f"@名称匹配机器人名称: {robot_name}")
-                            return True
+    async def get_chatroom_members(self, bot: WechatAPIClient, group_id: str) -> list:
+        """获取群成员列表（带缓存）"""
 
-                        # 检查名称是否部分匹配（例如@小球 可能是@小球子的简写）
-                        if robot_name.startswith(at_name) or robot_name.lower().startswith(at_name.lower()):
-                            logger.info(f"@名称部分匹配机器人名称: {at_name} -> {robot_name}")
-                            return True
+        async def load():
+            return await bot.get_chatroom_member_list(group_id) or None
 
-        # 如果消息内容以@开头，这是一个强烈的信号，表明用户@了某人
-        if content.startswith('@'):
-            logger.debug(f"消息内容以@开头: {content[:20]}")
-            # 检查@的是否是机器人
-            for robot_name in self.robot_names:
-                if content.startswith(f'@{robot_name}'):
-                    logger.debug(f"消息内容以@{robot_name}开头")
-                    return True
-
-                # 特殊处理：检查是否是@小小x这样的格式（可能有空格）
-                if content.lower().startswith(f'@{robot_name.lower()}'):
-                    logger.debug(f"消息内容以@{robot_name}开头（忽略大小写）")
-                    return True
-            # 如果@的不是机器人，继续检查其他条件
-
-        # 检查普通消息中的@
-        for robot_name in self.robot_names:
-            if f"@{robot_name}" in content:
-                logger.debug(f"在消息内容中发现@{robot_name}")
-                return True
+        return await self.member_cache.get(group_id, load) or []
 
-        # 如果是引用消息，检查消息类型
-        if msg_type == 49 or msg_type == 57 or "Quote" in message:  # 引用消息类型
-            logger.debug(f"检测到引用消息: {msg_type}, Quote字段: {'Quote' in message}")
-
-            # 特殊处理：如果消息内容以@开头，这是一个强烈的信号，表明用户@了某人
-            if content.startswith('@'):
-                for robot_name in self.robot_names:
-                    if content.startswith(f'@{robot_name}'):
-                        logger.debug(f"引用消息内容以@{robot_name}开头")
-                        return True
-
-                    # 特殊处理：检查是否是@小小x这样的格式（可能有空格）
-                    if content.lower().startswith(f'@{robot_name.lower()}'):
-                        logger.debug(f"引用消息内容以@{robot_name}开头（忽略大小写）")
-                        return True
-
-            # 如果有Quote字段，检查引用的消息内容
-            if "Quote" in message:
-                quote_info = message.get("Quote", {})
-                quote_from = quote_info.get("Nickname", "")
-
-                # 检查被引用的消息是否来自机器人
-                for robot_name in self.robot_names:
-                    if robot_name == quote_from:
-                        logger.debug(f"引用了机器人 '{robot_name}' 的消息")
-                        return True
-
-                # 检查引用消息的内容中是否有@机器人
-                quote_content = quote_info.get("Content", "")
-                for robot_name in self.robot_names:
-                    if f"@{robot_name}" in quote_content:
-                        logger.debug(f"在引用的消息内容中发现@{robot_name}")
-                        return True
-
-            # 如果有OriginalContent，尝试解析XML
-            if "OriginalContent" in message:
-                try:
-                    root = ET.fromstring(message.get("OriginalContent", ""))
-                    title = root.find("appmsg/title")
-                    if title is not None and title.text:
-                        # 检查引用消息的标题中是否包含@机器人
-                        for robot_name in self.robot_names:
-                            if f"@{robot_name}" in title.text:
-                                logger.debug(f"在引用消息标题中发现@{robot_name}")
-                                return True
-                except Exception as e:
-                    logger.debug(f"解析引用消息 XML 失败: {e}")
-
-            # 特殊处理：如果消息内容中包含机器人名称（不带@符号）
-            for robot_name in self.robot_names:
-                if robot_name in content:
-                    logger.debug(f"在引用消息内容中发现机器人名称: {robot_name}")
-                    return True
-
-        # 检查消息的Ats字段，这是一个直接的@标记
-        if "Ats" in message and message["Ats"] and bot_wxid:
-            logger.debug(f"消息包含Ats字段: {message['Ats']}")
-            # 如果机器人的wxid在Ats列表中，则返回True
-            if bot_wxid in message["Ats"]:
-                logger.debug(f"在Ats字段中发现机器人的wxid: {bot_wxid}")
-                return True
+    @property
+    def bot_status(self) -> Optional[dict]:
+        """机器人状态，优先读取 bot_status.json，其次 admin/bot_status.json，文件变化时才重新读取"""
+        for status_file in self.bot_status_files:
+            status = status_file.get()
+            if status is not None:
+                return status
+        # 无法获取状态
+        return None
 
-        if bot_wxid and bot_nickname:
-            if f"@{bot_nickname}" in content:
-                logger.debug(f"在消息中发现@了bot的NickName: @{bot_nickname}")
-                return True
+    def get_bot_status(self):
+        """获取机器人状态"""
+        return self.bot_status
 
-        return False
+    def is_at_message(self, message: dict, bot_wxid=None, bot_nickname=None) -> bool:
+        """检查消息是否@了机器人
+
+        支持检测普通消息和引用消息中的@，见 MentionMatcher.is_at()
+        """
+        return self.mention_matcher.is_at(message, bot_wxid, bot_nickname)
 
     async def dify(self, bot: WechatAPIClient, message: dict, query: str, files=None, specific_model=None):
-        """发送消息到Dify API"""
-        if files is None:
-            files = []
+        """发送消息到Dify API，同一会话的请求排队依次处理"""
+        return await self.conversation_scheduler.run(message["FromWxid"], message["SenderWxid"], self.dify_admitted,
+                                                     bot, message, query, files=files, specific_model=specific_model)
 
+    async def dify_admitted(self, bot: WechatAPIClient, message: dict, query: str, files=None, specific_model=None):
+        """确定智能体并取得它的执行名额后调用Dify，名额不足时回复忙碌提示"""
+        model, processed_query = await self.route_request(bot, message, query, specific_model)
+        if model is None:
+            return
+        try:
+            async with self.admission.slot(model.name):
+                return await self.dify_request(bot, message, processed_query, model, files=files)
+        except AdmissionRejected as e:
+            await self.reply_busy(bot, message, e)
+
+    async def reply_busy(self, bot: WechatAPIClient, message: dict, error: AdmissionRejected):
+        """智能体执行名额不足时回复忙碌提示"""
+        logger.warning(f"Dify请求被拒绝: {error}, 当前状态: {self.admission.stats()}")
+        if message["IsGroup"]:
+            await bot.send_at_message(message["FromWxid"], f"\n{self.busy_reply}", [message["SenderWxid"]])
+        else:
+            await bot.send_text_message(message["FromWxid"], self.busy_reply)
+
+    async def route_request(self, bot: WechatAPIClient, message: dict, query: str,
+                            specific_model=None) -> tuple[Optional[ModelConfig], str]:
+        """
+        确定处理请求的智能体
+
+        Returns:
+            tuple: (智能体, 处理后的查询内容)；切换智能体命令已处理或没有可用智能体时智能体为 None
+        """
         # 如果提供了specific_model，直接使用；否则根据消息内容选择智能体
         if specific_model:
-            model = specific_model
-            processed_query = query
-            is_switch = False
-            model_name = next((name for name, config in self.models.items() if config == model), '未知')
-            logger.info(f"使用指定的智能体 '{model_name}'")
-        else:
-            # 根据消息内容选择智能体
-            # model, processed_query, is_switch = self.get_model_from_message(query, message["SenderWxid"])
-            model, processed_query, is_switch, wakeup_detected = self.get_model_from_message(
-                query,
-                message["SenderWxid"],
-                message["FromWxid"] if message["IsGroup"] else None
+            logger.info(f"使用指定的智能体 '{specific_model.name}'")
+            return specific_model, query
+
+        # 根据消息内容选择智能体
+        # model, processed_query, is_switch = self.get_model_from_message(query, message["SenderWxid"])
+        model, processed_query, is_switch, wakeup_detected = await self.get_model_from_message(
+            query,
+            message["SenderWxid"],
+            message["FromWxid"] if message["IsGroup"] else None
+        )
+        # 如果是切换智能体的命令
+        if is_switch:
+            model_name = model.name
+            await bot.send_text_message(
+                message["FromWxid"],
+                f"已切换到{model_name.upper()}智能体，将一直使用该智能体直到下次切换。"
             )
-            # 如果是切换智能体的命令
-            if is_switch:
-                model_name = next(name for name, config in self.models.items() if config == model)
-                await bot.send_text_message(
-                    message["FromWxid"],
-                    f"已切换到{model_name.upper()}智能体，将一直使用该智能体直到下次切换。"
-                )
-                return
-            if model is None:
-                return
-            model_name = next((name for name, config in self.models.items() if config == model), '默认')
-            logger.info(f"从消息内容选择智能体 '{model_name}'")
+            return None, processed_query
+        if model is None:
+            return None, processed_query
+        logger.info(f"从消息内容选择智能体 '{model.name}'")
+        return model, processed_query
+
+    async def dify_request(self, bot: WechatAPIClient, message: dict, processed_query: str, model: ModelConfig,
+                           files=None):
+        """发送消息到Dify API，调用方需已取得会话的执行权和智能体的执行名额（见 dify）"""
+        if files is None:
+            files = []
+        model_name = model.name
+
+        # 选择端点，端点熔断中时直接回复，不再上传文件和等待超时
+        endpoint = await self.select_endpoint(model, message["FromWxid"])
+        if not self.endpoint_health.available(endpoint.base_url):
+            logger.warning(f"智能体 '{model_name}' 的端点 {endpoint.base_url} 熔断中: "
+                           f"{self.endpoint_health.get(endpoint.base_url).stats()}")
+            await self.handle_circuit_open(bot, message, model)
+            return
 
         # 记录将要使用的智能体配置
-        logger.info(f"智能体API密钥: {model.api_key[:5]}...{model.api_key[-5:] if len(model.api_key) > 10 else ''}")
-        logger.info(f"智能体API端点: {model.base_url}")
+        api_key = endpoint.api_key
+        logger.info(f"智能体API密钥: {api_key[:5]}...{api_key[-5:] if len(api_key) > 10 else ''}")
+        logger.info(f"智能体API端点: {endpoint.base_url}")
 
         # 处理文件上传
         formatted_files = []
@@ -1266,7 +1332,7 @@ class DifyPlus(PluginBase):
 
             # 上传文件到 Dify
             file_info = await self.upload_file_to_dify(file_content, file_name, mime_type, message["SenderWxid"],
-                                                       model_config=model)
+                                                       model_config=model, endpoint=endpoint)
             if file_info:
                 logger.info(f"成功上传缓存文件到 Dify，文件ID: {file_info['id']}, 类型: {file_info['type']}")
                 formatted_files.append({
@@ -1275,6 +1341,7 @@ class DifyPlus(PluginBase):
                     "upload_file_id": file_info["id"]
                 })
 
+        stream_sender = None
         try:
             logger.debug(f"开始调用 Dify API - 用户消息: {processed_query}")
             logger.debug(f"文件列表: {formatted_files}")
@@ -1292,17 +1359,17 @@ class DifyPlus(PluginBase):
                 if use_group_id:
                     # 使用群聊ID作为会话ID的键
                     logger.debug(f"群聊消息，使用群聊ID '{from_wxid}' 获取会话ID")
-                    conversation_id = self.db.get_llm_thread_id(from_wxid, namespace="dify")
+                    conversation_id = await self.conversations.get(from_wxid)
                 else:
                     # 使用发送者的wxid作为会话ID的键
                     logger.debug(f"群聊消息，使用发送者wxid '{user_wxid}' 获取会话ID")
-                    conversation_id = self.db.get_llm_thread_id(user_wxid, namespace="dify")
+                    conversation_id = await self.conversations.get(user_wxid)
             else:
                 # 私聊消息，使用原来的FromWxid
-                conversation_id = self.db.get_llm_thread_id(from_wxid, namespace="dify")
+                conversation_id = await self.conversations.get(from_wxid)
 
             try:
-                user_username = await bot.get_nickname(user_wxid) or "未知用户"
+                user_username = await self.get_nickname(bot, user_wxid) or "未知用户"
             except:
                 user_username = "未知用户"
 
@@ -1329,24 +1396,24 @@ class DifyPlus(PluginBase):
             # 决定是使用API代理还是直接连接
             use_api_proxy = self.api_proxy is not None and has_api_proxy
             logger.debug(
-                f"发送请求到 Dify（智能体：{model_name}） - URL: {model.base_url}/chat-messages, Payload: {json.dumps(payload)}")
+                f"发送请求到 Dify（智能体：{model_name}） - URL: {endpoint.base_url}/chat-messages, Payload: {json.dumps(payload)}")
 
             if use_api_proxy:
                 # 使用API代理调用
                 logger.info(f"通过API代理调用Dify")
                 try:
                     # 检查是否有对应的注册API
-                    base_url_without_v1 = model.base_url.rstrip("/v1")
-                    endpoint = model.base_url.replace(base_url_without_v1, "")
-                    endpoint = endpoint + "/chat-messages"
+                    base_url_without_v1 = endpoint.base_url.rstrip("/v1")
+                    api_endpoint = endpoint.base_url.replace(base_url_without_v1, "")
+                    api_endpoint = api_endpoint + "/chat-messages"
 
                     # 准备请求
                     api_response = await self.api_proxy.call_api(
                         api_type="dify",
-                        endpoint=endpoint,
+                        endpoint=api_endpoint,
                         data=payload,
                         method="POST",
-                        headers={"Authorization": f"Bearer {model.api_key}"}
+                        headers={"Authorization": f"Bearer {endpoint.api_key}"}
                     )
 
                     if api_response.get("success") is False:
@@ -1360,11 +1427,11 @@ class DifyPlus(PluginBase):
                         # 根据消息类型选择正确的ID来保存会话ID
                         if message["IsGroup"]:
                             # 群聊消息，使用群聊ID
-                            self.db.save_llm_thread_id(message["FromWxid"], new_con_id, "dify")
+                            self.conversations.set(message["FromWxid"], new_con_id, endpoint.base_url)
                             logger.debug(f"群聊消息，保存会话ID到群聊ID: {message['FromWxid']}")
                         else:
                             # 私聊消息，使用原来的FromWxid
-                            self.db.save_llm_thread_id(message["FromWxid"], new_con_id, "dify")
+                            self.conversations.set(message["FromWxid"], new_con_id, endpoint.base_url)
 
                         # 过滤掉思考标签
                         think_pattern = r'<think>.*?</think>'
@@ -1391,245 +1458,186 @@ class DifyPlus(PluginBase):
 
             # 如果API代理不可用或调用失败，使用直接连接
             if not use_api_proxy:
-                headers = {"Authorization": f"Bearer {model.api_key}", "Content-Type": "application/json"}
+                headers = {"Authorization": f"Bearer {endpoint.api_key}", "Content-Type": "application/json"}
                 ai_resp = ""
-                async with aiohttp.ClientSession() as session:
-                    # 正确的方式是在请求时设置代理，而不是在创建会话时
-                    proxy = self.http_proxy if self.http_proxy else None
-                    async with session.post(url=f"{model.base_url}/chat-messages", headers=headers,
-                                            data=json.dumps(payload), proxy=proxy) as resp:
-                        if resp.status in (200, 201):
-                            async for line in resp.content:
-                                line = line.decode("utf-8").strip()
-                                if not line or line == "event: ping":
-                                    continue
-                                elif line.startswith("data: "):
-                                    line = line[6:]
-                                try:
-                                    resp_json = json.loads(line)
-                                except json.JSONDecodeError:
-                                    logger.error(f"Dify返回的JSON解析错误: {line}")
-                                    continue
-
-                                event = resp_json.get("event", "")
-                                if event == "message":
-                                    ai_resp += resp_json.get("answer", "")
-                                elif event == "message_replace":
-                                    ai_resp = resp_json.get("answer", "")
-                                elif event == "message_end":
-                                    # 在消息结束时过滤掉思考标签
-                                    think_pattern = r'<think>.*?</think>'
-                                    ai_resp = re.sub(think_pattern, '', ai_resp, flags=re.DOTALL)
-                                    logger.debug(f"消息结束时过滤思考标签")
-                                elif event == "message_file":
-                                    file_url = resp_json.get("url", "")
-                                    file_id = resp_json.get("id", "")
-                                    file_type = resp_json.get("type", "image")
-                                    belongs_to = resp_json.get("belongs_to", "assistant")
-
-                                    # 存储文件信息
-                                    self.agent_files[file_id] = {
-                                        "url": file_url,
-                                        "type": file_type,
-                                        "belongs_to": belongs_to
-                                    }
-
-                                    # 处理文件
-                                    if file_type == "image":
-                                        await self.dify_handle_image(bot, message, file_url, model_config=model)
-                                    else:
-                                        logger.info(f"收到非图片类型文件: {file_type}, ID: {file_id}, URL: {file_url}")
-                                elif event == "agent_thought":
-                                    # 处理Agent思考过程
-                                    if self.support_agent_mode:
-                                        thought_id = resp_json.get("id", "")
-                                        message_id = resp_json.get("message_id", "")
-                                        conversation_id = resp_json.get("conversation_id", "")
-                                        position = resp_json.get("position", 0)
-                                        thought = resp_json.get("thought", "")
-                                        observation = resp_json.get("observation", "")
-                                        tool = resp_json.get("tool", "")
-                                        tool_input = resp_json.get("tool_input", "")
-                                        message_files = resp_json.get("message_files", [])
-
-                                        # 记录思考过程
-                                        if conversation_id not in self.current_agent_thoughts:
-                                            self.current_agent_thoughts[conversation_id] = []
-
-                                        self.current_agent_thoughts[conversation_id].append({
-                                            "id": thought_id,
-                                            "message_id": message_id,
-                                            "position": position,
-                                            "thought": thought,
-                                            "observation": observation,
-                                            "tool": tool,
-                                            "tool_input": tool_input,
-                                            "files": message_files
-                                        })
-
-                                        logger.debug(f"Agent思考: {thought[:100]}...")
-                                        if tool:
-                                            logger.debug(f"使用工具: {tool}, 输入: {tool_input}")
-                                        if observation:
-                                            logger.debug(f"观察结果: {observation[:100]}...")
-                                elif event == "agent_message":
-                                    # 处理Agent消息
-                                    if self.support_agent_mode:
-                                        answer = resp_json.get("answer", "")
-                                        ai_resp += answer
-                                        logger.debug(f"Agent消息: {answer}")
-                                elif event == "error":
-                                    await self.dify_handle_error(bot, message,
-                                                                 resp_json.get("task_id", ""),
-                                                                 resp_json.get("message_id", ""),
-                                                                 resp_json.get("status", ""),
-                                                                 resp_json.get("code", ""),
-                                                                 resp_json.get("message", ""))
-
-                            new_con_id = resp_json.get("conversation_id", "")
-                            if new_con_id and new_con_id != conversation_id:
-                                # 根据消息类型选择正确的ID来保存会话ID
-                                if message["IsGroup"]:
-                                    # 群聊消息，使用群聊ID
-                                    self.db.save_llm_thread_id(message["FromWxid"], new_con_id, "dify")
-                                    logger.debug(f"群聊消息，保存会话ID到群聊ID: {message['FromWxid']}")
-                                else:
-                                    # 私聊消息，使用原来的FromWxid
-                                    self.db.save_llm_thread_id(message["FromWxid"], new_con_id, "dify")
-                            ai_resp = ai_resp.rstrip()
-
-                            # 最后再次过滤思考标签，确保完全移除
-                            think_pattern = r'<think>.*?</think>'
-                            ai_resp = re.sub(think_pattern, '', ai_resp, flags=re.DOTALL)
-                            logger.debug(f"Dify响应(过滤思考标签后): {ai_resp[:100]}...")
-                        elif resp.status == 404:
-                            logger.warning("会话ID不存在，重置会话ID并重试")
-                            # 根据消息类型选择正确的ID来重置会话ID
-                            if message["IsGroup"]:
-                                # 群聊消息，使用群聊ID
-                                self.db.save_llm_thread_id(message["FromWxid"], "", "dify")
-                                logger.debug(f"群聊消息，重置会话ID，群聊ID: {message['FromWxid']}")
-                            else:
-                                # 私聊消息，使用原来的FromWxid
-                                self.db.save_llm_thread_id(message["FromWxid"], "", "dify")
-                            # 重要：在递归调用时必须传递原始智能体，不要重新选择
-                            return await self.dify(bot, message, processed_query, files=formatted_files,
-                                                   specific_model=model)
-                        elif resp.status == 400:
-                            # 先获取错误内容
-                            error_text = await resp.content.read()
-                            error_text_str = error_text.decode('utf-8')
-
-                            logger.warning(f"收到{resp.status}错误，完整错误信息: {error_text_str}")
-
-                            # 强制重置会话ID，无论错误类型如何
-                            # 这是一个更激进的解决方案，但可以确保会话ID被重置
-                            logger.warning(f"收到{resp.status}错误，强制重置会话ID")
-
-                            # 重置会话ID
-                            # 根据消息类型选择正确的ID来重置会话ID
-                            if message.get("IsGroup", False):
-                                # 群聊消息，使用群聊ID
-                                from_wxid = message.get("FromWxid", "")
-                                if from_wxid:
-                                    # 确保完全清除会话ID
-                                    self.db.save_llm_thread_id(from_wxid, "", "dify")
-                                    logger.info(f"已重置群聊 {from_wxid} 的会话ID")
-                            else:
-                                # 私聊消息，使用原来的FromWxid
-                                from_wxid = message.get("FromWxid", "")
-                                if from_wxid:
-                                    # 确保完全清除会话ID
-                                    self.db.save_llm_thread_id(from_wxid, "", "dify")
-                                    logger.info(f"已重置私聊用户 {from_wxid} 的会话ID")
-
-                            # 通知用户
-                            await bot.send_text_message(
-                                message["FromWxid"],
-                                f"{XYBOT_PREFIX}检测到对话异常，已重置对话。正在重新处理您的问题..."
-                            )
-
-                            # 等待一小段时间，确保数据库操作完成
-                            await asyncio.sleep(1)
-
-                            # 创建一个新的会话ID
-                            new_conversation_id = str(uuid.uuid4())
-                            logger.info(f"生成新的会话ID: {new_conversation_id}")
-
-                            # 保存新的会话ID
-                            if message.get("IsGroup", False):
-                                # 群聊消息，使用群聊ID
-                                self.db.save_llm_thread_id(message.get("FromWxid", ""), new_conversation_id, "dify")
-                            else:
-                                # 私聊消息，使用原来的FromWxid
-                                self.db.save_llm_thread_id(message.get("FromWxid", ""), new_conversation_id, "dify")
-
-                            # 修改payload，使用新的会话ID
-                            payload["conversation_id"] = new_conversation_id
-                            logger.info(f"更新payload中的会话ID为: {new_conversation_id}")
-
-                            # 重新发送请求，使用新的会话ID
-                            logger.info("使用新会话ID重新发送请求")
-
-                            # 重新构建请求
-                            headers = {"Authorization": f"Bearer {model.api_key}", "Content-Type": "application/json"}
-                            ai_resp = ""
-
-                            # 重新发送请求
-                            logger.debug(
-                                f"重新发送请求到 Dify - URL: {model.base_url}/chat-messages, 新会话ID: {new_conversation_id}")
-                            async with aiohttp.ClientSession() as new_session:
-                                # 正确的方式是在请求时设置代理，而不是在创建会话时
-                                proxy = self.http_proxy if self.http_proxy else None
-                                async with new_session.post(url=f"{model.base_url}/chat-messages", headers=headers,
-                                                            data=json.dumps(payload), proxy=proxy) as new_resp:
-                                    if new_resp.status in (200, 201):
-                                        # 处理成功响应
-                                        logger.info("使用新会话ID的请求成功")
-                                        # 读取响应内容
-                                        async for line in new_resp.content:
-                                            line = line.decode("utf-8").strip()
-                                            if not line or line == "event: ping":
-                                                continue
-                                            elif line.startswith("data: "):
-                                                line = line[6:]
-                                            try:
-                                                resp_json = json.loads(line)
-                                                event = resp_json.get("event", "")
-                                                if event == "message":
-                                                    ai_resp += resp_json.get("answer", "")
-                                                elif event == "message_end":
-                                                    # 处理消息结束事件
-                                                    think_pattern = r'<think>.*?</think>'
-                                                    ai_resp = re.sub(think_pattern, '', ai_resp, flags=re.DOTALL)
-                                            except json.JSONDecodeError:
-                                                logger.error(f"重试请求返回的JSON解析错误: {line}")
-                                                continue
-
-                                        # 处理响应
-                                        if ai_resp:
-                                            await self.dify_handle_text(bot, message, ai_resp, model)
-                                            return
+                # 按数据块累积答案并增量过滤思考内容
+                answer_buffer = AnswerBuffer()
+                answer_tail = ""
+                resp_json = {}
+                # 流式发送，语音回复需要完整文本所以不使用
+                stream_chunker = None
+                if self.stream_reply and not (message["MsgType"] == 34 or self.voice_reply_all):
+                    stream_chunker = StreamChunker(self.stream_chunk_size, self.stream_flush_interval)
+                    stream_renderer = ReplyRenderer()
+                    stream_sent = 0
+                    stream_links = []
+
+                    async def send_segments(segments: list[str], renderer: ReplyRenderer):
+                        nonlocal stream_sent
+                        stream_sent = await self.send_stream_segments(bot, message, segments, stream_sent,
+                                                                      stream_links, renderer)
+
+                    # 片段在后台按顺序发送，发送排队时继续读取响应流
+                    stream_sender = StreamSender(send_segments)
+                # 正确的方式是在请求时设置代理，而不是在创建会话时
+                proxy = self.http_proxy if self.http_proxy else None
+                # 限流、网关错误和连接失败按重试策略重试；会话不存在（404）或对话异常（400）时重置会话后重试一次
+                retry = self.retry_policy.begin(f"Dify对话（智能体：{model_name}）")
+                conversation_reset = False
+                while True:
+                    delay = None
+                    try:
+                        async with self.endpoint_health.call(endpoint.base_url) as endpoint_call, \
+                                self.http_pool.session(endpoint.base_url, proxy) as session:
+                            async with session.post(url=f"{endpoint.base_url}/chat-messages", headers=headers,
+                                                    data=json.dumps(payload), proxy=proxy,
+                                                    timeout=self.dify_timeout) as resp:
+                                endpoint_call.finish(resp.status < 500)
+                                if resp.status in (200, 201):
+                                    async for resp_json in iter_sse_events(resp.content):
+                                        event = resp_json.get("event", "")
+                                        if event == "message":
+                                            visible = answer_buffer.append(resp_json.get("answer", ""))
+                                            if stream_chunker:
+                                                stream_sender.put(stream_chunker.feed(visible), stream_renderer)
+                                        elif event == "message_replace":
+                                            visible = answer_buffer.replace(resp_json.get("answer", ""))
+                                            if stream_chunker:
+                                                # 已发送的片段无法撤回，替换内容作为新的回复继续发送
+                                                logger.warning(f"流式发送中收到message_replace，已发送 {stream_sent} 段")
+                                                stream_chunker = StreamChunker(self.stream_chunk_size,
+                                                                               self.stream_flush_interval)
+                                                stream_renderer = ReplyRenderer()
+                                                stream_sender.put(stream_chunker.feed(visible), stream_renderer)
+                                        elif event == "message_file":
+                                            file_url = resp_json.get("url", "")
+                                            file_id = resp_json.get("id", "")
+                                            file_type = resp_json.get("type", "image")
+                                            belongs_to = resp_json.get("belongs_to", "assistant")
+
+                                            # 存储文件信息
+                                            self.agent_files[file_id] = {
+                                                "url": file_url,
+                                                "type": file_type,
+                                                "belongs_to": belongs_to
+                                            }
+
+                                            # 处理文件
+                                            if file_type == "image":
+                                                await self.dify_handle_image(bot, message, file_url, model_config=model)
+                                            else:
+                                                logger.info(f"收到非图片类型文件: {file_type}, ID: {file_id}, URL: {file_url}")
+                                        elif event == "agent_thought":
+                                            # 处理Agent思考过程
+                                            if self.support_agent_mode:
+                                                thought_id = resp_json.get("id", "")
+                                                message_id = resp_json.get("message_id", "")
+                                                conversation_id = resp_json.get("conversation_id", "")
+                                                position = resp_json.get("position", 0)
+                                                thought = resp_json.get("thought", "")
+                                                observation = resp_json.get("observation", "")
+                                                tool = resp_json.get("tool", "")
+                                                tool_input = resp_json.get("tool_input", "")
+                                                message_files = resp_json.get("message_files", [])
+
+                                                # 记录思考过程
+                                                if conversation_id not in self.current_agent_thoughts:
+                                                    self.current_agent_thoughts[conversation_id] = []
+
+                                                self.current_agent_thoughts[conversation_id].append({
+                                                    "id": thought_id,
+                                                    "message_id": message_id,
+                                                    "position": position,
+                                                    "thought": thought,
+                                                    "observation": observation,
+                                                    "tool": tool,
+                                                    "tool_input": tool_input,
+                                                    "files": message_files
+                                                })
+
+                                                logger.debug(f"Agent思考: {thought[:100]}...")
+                                                if tool:
+                                                    logger.debug(f"使用工具: {tool}, 输入: {tool_input}")
+                                                if observation:
+                                                    logger.debug(f"观察结果: {observation[:100]}...")
+                                        elif event == "agent_message":
+                                            # 处理Agent消息
+                                            if self.support_agent_mode:
+                                                answer = resp_json.get("answer", "")
+                                                visible = answer_buffer.append(answer)
+                                                logger.debug(f"Agent消息: {answer}")
+                                                if stream_chunker:
+                                                    stream_sender.put(stream_chunker.feed(visible), stream_renderer)
+                                        elif event == "error":
+                                            await self.dify_handle_error(bot, message,
+                                                                         resp_json.get("task_id", ""),
+                                                                         resp_json.get("message_id", ""),
+                                                                         resp_json.get("status", ""),
+                                                                         resp_json.get("code", ""),
+                                                                         resp_json.get("message", ""))
+
+                                    new_con_id = resp_json.get("conversation_id", "")
+                                    if new_con_id and new_con_id != conversation_id:
+                                        # 根据消息类型选择正确的ID来保存会话ID
+                                        if message["IsGroup"]:
+                                            # 群聊消息，使用群聊ID
+                                            self.conversations.set(message["FromWxid"], new_con_id, endpoint.base_url)
+                                            logger.debug(f"群聊消息，保存会话ID到群聊ID: {message['FromWxid']}")
                                         else:
-                                            logger.warning("重试请求未返回有效响应")
+                                            # 私聊消息，使用原来的FromWxid
+                                            self.conversations.set(message["FromWxid"], new_con_id, endpoint.base_url)
+                                    answer_tail = answer_buffer.finish()
+                                    ai_resp = answer_buffer.getvalue().rstrip()
+                                    logger.debug(f"Dify响应(过滤思考标签后): {ai_resp[:100]}...")
+                                elif resp.status in (400, 404) and not conversation_reset:
+                                    conversation_reset = True
+                                    if resp.status == 404:
+                                        logger.warning("会话ID不存在，重置会话ID并重试")
                                     else:
-                                        # 如果重试仍然失败，放弃并通知用户
-                                        error_msg = await new_resp.text()
-                                        logger.error(f"重试请求失败: HTTP {new_resp.status} - {error_msg}")
+                                        error_text_str = (await resp.content.read()).decode('utf-8')
+                                        logger.warning(f"收到{resp.status}错误，完整错误信息: {error_text_str}")
+                                        logger.warning(f"收到{resp.status}错误，强制重置会话ID并重试")
+                                        # 缓存的文件ID可能已被Dify清理
+                                        self.forget_uploaded_files(formatted_files)
+                                        # 通知用户
                                         await bot.send_text_message(
                                             message["FromWxid"],
-                                            f"{XYBOT_PREFIX}重试请求失败，请稍后再试。"
+                                            f"{XYBOT_PREFIX}检测到对话异常，已重置对话。正在重新处理您的问题..."
                                         )
+                                    # 群聊和私聊的会话ID都保存在FromWxid下，清空后由Dify创建新会话
+                                    self.conversations.reset(message["FromWxid"])
+                                    logger.info(f"已重置 {message['FromWxid']} 的会话ID")
+                                    conversation_id = ""
+                                    payload["conversation_id"] = ""
+                                    delay = retry.delay()
+                                    if delay is None:
+                                        await bot.send_text_message(message["FromWxid"],
+                                                                    f"{XYBOT_PREFIX}重试请求失败，请稍后再试。")
                                         return
-
-                            # 如果执行到这里，说明重试失败，回退到原始方法
-                            return await self.dify(bot, message, processed_query, files=files, specific_model=model)
-                        elif resp.status == 500:
-                            return await self.handle_500(bot, message)
-                        else:
-                            return await self.handle_other_status(bot, message, resp)
-
-                if ai_resp:
+                                else:
+                                    delay = retry.on_status(resp.status, resp.headers)
+                                    if delay is None:
+                                        if resp.status == 500:
+                                            return await self.handle_500(bot, message)
+                                        return await self.handle_other_status(bot, message, resp)
+                    except aiohttp.ClientConnectorError as e:
+                        # 连接失败时请求尚未发出，可以安全重试
+                        delay = retry.on_error(e)
+                        if delay is None:
+                            raise
+                    if delay is None:
+                        break
+                    await asyncio.sleep(delay)
+
+                if stream_chunker:
+                    # 发送剩余片段和回复中的文件链接
+                    stream_sender.put(stream_chunker.feed(answer_tail) + stream_chunker.flush(), stream_renderer)
+                    await stream_sender.close()
+                    await self.send_reply_links(bot, message, stream_links, model)
+                    self.current_agent_thoughts.pop(resp_json.get("conversation_id", ""), None)
+                    if not stream_sent and not stream_links:
+                        logger.warning("Dify未返回有效响应")
+                elif ai_resp:
                     # 获取消息ID，如果有的话
                     message_id = resp_json.get("message_id")
                     if message_id:
@@ -1639,9 +1647,16 @@ class DifyPlus(PluginBase):
                         await self.dify_handle_text(bot, message, ai_resp, model)
                 else:
                     logger.warning("Dify未返回有效响应")
+        except CircuitOpenError as e:
+            logger.warning(f"Dify API 未调用: {e}")
+            await self.handle_circuit_open(bot, message, model)
         except Exception as e:
             logger.error(f"Dify API 调用失败: {e}")
             await self.handle_exceptions(bot, message, model_config=model)
+        finally:
+            # 出错或提前返回时停止后台发送
+            if stream_sender:
+                stream_sender.cancel()
 
     async def download_file(self, url: str) -> bytes:
         """
@@ -1649,9 +1664,9 @@ class DifyPlus(PluginBase):
         """
         try:
             logger.info(f"开始下载文件: {url}")
-            async with aiohttp.ClientSession() as session:
-                # 正确的方式是在请求时设置代理，而不是在创建会话时
-                proxy = self.http_proxy if self.http_proxy else None
+            # 正确的方式是在请求时设置代理，而不是在创建会话时
+            proxy = self.http_proxy if self.http_proxy else None
+            async with self.http_pool.session(proxy=proxy) as session:
                 async with session.get(url, proxy=proxy) as resp:
                     if resp.status == 200:
                         content = await resp.read()
@@ -1666,9 +1681,10 @@ class DifyPlus(PluginBase):
             return None
 
     async def upload_file_to_dify(self, file_content: bytes, file_name: str, mime_type: str, user: str,
-                                  model_config=None) -> Optional[dict]:
+                                  model_config=None, endpoint: Endpoint = None) -> Optional[dict]:
         """
-        上传文件到Dify并返回文件信息
+        上传文件到Dify并返回文件信息，文件只能在同一端点的对话中引用，
+        未指定 endpoint 时使用会话 user 绑定的端点
         返回格式: {"id": "uuid", "type": "image|document|audio|video"}
         """
         logger.info(
@@ -1678,6 +1694,20 @@ class DifyPlus(PluginBase):
             logger.error("文件内容为空，无法上传")
             return None
 
+        # 使用传入的model_config，如果没有则使用默认智能体
+        model = model_config or self.current_model
+        endpoint = endpoint or await self.select_endpoint(model, user)
+
+        # 相同内容已上传到同一智能体的同一端点时直接复用文件ID，省去图片处理和上传
+        upload_key = None
+        if self.upload_cache_ttl:
+            upload_key = (model.name, endpoint.base_url, hashlib.sha256(file_content).hexdigest())
+            file_info = self.upload_cache.get(upload_key)
+            if file_info:
+                logger.info(f"文件已上传过，复用文件ID: {file_info['id']}, 类型: {file_info['type']}")
+                self.clear_upload_source_cache(user, file_info["type"])
+                return dict(file_info)
+
         try:
             # 判断文件类型
             file_extension = os.path.splitext(file_name)[1].lower().lstrip('.')
@@ -1717,69 +1747,12 @@ class DifyPlus(PluginBase):
                     logger.info(f"检测到 PPT 文件，使用 document 类型上传")
             elif file_extension in image_extensions or mime_type.startswith('image/'):
                 file_type = "image"
-                # 处理图片文件
+                # 处理图片文件：去除alpha通道、限制尺寸和大小，在图片处理进程中执行
                 try:
-                    # 尝试打开图片数据
-                    # 特别处理截断的图片文件
-                    from PIL import ImageFile
-                    ImageFile.LOAD_TRUNCATED_IMAGES = True  # 允许加载截断的图片
-
-                    # 使用BytesIO确保完整读取图片数据
-                    image_io = io.BytesIO(file_content)
-                    image = Image.open(image_io)
-                    logger.debug(f"原始图片格式: {image.format}, 大小: {image.size}, 模式: {image.mode}")
-
-                    # 转换为RGB模式(去除alpha通道)
-                    if image.mode in ('RGBA', 'LA'):
-                        logger.debug(f"图片包含alpha通道，转换为RGB模式")
-                        background = Image.new('RGB', image.size, (255, 255, 255))
-                        background.paste(image, mask=image.split()[-1])
-                        image = background
-
-                    # 检查图片大小，如果太大则调整大小
-                    max_dimension = 1600  # 最大尺寸限制
-                    max_file_size = 1024 * 1024 * 2  # 2MB大小限制
-
-                    # 调整图片尺寸
-                    width, height = image.size
-                    if width > max_dimension or height > max_dimension:
-                        # 计算缩放比例
-                        ratio = min(max_dimension / width, max_dimension / height)
-                        new_width = int(width * ratio)
-                        new_height = int(height * ratio)
-                        logger.info(f"图片尺寸过大，调整大小从 {width}x{height} 到 {new_width}x{new_height}")
-                        image = image.resize((new_width, new_height), Image.LANCZOS)
-
-                    # 保存为JPEG，尝试不同的质量级别以满足大小限制
-                    quality = 95
-                    output = io.BytesIO()
-                    image.save(output, format='JPEG', quality=quality, optimize=True)
-                    output.seek(0)
-                    resized_content = output.getvalue()
-
-                    # 如果文件仍然太大，逐步降低质量
-                    while len(resized_content) > max_file_size and quality > 50:
-                        quality -= 10
-                        output = io.BytesIO()
-                        image.save(output, format='JPEG', quality=quality, optimize=True)
-                        output.seek(0)
-                        resized_content = output.getvalue()
-                        logger.debug(f"降低图片质量到 {quality}，新大小: {len(resized_content)} 字节")
-
-                    file_content = resized_content
+                    file_content, quality = await self.image_processor.normalize_for_upload(file_content)
                     mime_type = 'image/jpeg'
                     file_extension = 'jpg'
                     logger.info(f"图片处理成功，质量: {quality}，新大小: {len(file_content)} 字节")
-
-                    # 验证处理后的图片
-                    try:
-                        Image.open(io.BytesIO(file_content))
-                        logger.debug("处理后的图片验证成功")
-                    except Exception as e:
-                        logger.error(f"处理后的图片验证失败: {e}")
-                        # 如果处理后的图片无效，尝试使用原始图片数据
-                        file_content = image_io.getvalue()
-                        logger.warning(f"使用原始图片数据上传，大小: {len(file_content)} 字节")
                 except Exception as e:
                     logger.error(f"图片格式转换失败: {e}")
                     logger.error(traceback.format_exc())
@@ -1798,13 +1771,11 @@ class DifyPlus(PluginBase):
 
             logger.info(f"文件类型判断: {file_type}, 扩展名: {file_extension}")
 
-            # 使用传入的model_config，如果没有则使用默认智能体
-            model = model_config or self.current_model
-            model_name = next((name for name, config in self.models.items() if config == model), '未知')
-            logger.debug(f"使用智能体 '{model_name}' 上传文件")
+            model_name = model.name
+            logger.debug(f"使用智能体 '{model_name}' 上传文件到 {endpoint.base_url}")
 
             # 检查API密钥
-            if not model.api_key:
+            if not endpoint.api_key:
                 logger.error(f"智能体 '{model_name}' 的API密钥未配置，无法上传文件")
                 return None
 
@@ -1839,59 +1810,91 @@ class DifyPlus(PluginBase):
                 logger.info(f"更新MIME类型为: {mime_type}")
 
             # 使用直接连接上传文件
-            headers = {"Authorization": f"Bearer {model.api_key}"}
-            formdata = aiohttp.FormData()
-            # 使用处理后的文件名
-            formdata.add_field("file", file_content,
-                               filename=processed_file_name,
-                               content_type=mime_type)
-            # 确保使用正确的用户ID
-            # 如果user是群聊ID（包含@chatroom），则使用它
-            # 否则，使用发送者的wxid
-            formdata.add_field("user", user)
-
-            url = f"{model.base_url}/files/upload"
+            headers = {"Authorization": f"Bearer {endpoint.api_key}"}
+            url = f"{endpoint.base_url}/files/upload"
             logger.debug(f"开始请求Dify文件上传API: {url}")
 
             # 设置较长的超时时间
             timeout = aiohttp.ClientTimeout(total=60)  # 60秒超时
 
             try:
-                async with aiohttp.ClientSession(timeout=timeout) as session:
-                    # 正确的方式是在请求时设置代理，而不是在创建会话时
-                    proxy = self.http_proxy if self.http_proxy else None
-                    async with session.post(url, headers=headers, data=formdata, proxy=proxy) as resp:
-                        if resp.status in (200, 201):
-                            result = await resp.json()
-                            file_id = result.get("id")
-                            if file_id:
-                                logger.info(f"文件上传成功，文件ID: {file_id}, 类型: {file_type}")
-                                # 上传成功后删除缓存
-                                if user in self.file_cache:
-                                    del self.file_cache[user]
-                                    logger.debug(f"已清除用户 {user} 的文件缓存")
-                                # 清除图片缓存
-                                if file_type == "image" and user in self.image_cache:
-                                    del self.image_cache[user]
-                                    logger.debug(f"已清除用户 {user} 的图片缓存")
-                                return {
-                                    "id": file_id,
-                                    "type": file_type
-                                }
-                            else:
-                                logger.error(f"文件上传成功但未返回文件ID: {result}")
-                        else:
-                            error_text = await resp.text()
-                            logger.error(f"文件上传失败: HTTP {resp.status} - {error_text}")
-                            return None
+                # 正确的方式是在请求时设置代理，而不是在创建会话时
+                proxy = self.http_proxy if self.http_proxy else None
+                retry = self.retry_policy.begin(f"Dify文件上传（{processed_file_name}）")
+                while True:
+                    # FormData只能发送一次，每次尝试重新构建
+                    formdata = aiohttp.FormData()
+                    # 使用处理后的文件名
+                    formdata.add_field("file", file_content,
+                                       filename=processed_file_name,
+                                       content_type=mime_type)
+                    # 确保使用正确的用户ID
+                    # 如果user是群聊ID（包含@chatroom），则使用它
+                    # 否则，使用发送者的wxid
+                    formdata.add_field("user", user)
+                    try:
+                        # 上传与对话共享智能体的并发名额，在Dify请求内部上传时不重复占用
+                        async with self.admission.slot(model.name), \
+                                self.endpoint_health.call(endpoint.base_url) as endpoint_call, \
+                                self.http_pool.session(endpoint.base_url, proxy) as session:
+                            async with session.post(url, headers=headers, data=formdata, proxy=proxy,
+                                                    timeout=timeout) as resp:
+                                endpoint_call.finish(resp.status < 500)
+                                delay = retry.on_status(resp.status, resp.headers)
+                                if delay is None:
+                                    if resp.status in (200, 201):
+                                        result = await resp.json()
+                                        file_id = result.get("id")
+                                        if file_id:
+                                            logger.info(f"文件上传成功，文件ID: {file_id}, 类型: {file_type}")
+                                            # 上传成功后删除缓存
+                                            self.clear_upload_source_cache(user, file_type)
+                                            file_info = {
+                                                "id": file_id,
+                                                "type": file_type
+                                            }
+                                            if upload_key:
+                                                self.upload_cache.set(upload_key, file_info)
+                                            return dict(file_info)
+                                        else:
+                                            logger.error(f"文件上传成功但未返回文件ID: {result}")
+                                            return None
+                                    else:
+                                        error_text = await resp.text()
+                                        logger.error(f"文件上传失败: HTTP {resp.status} - {error_text}")
+                                        return None
+                    except aiohttp.ClientConnectorError as e:
+                        delay = retry.on_error(e)
+                        if delay is None:
+                            raise
+                    await asyncio.sleep(delay)
             except aiohttp.ClientError as e:
                 logger.error(f"HTTP请求失败: {e}")
                 return None
+        except AdmissionRejected:
+            # 名额不足不是上传错误，交给调用方回复忙碌提示
+            raise
         except Exception as e:
             logger.error(f"上传文件时发生错误: {e}")
             logger.error(traceback.format_exc())
             return None
 
+    def clear_upload_source_cache(self, user: str, file_type: str):
+        """文件上传（或复用）后清除用户的文件缓存和图片缓存"""
+        if self.media_cache.pop(("file", user)) is not None:
+            logger.debug(f"已清除用户 {user} 的文件缓存")
+        # 清除图片缓存
+        if file_type == "image" and self.media_cache.pop(("image", user)) is not None:
+            logger.debug(f"已清除用户 {user} 的图片缓存")
+
+    def forget_uploaded_files(self, files: list):
+        """Dify拒绝请求时，移除请求中引用的已缓存文件ID，下次重新上传"""
+        file_ids = {file.get("upload_file_id") for file in files or [] if isinstance(file, dict)}
+        for key, file_info in self.upload_cache.items():
+            if file_info["id"] in file_ids:
+                self.upload_cache.pop(key)
+                logger.debug(f"已移除上传缓存中的文件ID: {file_info['id']}")
+
     async def dify_handle_text(self, bot: WechatAPIClient, message: dict, text: str, model_config=None,
                                message_id=None):
         """
@@ -1907,20 +1910,18 @@ class DifyPlus(PluginBase):
         # 使用传入的model_config，如果没有则使用默认智能体
         model = model_config or self.current_model
 
-        # 先过滤掉<think>...</think>标签中的内容
-        think_pattern = r'<think>.*?</think>'
-        text = re.sub(think_pattern, '', text, flags=re.DOTALL)
+        # <think>...</think>思考内容已由调用方过滤
         logger.debug(f"过滤思考标签后的文本: {text[:100]}...")
 
         # 获取会话ID，用于查找Agent思考过程
         # 根据消息类型选择正确的ID来获取会话ID
         if message["IsGroup"]:
             # 群聊消息，使用群聊ID
-            conversation_id = self.db.get_llm_thread_id(message["FromWxid"], namespace="dify")
+            conversation_id = await self.conversations.get(message["FromWxid"])
             logger.debug(f"群聊消息，从群聊ID获取会话ID: {message['FromWxid']}")
         else:
             # 私聊消息，使用原来的FromWxid
-            conversation_id = self.db.get_llm_thread_id(message["FromWxid"], namespace="dify")
+            conversation_id = await self.conversations.get(message["FromWxid"])
 
         # 如果启用了Agent模式且有思考过程，可以在这里处理
         if self.support_agent_mode and conversation_id in self.current_agent_thoughts:
@@ -1940,39 +1941,7 @@ class DifyPlus(PluginBase):
                 # 清除已处理的思考过程
                 self.current_agent_thoughts[conversation_id] = []
 
-        # 匹配Dify返回的Markdown链接格式 [文件名](URL) 和 ![文件名](URL)
-        link_pattern = r'!?\[(.*?)\]\((.*?)\)'
-        matches = re.findall(link_pattern, text)
-
-        # 记录所有找到的链接
-        if matches:
-            logger.info(f"[文件处理] 在回复中找到 {len(matches)} 个文件链接")
-            for i, (filename, url) in enumerate(matches):
-                logger.info(f"[文件处理] 链接 {i + 1}: 文件名='{filename}', URL='{url}'")
-        # 移除所有链接文本，以免重复显示
-        text = re.sub(link_pattern, '', text)
-
-        # 移除行首字符为标点符号后面跟换行的
-        pattern = r'^([\u2000-\u206F\u2E00-\u2E7F\'!"#$%&()*+,\-./:;<=>?@[\]^_`{|}~]+)(\r\n|\n|\r)'
-        while re.search(pattern, text, re.MULTILINE):
-            text = re.sub(pattern, '', text, flags=re.MULTILINE)
-
-        # 移除粗体、斜体、代码块、链接、图片等基础格式
-        text = re.sub(r'\*\*(.*?)\*\*', r'\1', text)  # 粗体
-        text = re.sub(r'\*(.*?)\*', r'\1', text)  # 斜体
-        text = re.sub(r'`(.*?)`', r'\1', text)  # 行内代码
-        text = re.sub(r'\!$$(.*?)$$$.*?$', r'\1', text)  # 图片
-        text = re.sub(r'$$(.*?)$$$.*?$', r'\1', text)  # 链接
-        # 移除标题
-        text = re.sub(r'^#+\s*', '', text, flags=re.MULTILINE)
-        # 移除列表标记
-        text = re.sub(r'^[\*\-\+] ', '', text, flags=re.MULTILINE)
-        # 移除代码块
-        text = re.sub(r'```.*?\n.*?```', '', text, flags=re.DOTALL)
-        # 移除引用
-        text = re.sub(r'^> ', '', text, flags=re.MULTILINE)
-        # 移除水平线
-        text = re.sub(r'^[-*_]{3,}', '', text, flags=re.MULTILINE)
+        text, matches = self.clean_reply_text(text)
 
         # 先发送文字内容
         if text:
@@ -1992,311 +1961,345 @@ class DifyPlus(PluginBase):
                 # 使用 //n 作为分隔符进行分段发送
                 paragraphs = text.split("//n")
                 logger.info(f"检测到 //n 分隔符，将消息分为 {len(paragraphs)} 段发送")
+                await self.send_reply_paragraphs(bot, message, paragraphs)
 
-                should_quote = False
-                quoted_msg_id = message.get("MsgId", "")
-                quoted_wxid = message.get("SenderWxid", "")
-                quoted_content = message.get("Content", "")
+        # 处理所有找到的链接
+        await self.send_reply_links(bot, message, matches, model)
 
-                # 尝试获取引用消息的发送者昵称
-                try:
-                    quoted_nickname = await bot.get_nickname(quoted_wxid) or "未知用户"
-                except:
-                    quoted_nickname = "未知用户"
+    def clean_reply_text(self, text: str, renderer: ReplyRenderer = None) -> tuple[str, list]:
+        """
+        移除回复中的Markdown格式并提取文件链接，见 ReplyRenderer
+
+        Args:
+            renderer: 流式发送时同一回复共用的转换器，保留跨片段的代码块状态
 
-                # 如果有消息ID且内容不是太长，使用引用回复
-                if quoted_msg_id and quoted_wxid and quoted_content and len(quoted_content) <= 100:
-                    should_quote = True
-                    logger.info(f"将使用普通消息引用回复，引用MsgId={quoted_msg_id}")
+        Returns:
+            tuple: (处理后的文本, [(文件名, URL), ...])
+        """
+        return (renderer or ReplyRenderer()).render(text)
 
-                for i, paragraph in enumerate(paragraphs):
-                    if paragraph.strip():
-                        logger.debug(f"发送第 {i + 1}/{len(paragraphs)} 段消息，长度: {len(paragraph.strip())} 字符")
+    async def send_reply_paragraphs(self, bot: WechatAPIClient, message: dict, paragraphs: list[str],
+                                    quote_first: bool = True, seq: int = 0) -> int:
+        """
+        逐段发送文本回复
 
-                        # 群聊判断如果CSRS标记，则@人工座席微信
-                        if message["IsGroup"]:
-                            group_id = message["FromWxid"]
-                            if '@@@CSRS@@@' in paragraph:
-                                logger.debug(f'发现@CSRS标记，正在获取csrs')
-                                paragraph = paragraph.replace('@@@CSRS@@@', '')
-                                # 只对第一段使用引用回复
-                                if should_quote and i == 0:
-                                    await self.send_quote_message(
-                                        bot,
-                                        message["FromWxid"],
-                                        paragraph.strip(),
-                                        quoted_msg_id,
-                                        quoted_wxid,
-                                        quoted_nickname,
-                                        quoted_content[:100]  # 截断过长的引用内容
-                                    )
-                                else:
-                                    await bot.send_at_message(message["FromWxid"], paragraph.strip(),
-                                                              [message["SenderWxid"]])
-                                groups_config = self.groupid_to_groupsconfig.get(group_id, {})
-                                members = await bot.get_chatroom_member_list(group_id)
-                                csrs = [member['UserName'] for member in members
-                                        if member.get('UserName') in groups_config.csrs]
-                                if len(csrs) > 0:
-                                    logger.debug(f'找到csrs: {csrs}，并@csrs。')
-                                    await bot.send_at_message(message["FromWxid"], '', csrs)
-                            else:
-                                # 只对第一段使用引用回复
-                                if should_quote and i == 0:
-                                    await self.send_quote_message(
-                                        bot,
-                                        message["FromWxid"],
-                                        paragraph.strip(),
-                                        quoted_msg_id,
-                                        quoted_wxid,
-                                        quoted_nickname,
-                                        quoted_content[:100]  # 截断过长的引用内容
-                                    )
-                                else:
-                                    await bot.send_at_message(message["FromWxid"], paragraph.strip(),
-                                                              [message["SenderWxid"]])
+        Args:
+            bot: WechatAPIClient实例
+            message: 消息字典
+            paragraphs: 要发送的段落列表
+            quote_first: 第一段是否使用引用回复（流式发送时只有首批片段需要引用）
+            seq: 这批段落在整个回复中的序号，与MsgId一起作为发件箱的键
 
-                        else:
-                            if '@@@CSRS@@@' in paragraph:
-                                paragraph = paragraph.replace('@@@CSRS@@@', '')
-                            send_message = paragraph.strip()
-                            send_message = self.reply_title + send_message
-                            # 只对第一段使用引用回复
-                            if should_quote and i == 0:
-                                await self.send_quote_message(
-                                    bot,
-                                    message["FromWxid"],
-                                    send_message,
-                                    quoted_msg_id,
-                                    quoted_wxid,
-                                    quoted_nickname,
-                                    quoted_content[:100]  # 截断过长的引用内容
-                                )
-                            else:
-                                await bot.send_text_message(message["FromWxid"], send_message)
+        Returns:
+            int: 发送的段落数
+        """
+        should_quote = False
+        sent = 0
+        quoted_msg_id = message.get("MsgId", "")
+        quoted_wxid = message.get("SenderWxid", "")
+        quoted_content = message.get("Content", "")
 
-                        if i < len(paragraphs) - 1:  # 如果不是最后一段
-                            await asyncio.sleep(0.5)  # 添加0.5秒延迟
+        # 尝试获取引用消息的发送者昵称
+        try:
+            quoted_nickname = await self.get_nickname(bot, quoted_wxid) or "未知用户"
+        except:
+            quoted_nickname = "未知用户"
+
+        # 如果有消息ID且内容不是太长，使用引用回复
+        if quote_first and quoted_msg_id and quoted_wxid and quoted_content and len(quoted_content) <= 100:
+            should_quote = True
+            logger.info(f"将使用普通消息引用回复，引用MsgId={quoted_msg_id}")
+
+        to_wxid = message["FromWxid"]
+        quote = {"quoted_msg_id": quoted_msg_id, "quoted_wxid": quoted_wxid, "quoted_nickname": quoted_nickname,
+                 "quoted_content": quoted_content[:100]}  # 截断过长的引用内容
+        messages = []
+        for i, paragraph in enumerate(paragraphs):
+            if paragraph.strip():
+                logger.debug(f"发送第 {i + 1}/{len(paragraphs)} 段消息，长度: {len(paragraph.strip())} 字符")
+                has_csrs = '@@@CSRS@@@' in paragraph
+                paragraph = paragraph.replace('@@@CSRS@@@', '').strip()
 
-        # 处理所有找到的链接
-        for filename, url in matches:
+                if message["IsGroup"]:
+                    # 只对第一段使用引用回复
+                    if should_quote and i == 0:
+                        messages.append(OutboundMessage(to_wxid, paragraph, QUOTE, quote=quote))
+                    else:
+                        messages.append(OutboundMessage(to_wxid, paragraph, AT, [message["SenderWxid"]]))
+                    # 群聊判断如果CSRS标记，则@人工座席微信
+                    if has_csrs:
+                        logger.debug(f'发现@CSRS标记，正在获取csrs')
+                        groups_config = self.groupid_to_groupsconfig.get(to_wxid, {})
+                        members = await self.get_chatroom_members(bot, to_wxid)
+                        csrs = [member['UserName'] for member in members
+                                if member.get('UserName') in groups_config.csrs]
+                        if len(csrs) > 0:
+                            logger.debug(f'找到csrs: {csrs}，并@csrs。')
+                            messages.append(OutboundMessage(to_wxid, '', AT, csrs, coalesce=False))
+                else:
+                    if should_quote and i == 0:
+                        messages.append(OutboundMessage(to_wxid, paragraph, QUOTE, quote=quote,
+                                                        prefix=self.reply_title))
+                    else:
+                        messages.append(OutboundMessage(to_wxid, paragraph, prefix=self.reply_title))
+                sent += 1
+
+        # 相邻的短段落合并为一条消息，先写入发件箱，再经发送队列按会话限速发送
+        messages = self.outbound.prepare(messages)
+        if not messages:
+            return sent
+        key = Outbox.key(to_wxid, quoted_msg_id, seq) if self.outbox else None
+        if key:
             try:
-                # 如果URL是相对路径,添加base_url
-                if url.startswith('/files') or url.startswith('./files'):
-                    # 移除base_url中可能的v1路径
-                    base_url = model.base_url.replace('/v1', '')
-                    if url.startswith('./'):
-                        url = url[1:]  # 移除开头的点
-                    url = f"{base_url}{url}"
+                if not await self.outbox.journal(key, messages):
+                    logger.info(f"回复 {key} 已在发件箱中，跳过重复发送")
+                    return sent
+            except Exception as e:
+                logger.error(f"写入发件箱失败，直接发送: {e}")
+                key = None
+        await self.outbound.send(messages, functools.partial(self.deliver_message, bot, key=key),
+                                 stop_on_error=key is not None)
+        return sent
 
-                logger.info(f"[文件处理] 开始下载文件: {filename}, URL: {url}")
+    async def deliver_message(self, bot: WechatAPIClient, item: OutboundMessage, key: str = None):
+        """发送队列中的一条消息，key 不为空时在发件箱中记录发送进度
 
-                # 设置请求头
-                headers = {"Authorization": f"Bearer {model.api_key}"}
+        只有发送成功才推进进度；发送失败或被取消时记录保持未完成，下次启动时从这条消息开始重发
+        """
+        content = item.prefix + item.content
+        if item.kind == QUOTE:
+            await self.send_quote_message(bot, item.to_wxid, content, **item.quote)
+        elif item.kind == AT:
+            await bot.send_at_message(item.to_wxid, content, item.at_list)
+        else:
+            await bot.send_text_message(item.to_wxid, content)
+        if key:
+            try:
+                await self.outbox.advance(key)
+            except Exception as e:
+                logger.error(f"更新发件箱进度失败: {e}")
 
-                # 下载文件
-                async with aiohttp.ClientSession() as session:
-                    # 正确的方式是在请求时设置代理，而不是在创建会话时
-                    proxy = self.http_proxy if self.http_proxy else None
-                    async with session.get(url, headers=headers, proxy=proxy) as resp:
-                        if resp.status == 200:
-                            # 获取内容类型
-                            content_type = resp.headers.get('Content-Type', '')
-                            logger.info(f"[文件处理] 下载成功: 状态码={resp.status}, 内容类型={content_type}")
-
-                            # 读取文件内容
-                            file_content = await resp.read()
-                            logger.info(f"[文件处理] 文件大小: {len(file_content)} 字节")
-
-                            # 保存一份用于调试
-                            # debug_file = f"debug_file_{int(time.time())}_{os.path.basename(url)}"
-                            # try:
-                            #     with open(debug_file, "wb") as f:
-                            #         f.write(file_content)
-                            #     logger.info(f"[文件处理] 已保存调试文件: {debug_file}")
-                            # except Exception as save_error:
-                            #     logger.error(f"[文件处理] 保存调试文件失败: {save_error}")
-
-                            # 根据内容类型或文件扩展名确定文件类型
-                            file_type = None
-
-                            # 首先尝试使用文件内容检测类型
-                            kind = filetype.guess(file_content)
-                            if kind:
-                                file_type = kind.mime
-                                ext = kind.extension
-                                logger.info(f"[文件处理] 通过内容检测到文件类型: {file_type}, 扩展名: {ext}")
-                            else:
-                                # 尝试从Content-Type头获取
-                                if content_type and content_type != 'application/octet-stream':
-                                    file_type = content_type
-                                    ext = mimetypes.guess_extension(content_type)
-                                    if ext:
-                                        ext = ext.lstrip('.')
-                                    else:
-                                        ext = ""
-                                    logger.info(f"[文件处理] 从Content-Type获取文件类型: {file_type}, 扩展名: {ext}")
-                                else:
-                                    # 尝试从文件名获取扩展名
-                                    ext = os.path.splitext(filename)[1].lower().lstrip('.')
-                                    if not ext and '.' in url:
-                                        ext = os.path.splitext(url)[1].lower().lstrip('.')
-
-                                    if ext:
-                                        file_type = mimetypes.guess_type(f"file.{ext}")[0]
-                                        logger.info(f"[文件处理] 从文件名获取类型: {file_type}, 扩展名: {ext}")
-                                    else:
-                                        # 无法确定类型
-                                        file_type = 'application/octet-stream'
-                                        ext = 'bin'
-                                        logger.warning(f"[文件处理] 无法确定文件类型，使用默认值: {file_type}")
+    async def replay_outbox(self, bot: WechatAPIClient):
+        """重启后继续发送发件箱中未发送完的回复"""
+        self.outbox_replayed = True
+        try:
+            pending = await self.outbox.pending()
+        except Exception as e:
+            logger.error(f"读取发件箱失败: {e}")
+            return
+        if not pending:
+            return
+        logger.info(f"发件箱中有 {len(pending)} 批回复未发送完，继续发送")
+        await asyncio.gather(*(self.outbound.send(messages, functools.partial(self.deliver_message, bot, key=key),
+                                                  stop_on_error=True)
+                               for key, messages in pending))
 
-                            # 创建临时目录用于处理文件
-                            temp_dir = os.path.join(os.getcwd(), "temp")
-                            os.makedirs(temp_dir, exist_ok=True)
-                            temp_filename = os.path.join(temp_dir, f"{int(time.time())}_{filename}")
+    async def send_stream_segments(self, bot: WechatAPIClient, message: dict, segments: list[str], sent: int,
+                                   links: list, renderer: ReplyRenderer = None) -> int:
+        """
+        发送流式回复中已经完成的片段
 
-                            try:
-                                # 保存临时文件
-                                with open(temp_filename, "wb") as f:
-                                    f.write(file_content)
-                                logger.debug(f"[文件处理] 已保存临时文件: {temp_filename}")
-
-                                # 根据文件类型发送不同类型的消息
-                                if file_type and (
-                                        file_type.startswith('audio/') or ext in ('wav', 'mp3', 'ogg', 'm4a', 'amr')):
-                                    # 音频文件
-                                    logger.info(f"[文件处理] 检测到音频文件，发送语音消息")
-
-                                    # 对于音频文件，可能需要转换格式
-                                    try:
-                                        # 检查是否有ffmpeg
-                                        if shutil.which("ffmpeg"):
-                                            # 转换为mp3格式，这是微信支持较好的格式
-                                            mp3_file = f"{temp_filename}.mp3"
-                                            command = f'ffmpeg -y -i "{temp_filename}" -acodec libmp3lame -ar 44100 -ab 192k "{mp3_file}"'
-                                            logger.debug(f"[文件处理] 执行音频转换命令: {command}")
-
-                                            process = subprocess.run(command, shell=True, check=True,
-                                                                     capture_output=True, text=True)
-                                            if process.returncode == 0:
-                                                logger.info(f"[文件处理] 音频转换成功: {mp3_file}")
-
-                                                # 读取转换后的文件
-                                                with open(mp3_file, "rb") as f:
-                                                    converted_audio = f.read()
-
-                                                # 发送转换后的音频
-                                                await bot.send_voice_message(message["FromWxid"], voice=converted_audio,
-                                                                             format="mp3")
-                                                logger.info(f"[文件处理] 发送转换后的语音消息成功")
-
-                                                # 删除转换后的文件
-                                                try:
-                                                    os.remove(mp3_file)
-                                                    logger.debug(f"[文件处理] 已删除转换后的音频文件: {mp3_file}")
-                                                except Exception as del_error:
-                                                    logger.debug(f"[文件处理] 删除转换后的音频文件失败: {del_error}")
-                                            else:
-                                                logger.warning(f"[文件处理] 音频转换失败: {process.stderr}")
-                                                # 尝试直接发送原始音频
-                                                await bot.send_voice_message(message["FromWxid"], voice=file_content,
-                                                                             format=ext or 'mp3')
-                                                logger.info(f"[文件处理] 发送原始语音消息成功")
-                                        else:
-                                            logger.warning("[文件处理] 未找到ffmpeg，直接发送原始音频")
-                                            await bot.send_voice_message(message["FromWxid"], voice=file_content,
-                                                                         format=ext or 'mp3')
-                                            logger.info(f"[文件处理] 发送原始语音消息成功")
-                                    except Exception as audio_error:
-                                        logger.error(f"[文件处理] 处理音频文件失败: {audio_error}")
-                                        logger.error(traceback.format_exc())
-                                        # 尝试直接发送原始音频
-                                        await bot.send_voice_message(message["FromWxid"], voice=file_content,
-                                                                     format=ext or 'mp3')
-                                        logger.info(f"[文件处理] 尝试直接发送原始语音消息")
-
-                                elif file_type and (file_type.startswith('image/') or ext in (
-                                        'jpg', 'jpeg', 'png', 'gif', 'bmp', 'webp', 'svg')):
-                                    # 图片文件
-                                    logger.info(f"[文件处理] 检测到图片文件，发送图片消息")
-                                    await bot.send_image_message(message["FromWxid"], file_content)
-                                    logger.info(f"[文件处理] 发送图片消息成功")
-
-                                elif file_type and (file_type.startswith('video/') or ext in (
-                                        'mp4', 'avi', 'mov', 'mkv', 'flv', 'webm')):
-                                    # 视频文件
-                                    logger.info(f"[文件处理] 检测到视频文件，发送视频消息")
-                                    await bot.send_video_message(message["FromWxid"], video=file_content, image="None")
-                                    logger.info(f"[文件处理] 发送视频消息成功")
+        Args:
+            segments: StreamChunker 输出的片段（已过滤思考标签）
+            sent: 之前已发送的段数，为0时首段使用引用回复
+            links: 收集片段中的文件链接，流结束后统一发送
+            renderer: 同一回复共用的Markdown转换器
 
-                                else:
-                                    # 其他类型文件，855,Mac暂不做处理
-                                    logger.info(f"[文件处理] 检测到其他类型文件: {file_type}，855/Mac暂不处理")
-                                    # logger.info(f"[文件处理] 检测到其他类型文件: {file_type}，发送文件中")
-                                    # file_info = await bot.upload_file(file_content)
-                                    # logger.debug(f"文件上传成功: {file_info}")
-                                    # media_id = file_info.get('mediaId')
-                                    # total_len = file_info.get('totalLen', len(file_content))
-                                    # file_extension = os.path.splitext(filename)[1][1:]
-                                    # logger.info(f"文件信息: mediaId={media_id}, totalLen={total_len}")
-                                    #
-                                    # xml = f"""<appmsg appid="" sdkver="0">
-                                    #     <title>{filename}</title>
-                                    #     <des></des>
-                                    #     <action></action>
-                                    #     <type>6</type>
-                                    #     <showtype>0</showtype>
-                                    #     <content></content>
-                                    #     <url></url>
-                                    #     <appattach>
-                                    #         <totallen>{total_len}</totallen>
-                                    #         <attachid>{media_id}</attachid>
-                                    #         <fileext>{file_extension}</fileext>
-                                    #     </appattach>
-                                    #     <md5></md5>
-                                    # </appmsg>"""
-                                    #
-                                    # # 发送文件消息
-                                    # logger.debug(f"开始发送文件消息: {filename}")
-                                    # result = await bot.send_cdn_file_msg(message["FromWxid"], xml)
-                                    # logger.debug(f"文件消息发送结果: {result}")
-
-                            except Exception as e:
-                                logger.error(f"[文件处理] 处理文件失败: {e}")
-                                logger.error(traceback.format_exc())
+        Returns:
+            int: 累计发送的段数
+        """
+        for segment in segments:
+            text, matches = self.clean_reply_text(segment, renderer)
+            links.extend(matches)
+            if text.strip():
+                sent += await self.send_reply_paragraphs(bot, message, [text], quote_first=sent == 0, seq=sent)
+        return sent
+
+    async def send_reply_links(self, bot: WechatAPIClient, message: dict, matches: list, model: ModelConfig):
+        """下载并发送回复中的文件链接
+
+        所有链接并发下载（同时下载数受 media-fetch-concurrency 限制），按链接在回复中的顺序发送，
+        前面的文件下载完成后立即发送，不等待后面的下载。
+        """
+        if not matches:
+            return
+        # 相对路径的文件在生成回复的端点上
+        endpoint = await self.select_endpoint(model, message["FromWxid"])
+        semaphore = asyncio.Semaphore(self.media_fetch_concurrency)
 
-                            finally:
-                                # 无论成功与否，都删除临时文件
-                                try:
-                                    if os.path.exists(temp_filename):
-                                        os.remove(temp_filename)
-                                        logger.debug(f"[文件处理] 已删除临时文件: {temp_filename}")
-                                except Exception as del_error:
-                                    logger.debug(f"[文件处理] 删除临时文件失败: {del_error}")
-                        else:
-                            error_text = await resp.text()
-                            logger.error(f"[文件处理] 下载失败: 状态码={resp.status}, 错误={error_text}")
-            except Exception as e:
-                logger.error(f"[文件处理] 处理文件链接失败: {e}")
-                logger.error(traceback.format_exc())
+        async def fetch(filename, url):
+            async with semaphore:
+                return await self.fetch_reply_link(filename, url, endpoint)
+
+        tasks = [asyncio.create_task(fetch(filename, url)) for filename, url in matches]
+        try:
+            for (filename, url), task in zip(matches, tasks):
+                media = await task
+                if media:
+                    await self.send_reply_media(bot, message, filename, *media)
+        finally:
+            # 发送过程被取消时不再继续下载
+            for task in tasks:
+                task.cancel()
+
+    async def fetch_reply_link(self, filename: str, url: str,
+                               endpoint: Endpoint) -> Optional[tuple[bytes, str, str]]:
+        """
+        下载回复中的文件链接并根据内容识别类型
+
+        Returns:
+            (文件内容, MIME类型, 扩展名)，下载失败返回 None
+        """
+        try:
+            # 如果URL是相对路径,添加base_url
+            if url.startswith('/files') or url.startswith('./files'):
+                # 移除base_url中可能的v1路径
+                base_url = endpoint.base_url.replace('/v1', '')
+                if url.startswith('./'):
+                    url = url[1:]  # 移除开头的点
+                url = f"{base_url}{url}"
+
+            logger.info(f"[文件处理] 开始下载文件: {filename}, URL: {url}")
+
+            # 设置请求头
+            headers = {"Authorization": f"Bearer {endpoint.api_key}"}
+
+            # 下载文件
+            # 正确的方式是在请求时设置代理，而不是在创建会话时
+            proxy = self.http_proxy if self.http_proxy else None
+            async with self.http_pool.session(proxy=proxy) as session:
+                async with session.get(url, headers=headers, proxy=proxy) as resp:
+                    if resp.status != 200:
+                        error_text = await resp.text()
+                        logger.error(f"[文件处理] 下载失败: 状态码={resp.status}, 错误={error_text}")
+                        return None
+                    # 获取内容类型
+                    content_type = resp.headers.get('Content-Type', '')
+                    logger.info(f"[文件处理] 下载成功: 状态码={resp.status}, 内容类型={content_type}")
+
+                    # 读取文件内容
+                    file_content = await resp.read()
+                    logger.info(f"[文件处理] 文件大小: {len(file_content)} 字节")
+        except Exception as e:
+            logger.error(f"[文件处理] 处理文件链接失败: {e}")
+            logger.error(traceback.format_exc())
+            return None
 
-        # 处理可能的其他格式链接 - 由于我们已经处理了标准格式的链接，这部分可以简化
-        other_pattern = r'!?\]\((https?:\/\/[^\s\)]+)\)'
-        other_links = re.findall(other_pattern, text)
-        if other_links:
-            logger.debug(f"[文件处理] 发现其他格式链接: {other_links}")
-            # 不再处理这些链接，因为主要的链接已经在前面处理过了
+        # 根据内容类型或文件扩展名确定文件类型
+        # 首先尝试使用文件内容检测类型
+        kind = filetype.guess(file_content)
+        if kind:
+            file_type = kind.mime
+            ext = kind.extension
+            logger.info(f"[文件处理] 通过内容检测到文件类型: {file_type}, 扩展名: {ext}")
+        elif content_type and content_type != 'application/octet-stream':
+            # 尝试从Content-Type头获取
+            file_type = content_type
+            ext = (mimetypes.guess_extension(content_type) or "").lstrip('.')
+            logger.info(f"[文件处理] 从Content-Type获取文件类型: {file_type}, 扩展名: {ext}")
+        else:
+            # 尝试从文件名获取扩展名
+            ext = os.path.splitext(filename)[1].lower().lstrip('.')
+            if not ext and '.' in url:
+                ext = os.path.splitext(url)[1].lower().lstrip('.')
+
+            if ext:
+                file_type = mimetypes.guess_type(f"file.{ext}")[0]
+                logger.info(f"[文件处理] 从文件名获取类型: {file_type}, 扩展名: {ext}")
+            else:
+                # 无法确定类型
+                file_type = 'application/octet-stream'
+                ext = 'bin'
+                logger.warning(f"[文件处理] 无法确定文件类型，使用默认值: {file_type}")
+        return file_content, file_type, ext
+
+    async def send_reply_media(self, bot: WechatAPIClient, message: dict, filename: str, file_content: bytes,
+                               file_type: str, ext: str):
+        """根据文件类型发送语音、图片或视频消息"""
+        try:
+            if file_type and (file_type.startswith('audio/') or ext in ('wav', 'mp3', 'ogg', 'm4a', 'amr')):
+                # 音频文件
+                logger.info(f"[文件处理] 检测到音频文件，发送语音消息")
 
-        # 识别普通文件链接 - 简化处理
-        file_pattern = r'https?://[^\s<>"]+?/[^\s<>"]+\.(?:pdf|doc|docx|xls|xlsx|txt|zip|rar|7z|tar|gz)'
-        file_links = re.findall(file_pattern, text)
-        if file_links:
-            logger.debug(f"[文件处理] 发现普通文件链接: {file_links}")
-            # 不再处理这些链接，因为主要的链接已经在前面处理过了
+                # 对于音频文件，可能需要转换格式
+                try:
+                    # 检查是否有ffmpeg
+                    if self.transcoder.available:
+                        # 转换为mp3格式，这是微信支持较好的格式
+                        try:
+                            converted_audio = await self.transcoder.transcode(
+                                file_content,
+                                ["-acodec", "libmp3lame", "-ar", "44100", "-ab", "192k", "-f", "mp3"])
+                        except TranscodeError as transcode_error:
+                            logger.warning(f"[文件处理] 音频转换失败: {transcode_error}")
+                            # 尝试直接发送原始音频
+                            await bot.send_voice_message(message["FromWxid"], voice=file_content, format=ext or 'mp3')
+                            logger.info(f"[文件处理] 发送原始语音消息成功")
+                        else:
+                            logger.info(f"[文件处理] 音频转换成功，大小: {len(converted_audio)} 字节")
+                            # 发送转换后的音频
+                            await bot.send_voice_message(message["FromWxid"], voice=converted_audio, format="mp3")
+                            logger.info(f"[文件处理] 发送转换后的语音消息成功")
+                    else:
+                        logger.warning("[文件处理] 未找到ffmpeg，直接发送原始音频")
+                        await bot.send_voice_message(message["FromWxid"], voice=file_content, format=ext or 'mp3')
+                        logger.info(f"[文件处理] 发送原始语音消息成功")
+                except Exception as audio_error:
+                    logger.error(f"[文件处理] 处理音频文件失败: {audio_error}")
+                    logger.error(traceback.format_exc())
+                    # 尝试直接发送原始音频
+                    await bot.send_voice_message(message["FromWxid"], voice=file_content, format=ext or 'mp3')
+                    logger.info(f"[文件处理] 尝试直接发送原始语音消息")
+
+            elif file_type and (file_type.startswith('image/') or ext in (
+                    'jpg', 'jpeg', 'png', 'gif', 'bmp', 'webp', 'svg')):
+                # 图片文件
+                logger.info(f"[文件处理] 检测到图片文件，发送图片消息")
+                await bot.send_image_message(message["FromWxid"], file_content)
+                logger.info(f"[文件处理] 发送图片消息成功")
+
+            elif file_type and (file_type.startswith('video/') or ext in (
+                    'mp4', 'avi', 'mov', 'mkv', 'flv', 'webm')):
+                # 视频文件
+                logger.info(f"[文件处理] 检测到视频文件，发送视频消息")
+                await bot.send_video_message(message["FromWxid"], video=file_content, image="None")
+                logger.info(f"[文件处理] 发送视频消息成功")
 
-        pattern = r'\$\$[^$$]+\]\$\$https?:\/\/[^\s$$]+\)'
-        text = re.sub(pattern, '', text)
+            else:
+                # 其他类型文件，855,Mac暂不做处理
+                logger.info(f"[文件处理] 检测到其他类型文件: {filename}({file_type})，855/Mac暂不处理")
+                # logger.info(f"[文件处理] 检测到其他类型文件: {file_type}，发送文件中")
+                # file_info = await bot.upload_file(file_content)
+                # logger.debug(f"文件上传成功: {file_info}")
+                # media_id = file_info.get('mediaId')
+                # total_len = file_info.get('totalLen', len(file_content))
+                # file_extension = os.path.splitext(filename)[1][1:]
+                # logger.info(f"文件信息: mediaId={media_id}, totalLen={total_len}")
+                #
+                # xml = f"""<appmsg appid="" sdkver="0">
+                #     <title>{filename}</title>
+                #     <des></des>
+                #     <action></action>
+                #     <type>6</type>
+                #     <showtype>0</showtype>
+                #     <content></content>
+                #     <url></url>
+                #     <appattach>
+                #         <totallen>{total_len}</totallen>
+                #         <attachid>{media_id}</attachid>
+                #         <fileext>{file_extension}</fileext>
+                #     </appattach>
+                #     <md5></md5>
+                # </appmsg>"""
+                #
+                # # 发送文件消息
+                # logger.debug(f"开始发送文件消息: {filename}")
+                # result = await bot.send_cdn_file_msg(message["FromWxid"], xml)
+                # logger.debug(f"文件消息发送结果: {result}")
+
+        except Exception as e:
+            logger.error(f"[文件处理] 处理文件失败: {e}")
+            logger.error(traceback.format_exc())
 
     async def dify_handle_image(self, bot: WechatAPIClient, message: dict, image: Union[str, bytes], model_config=None):
         try:
@@ -2305,9 +2308,9 @@ class DifyPlus(PluginBase):
             if isinstance(image, str) and image.startswith("http"):
                 try:
                     logger.info(f"从URL下载图片: {image}")
-                    async with aiohttp.ClientSession() as session:
-                        # 正确的方式是在请求时设置代理，而不是在创建会话时
-                        proxy = self.http_proxy if self.http_proxy and self.http_proxy.strip() else None
+                    # 正确的方式是在请求时设置代理，而不是在创建会话时
+                    proxy = self.http_proxy if self.http_proxy and self.http_proxy.strip() else None
+                    async with self.http_pool.session(proxy=proxy) as session:
                         async with session.get(image, proxy=proxy) as resp:
                             if resp.status == 200:
                                 image_content = await resp.read()
@@ -2364,41 +2367,12 @@ class DifyPlus(PluginBase):
                 await bot.send_text_message(message["FromWxid"], "图片内容为空，无法发送")
                 return
 
-            # 验证图片数据
+            # 尺寸过大时缩小，在图片处理进程中执行
             try:
-                # 允许加载截断的图片
-                from PIL import ImageFile
-                ImageFile.LOAD_TRUNCATED_IMAGES = True
-
-                # 验证图片数据
-                img = Image.open(io.BytesIO(image_content))
-                logger.info(f"图片验证成功，格式: {img.format}, 大小: {img.size}, 模式: {img.mode}")
-
-                # 检查图片大小，如果太大则调整大小
-                width, height = img.size
-                max_dimension = 1600  # 最大尺寸限制
-
-                if width > max_dimension or height > max_dimension:
-                    # 计算缩放比例
-                    ratio = min(max_dimension / width, max_dimension / height)
-                    new_width = int(width * ratio)
-                    new_height = int(height * ratio)
-                    logger.info(f"图片尺寸过大，调整大小从 {width}x{height} 到 {new_width}x{new_height}")
-                    img = img.resize((new_width, new_height), Image.LANCZOS)
-
-                    # 转换为RGB模式(去除alpha通道)
-                    if img.mode in ('RGBA', 'LA'):
-                        logger.debug(f"图片包含alpha通道，转换为RGB模式")
-                        background = Image.new('RGB', img.size, (255, 255, 255))
-                        background.paste(img, mask=img.split()[-1])
-                        img = background
-
-                    # 保存为JPEG
-                    output = io.BytesIO()
-                    img.save(output, format='JPEG', quality=95, optimize=True)
-                    output.seek(0)
-                    image_content = output.getvalue()
-                    logger.info(f"图片处理成功，新大小: {len(image_content)} 字节")
+                resized_content = await self.image_processor.shrink_for_send(image_content)
+                if resized_content:
+                    image_content = resized_content
+                    logger.info(f"图片尺寸过大已缩小，新大小: {len(image_content)} 字节")
             except Exception as e:
                 logger.error(f"图片验证或处理失败: {e}")
                 logger.error(traceback.format_exc())
@@ -2430,6 +2404,12 @@ class DifyPlus(PluginBase):
         output = XYBOT_PREFIX + "🙅检测到服务异常，请稍后再试。"
         await bot.send_text_message(message["FromWxid"], output)
 
+    async def handle_circuit_open(self, bot: WechatAPIClient, message: dict, model_config=None):
+        model = model_config or self.current_model
+        retry_after = min(self.endpoint_health.retry_after(endpoint.base_url) for endpoint in model.endpoints)
+        output = XYBOT_PREFIX + f"🙅{model.name}智能体服务暂时不可用，请{max(1, round(retry_after))}秒后再试。"
+        await bot.send_text_message(message["FromWxid"], output)
+
     @staticmethod
     async def handle_other_status(bot: WechatAPIClient, message: dict, resp: aiohttp.ClientResponse):
         ai_resp = (XYBOT_PREFIX +
@@ -2447,70 +2427,71 @@ class DifyPlus(PluginBase):
         await bot.send_text_message(message["FromWxid"], output)
 
     async def audio_to_text(self, bot: WechatAPIClient, message: dict) -> str:
-        if not shutil.which("ffmpeg"):
+        if not self.transcoder.available:
             logger.error("未找到ffmpeg，请安装并配置到环境变量")
             await bot.send_text_message(message["FromWxid"], "服务器缺少ffmpeg，无法处理语音")
             return ""
 
-        silk_file = "temp_audio.silk"
-        mp3_file = "temp_audio.mp3"
         try:
-            with open(silk_file, "wb") as f:
-                f.write(message["Content"])
+            mp3_data = await self.transcoder.transcode(message["Content"], ["-ar", "16000", "-ac", "1", "-f", "mp3"])
 
-            command = f"ffmpeg -y -i {silk_file} -ar 16000 -ac 1 -f mp3 {mp3_file}"
-            process = subprocess.run(command, shell=True, check=True, capture_output=True, text=True)
-            if process.returncode != 0:
-                logger.error(f"ffmpeg 执行失败: {process.stderr}")
-                return ""
-
-            # 使用当前智能体的 base-url 构建音频转文本 URL
+            # 使用当前智能体在该会话的端点构建音频转文本 URL
             model = self.get_user_model(message["SenderWxid"])
-            audio_to_text_url = f"{model.base_url}/audio-to-text"
+            endpoint = await self.select_endpoint(model, message["FromWxid"])
+            audio_to_text_url = f"{endpoint.base_url}/audio-to-text"
             logger.debug(f"使用音频转文本 URL: {audio_to_text_url}")
 
-            headers = {"Authorization": f"Bearer {model.api_key}"}
-            formdata = aiohttp.FormData()
-            with open(mp3_file, "rb") as f:
-                mp3_data = f.read()
-            formdata.add_field("file", mp3_data, filename="audio.mp3", content_type="audio/mp3")
+            headers = {"Authorization": f"Bearer {endpoint.api_key}"}
             # 对于群聊消息，使用群聊ID作为user参数，这样对话会与群聊关联，而不是与个人关联
             user_id = message["FromWxid"] if message.get("IsGroup", False) else message["SenderWxid"]
-            formdata.add_field("user", user_id)
-            async with aiohttp.ClientSession() as session:
-                # 正确的方式是在请求时设置代理，而不是在创建会话时
-                proxy = self.http_proxy if self.http_proxy and self.http_proxy.strip() else None
-                async with session.post(audio_to_text_url, headers=headers, data=formdata, proxy=proxy) as resp:
-                    if resp.status == 200:
-                        result = await resp.json()
-                        text = result.get("text", "")
-                        if "failed" in text.lower() or "code" in text.lower():
-                            logger.error(f"Dify API 返回错误: {text}")
-                        else:
-                            logger.info(f"语音转文字结果 (Dify API): {text}")
-                            return text
-                    else:
-                        logger.error(f"audio-to-text 接口调用失败: {resp.status} - {await resp.text()})")
-
-            command = f"ffmpeg -y -i {mp3_file} {silk_file.replace('.silk', '.wav')}"
-            process = subprocess.run(command, shell=True, check=True, capture_output=True, text=True)
-            if process.returncode != 0:
-                logger.error(f"ffmpeg 转为 WAV 失败: {process.stderr}")
-                return ""
-
-            r = sr.Recognizer()
-            with sr.AudioFile(silk_file.replace('.silk', '.wav')) as source:
-                audio = r.record(source)
-            text = r.recognize_google(audio, language="zh-CN")
+            # 正确的方式是在请求时设置代理，而不是在创建会话时
+            proxy = self.http_proxy if self.http_proxy and self.http_proxy.strip() else None
+            retry = self.retry_policy.begin("Dify语音转文字")
+            while True:
+                # FormData只能发送一次，每次尝试重新构建
+                formdata = aiohttp.FormData()
+                formdata.add_field("file", mp3_data, filename="audio.mp3", content_type="audio/mp3")
+                formdata.add_field("user", user_id)
+                try:
+                    # 语音识别与对话共享智能体的并发名额
+                    async with self.admission.slot(model.name), \
+                            self.endpoint_health.call(endpoint.base_url) as endpoint_call, \
+                            self.http_pool.session(endpoint.base_url, proxy) as session:
+                        async with session.post(audio_to_text_url, headers=headers, data=formdata, proxy=proxy) as resp:
+                            endpoint_call.finish(resp.status < 500)
+                            delay = retry.on_status(resp.status, resp.headers)
+                            if delay is None:
+                                if resp.status == 200:
+                                    result = await resp.json()
+                                    text = result.get("text", "")
+                                    if "failed" in text.lower() or "code" in text.lower():
+                                        logger.error(f"Dify API 返回错误: {text}")
+                                    else:
+                                        logger.info(f"语音转文字结果 (Dify API): {text}")
+                                        return text
+                                else:
+                                    logger.error(f"audio-to-text 接口调用失败: {resp.status} - {await resp.text()})")
+                                break
+                except aiohttp.ClientConnectorError as e:
+                    delay = retry.on_error(e)
+                    if delay is None:
+                        raise
+                await asyncio.sleep(delay)
+
+            # 转为16位单声道PCM，直接交给语音识别，不再经过WAV文件
+            pcm_data = await self.transcoder.transcode(mp3_data, ["-ar", "16000", "-ac", "1", "-f", "s16le"])
+            audio = sr.AudioData(pcm_data, 16000, 2)
+            text = await asyncio.to_thread(sr.Recognizer().recognize_google, audio, language="zh-CN")
             logger.info(f"语音转文字结果 (Google): {text}")
             return text
+        except TranscodeError as e:
+            logger.error(f"ffmpeg 执行失败: {e}")
+            return ""
+        except AdmissionRejected:
+            raise
         except Exception as e:
             logger.error(f"语音处理失败: {e}")
             return ""
-        finally:
-            for temp_file in [silk_file, mp3_file, silk_file.replace('.silk', '.wav')]:
-                if os.path.exists(temp_file):
-                    os.remove(temp_file)
 
     async def text_to_voice_message(self, bot: WechatAPIClient, message: dict, text: str = None,
                                     message_id: str = None):
@@ -2524,12 +2505,13 @@ class DifyPlus(PluginBase):
             message_id: Dify生成的消息ID（可选，优先级高于text）
         """
         try:
-            # 使用当前智能体的 base-url 构建文本转音频 URL
+            # 使用当前智能体在该会话的端点构建文本转音频 URL，message_id 只在生成它的端点上有效
             model = self.get_user_model(message["SenderWxid"])
-            text_to_audio_url = f"{model.base_url}/text-to-audio"
+            endpoint = await self.select_endpoint(model, message["FromWxid"])
+            text_to_audio_url = f"{endpoint.base_url}/text-to-audio"
             logger.debug(f"使用文本转音频 URL: {text_to_audio_url}")
 
-            headers = {"Authorization": f"Bearer {model.api_key}", "Content-Type": "application/json"}
+            headers = {"Authorization": f"Bearer {endpoint.api_key}", "Content-Type": "application/json"}
             # 构建请求数据，支持message_id参数
             data = {"user": message["SenderWxid"]}
 
@@ -2546,19 +2528,36 @@ class DifyPlus(PluginBase):
                 await bot.send_text_message(message["FromWxid"], f"{TEXT_TO_VOICE_FAILED}: 未提供文本内容或消息ID")
                 return
 
-            async with aiohttp.ClientSession() as session:
-                # 正确的方式是在请求时设置代理，而不是在创建会话时
-                proxy = self.http_proxy if self.http_proxy else None
-                async with session.post(text_to_audio_url, headers=headers, json=data, proxy=proxy) as resp:
-                    if resp.status == 200:
-                        audio = await resp.read()
-                        await bot.send_voice_message(message["FromWxid"], voice=audio, format="mp3")
-                        logger.info(f"文本转语音成功，{'使用message_id' if message_id else '使用text'}")
-                    else:
-                        error_text = await resp.text()
-                        logger.error(f"text-to-audio 接口调用失败: {resp.status} - {error_text}")
-                        await bot.send_text_message(message["FromWxid"],
-                                                    f"{TEXT_TO_VOICE_FAILED}: 状态码 {resp.status}")
+            # 正确的方式是在请求时设置代理，而不是在创建会话时
+            proxy = self.http_proxy if self.http_proxy else None
+            retry = self.retry_policy.begin("Dify文本转语音")
+            while True:
+                try:
+                    # 语音合成与对话共享智能体的并发名额，在Dify请求内部合成时不重复占用
+                    async with self.admission.slot(model.name), \
+                            self.endpoint_health.call(endpoint.base_url) as endpoint_call, \
+                            self.http_pool.session(endpoint.base_url, proxy) as session:
+                        async with session.post(text_to_audio_url, headers=headers, json=data, proxy=proxy) as resp:
+                            endpoint_call.finish(resp.status < 500)
+                            delay = retry.on_status(resp.status, resp.headers)
+                            if delay is None:
+                                if resp.status == 200:
+                                    audio = await resp.read()
+                                    await bot.send_voice_message(message["FromWxid"], voice=audio, format="mp3")
+                                    logger.info(f"文本转语音成功，{'使用message_id' if message_id else '使用text'}")
+                                else:
+                                    error_text = await resp.text()
+                                    logger.error(f"text-to-audio 接口调用失败: {resp.status} - {error_text}")
+                                    await bot.send_text_message(message["FromWxid"],
+                                                                f"{TEXT_TO_VOICE_FAILED}: 状态码 {resp.status}")
+                                return
+                except aiohttp.ClientConnectorError as e:
+                    delay = retry.on_error(e)
+                    if delay is None:
+                        raise
+                await asyncio.sleep(delay)
+        except AdmissionRejected as e:
+            await self.reply_busy(bot, message, e)
         except Exception as e:
             logger.error(f"text-to-audio 接口调用异常: {e}")
             logger.error(traceback.format_exc())
@@ -2731,19 +2730,15 @@ class DifyPlus(PluginBase):
             # 如果成功获取图片内容，则缓存
             if image_content:
                 # 缓存图片到发送者和收件人的ID
-                self.image_cache[sender_wxid] = {
-                    "content": image_content,
-                    "timestamp": time.time()
-                }
-                logger.info(f"已缓存用户 {sender_wxid} 的图片")
+                if self.media_cache.put(("image", sender_wxid), image_content, len(image_content),
+                                        self.image_cache_timeout):
+                    logger.info(f"已缓存用户 {sender_wxid} 的图片")
 
                 # 如果是私聊，也缓存到聊天对象的ID
                 if from_wxid != sender_wxid:
-                    self.image_cache[from_wxid] = {
-                        "content": image_content,
-                        "timestamp": time.time()
-                    }
-                    logger.info(f"已缓存聊天对象 {from_wxid} 的图片")
+                    if self.media_cache.put(("image", from_wxid), image_content, len(image_content),
+                                            self.image_cache_timeout):
+                        logger.info(f"已缓存聊天对象 {from_wxid} 的图片")
             else:
                 logger.warning(f"未能获取图片内容，无法缓存")
             logger.info('<<<[handle_image]')
@@ -2755,46 +2750,40 @@ class DifyPlus(PluginBase):
     async def get_cached_image(self, user_wxid: str) -> Optional[bytes]:
         """获取用户最近的图片"""
         logger.debug(f"尝试获取用户 {user_wxid} 的缓存图片")
-        if user_wxid in self.image_cache:
-            cache_data = self.image_cache[user_wxid]
-            current_time = time.time()
-            cache_age = current_time - cache_data["timestamp"]
-            logger.info(f"找到缓存图片，年龄: {cache_age:.2f}秒, 超时时间: {self.image_cache_timeout}秒")
+        key = ("image", user_wxid)
+        cache_age = self.media_cache.age(key)
+        # 读取时会刷新访问时间，避免过早超时；不再删除缓存，而是在上传成功后删除
+        image_content = self.media_cache.get(key)
+        if image_content is None:
+            if cache_age is not None:
+                logger.info(f"缓存图片超时，已清除")
+            else:
+                logger.debug(f"未找到用户 {user_wxid} 的缓存图片")
+            return None
 
-            if cache_age <= self.image_cache_timeout:
-                try:
-                    # 确保我们有有效的二进制数据
-                    image_content = cache_data["content"]
-                    if not isinstance(image_content, bytes):
-                        logger.error("缓存的图片内容不是二进制格式")
-                        del self.image_cache[user_wxid]
-                        return None
+        logger.info(f"找到缓存图片，年龄: {cache_age:.2f}秒, 超时时间: {self.image_cache_timeout}秒")
+        try:
+            # 确保我们有有效的二进制数据
+            if not isinstance(image_content, bytes):
+                logger.error("缓存的图片内容不是二进制格式")
+                self.media_cache.pop(key)
+                return None
 
-                    # 尝试验证图片数据
-                    try:
-                        img = Image.open(io.BytesIO(image_content))
-                        logger.debug(f"缓存图片验证成功，格式: {img.format}, 大小: {len(image_content)} 字节")
-                    except Exception as e:
-                        logger.error(f"缓存的图片数据无效: {e}")
-                        del self.image_cache[user_wxid]
-                        return None
+            # 尝试验证图片数据
+            try:
+                img = Image.open(io.BytesIO(image_content))
+                logger.debug(f"缓存图片验证成功，格式: {img.format}, 大小: {len(image_content)} 字节")
+            except Exception as e:
+                logger.error(f"缓存的图片数据无效: {e}")
+                self.media_cache.pop(key)
+                return None
 
-                    # 不再删除缓存，而是在上传成功后删除
-                    # 更新时间戳，避免过早超时
-                    self.image_cache[user_wxid]["timestamp"] = current_time
-                    logger.info(f"成功获取用户 {user_wxid} 的缓存图片")
-                    return image_content
-                except Exception as e:
-                    logger.error(f"处理缓存图片失败: {e}")
-                    del self.image_cache[user_wxid]
-                    return None
-            else:
-                # 超时清除
-                logger.info(f"缓存图片超时，已清除")
-                del self.image_cache[user_wxid]
-        else:
-            logger.debug(f"未找到用户 {user_wxid} 的缓存图片")
-        return None
+            logger.info(f"成功获取用户 {user_wxid} 的缓存图片")
+            return image_content
+        except Exception as e:
+            logger.error(f"处理缓存图片失败: {e}")
+            self.media_cache.pop(key)
+            return None
 
     def _get_image_extension(self, image_data):
         """根据图片数据判断文件扩展名"""
@@ -2841,66 +2830,55 @@ class DifyPlus(PluginBase):
     async def get_cached_file(self, user_wxid: str) -> Optional[tuple[bytes, str, str]]:
         """获取用户最近的文件，返回 (文件内容, 文件名, MIME类型)"""
         logger.debug(f"尝试获取用户 {user_wxid} 的缓存文件")
-        if user_wxid in self.file_cache:
-            cache_data = self.file_cache[user_wxid]
-            current_time = time.time()
-            cache_age = current_time - cache_data["timestamp"]
-            logger.debug(f"找到缓存文件，年龄: {cache_age:.2f}秒, 超时时间: {self.file_cache_timeout}秒")
+        key = ("file", user_wxid)
+        cache_age = self.media_cache.age(key)
+        # 读取时会刷新访问时间，避免过早超时
+        cache_data = self.media_cache.get(key)
+        if cache_data is None:
+            if cache_age is not None:
+                logger.debug(f"缓存文件超时，已清除")
+            else:
+                logger.debug(f"未找到用户 {user_wxid} 的缓存文件")
+            return None
 
-            if cache_age <= self.file_cache_timeout:
+        logger.debug(f"找到缓存文件，年龄: {cache_age:.2f}秒, 超时时间: {self.file_cache_timeout}秒")
+        try:
+            file_content, file_name, mime_type = cache_data
+
+            # 处理不同类型的文件内容
+            if isinstance(file_content, bytearray):
+                # 将 bytearray 转换为 bytes
+                file_content = bytes(file_content)
+                logger.info(f"将 bytearray 转换为 bytes，大小: {len(file_content)} 字节")
+            elif isinstance(file_content, str):
+                # 尝试将字符串解析为 base64
                 try:
-                    # 确保我们有有效的二进制数据
-                    file_content = cache_data["content"]
-                    file_name = cache_data["name"]
-                    mime_type = cache_data["mime_type"]
-
-                    # 处理不同类型的文件内容
-                    if isinstance(file_content, bytearray):
-                        # 将 bytearray 转换为 bytes
-                        file_content = bytes(file_content)
-                        logger.info(f"将 bytearray 转换为 bytes，大小: {len(file_content)} 字节")
-                    elif isinstance(file_content, str):
-                        # 尝试将字符串解析为 base64
-                        try:
-                            file_content = base64.b64decode(file_content)
-                            logger.info(f"将 base64 字符串转换为 bytes，大小: {len(file_content)} 字节")
-                        except Exception as e:
-                            logger.error(f"Base64 解码失败: {e}")
-                            file_content = file_content.encode('utf-8')
-                            logger.info(f"将普通字符串转换为 bytes，大小: {len(file_content)} 字节")
-                    elif not isinstance(file_content, bytes):
-                        logger.error(f"缓存的文件内容不是支持的格式: {type(file_content)}")
-                        del self.file_cache[user_wxid]
-                        return None
-
-                    # 更新缓存中的文件内容
-                    self.file_cache[user_wxid]["content"] = file_content
-
-                    # 更新时间戳，避免过早超时
-                    self.file_cache[user_wxid]["timestamp"] = current_time
-                    logger.info(f"成功获取用户 {user_wxid} 的缓存文件: {file_name}, 大小: {len(file_content)} 字节")
-                    return (file_content, file_name, mime_type)
+                    file_content = base64.b64decode(file_content)
+                    logger.info(f"将 base64 字符串转换为 bytes，大小: {len(file_content)} 字节")
                 except Exception as e:
-                    logger.error(f"处理缓存文件失败: {e}")
-                    del self.file_cache[user_wxid]
-                    return None
-            else:
-                # 超时清除
-                logger.debug(f"缓存文件超时，已清除")
-                del self.file_cache[user_wxid]
-        else:
-            logger.debug(f"未找到用户 {user_wxid} 的缓存文件")
-        return None
+                    logger.error(f"Base64 解码失败: {e}")
+                    file_content = file_content.encode('utf-8')
+                    logger.info(f"将普通字符串转换为 bytes，大小: {len(file_content)} 字节")
+            elif not isinstance(file_content, bytes):
+                logger.error(f"缓存的文件内容不是支持的格式: {type(file_content)}")
+                self.media_cache.pop(key)
+                return None
+
+            if file_content is not cache_data[0]:
+                # 更新缓存中的文件内容
+                self.cache_file(user_wxid, file_content, file_name, mime_type)
+            logger.info(f"成功获取用户 {user_wxid} 的缓存文件: {file_name}, 大小: {len(file_content)} 字节")
+            return (file_content, file_name, mime_type)
+        except Exception as e:
+            logger.error(f"处理缓存文件失败: {e}")
+            self.media_cache.pop(key)
+            return None
 
     def cache_file(self, user_wxid: str, file_content: bytes, file_name: str, mime_type: str) -> None:
         """缓存用户文件"""
-        self.file_cache[user_wxid] = {
-            "content": file_content,
-            "name": file_name,
-            "mime_type": mime_type,
-            "timestamp": time.time()
-        }
-        logger.info(f"已缓存用户 {user_wxid} 的文件: {file_name}, 大小: {len(file_content)} 字节")
+        if self.media_cache.put(("file", user_wxid), (file_content, file_name, mime_type), len(file_content),
+                                self.file_cache_timeout):
+            logger.info(f"已缓存用户 {user_wxid} 的文件: {file_name}, 大小: {len(file_content)} 字节")
 
     async def save_file_by_md5(self, md5filename: str, file_data: bytes):
         try:
@@ -3055,23 +3033,8 @@ class DifyPlus(PluginBase):
             content = message.get("Content", "")
             logger.info(f"XML引用消息内容: {content[:50]}...")
 
-            # 直接检查消息内容中是否包含@机器人
-            is_at_bot = False
-            for robot_name in self.robot_names:
-                if f"@{robot_name}" in content:
-                    logger.info(f"XML引用消息内容中直接发现@{robot_name}")
-                    is_at_bot = True
-                    break
-
-                # 检查格式: "@小球子"（消息开头）
-                if content.startswith(f'@{robot_name}'):
-                    logger.info(f"XML引用消息内容以@{robot_name}开头")
-                    is_at_bot = True
-                    break
-
-            # 如果直接检查没有发现@，使用增强的is_at_message方法
-            if not is_at_bot:
-                is_at_bot = self.is_at_message(message)
+            # 检查消息内容或引用内容中是否@了机器人
+            is_at_bot = self.is_at_message(message)
 
             if is_at_bot:
                 logger.info("Dify: XML引用消息中@了机器人，处理该消息")
@@ -3116,122 +3079,14 @@ class DifyPlus(PluginBase):
         return True
 
     async def download_file_process(self, bot: WechatAPIClient, app_id, attach_id, total_len):
-        # 使用 /Tools/DownloadFile API 下载文件
+        # 使用 /Tools/DownloadFile API 并发分段下载文件
         logger.info("[download_file_process]")
 
-        logger.info("开始下载文件...")
-        # 分段下载大文件
-        # 每次下载 64KB
-        chunk_size = 64 * 1024  # 64KB
-
-        # 创建一个字节数组来存储完整的文件数据
-        file_data = bytearray()
-
-        # 计算需要下载的分段数量
-        chunks = (total_len + chunk_size - 1) // chunk_size  # 向上取整
-
-        logger.info(f"开始分段下载文件，总大小: {total_len} 字节，分 {chunks} 段下载")
-
-        # 尝试两个不同的API端点
-        urls = [
-            f'http://127.0.0.1:9011/api/Tools/DownloadFile',
-            f'http://127.0.0.1:9011/VXAPI/Tools/DownloadFile'
-        ]
-
-        download_success = False
-
-        for url in urls:
-            if download_success:
-                break
-
-            file_data.clear()  # 清空之前的数据
-            logger.info(f"尝试使用 {url} 下载文件")
-
-            # 分段下载
-            for i in range(chunks):
-                start_pos = i * chunk_size
-                # 最后一段可能不足 chunk_size
-                current_chunk_size = min(chunk_size, total_len - start_pos)
-
-                logger.info(
-                    f"下载第 {i + 1}/{chunks} 段，起始位置: {start_pos}，大小: {current_chunk_size} 字节")
-
-                async with aiohttp.ClientSession() as session:
-                    # 设置较长的超时时间
-                    timeout = aiohttp.ClientTimeout(total=60)  # 1分钟
-
-                    # 构造请求参数
-                    json_param = {
-                        "AppID": app_id,
-                        "AttachId": attach_id,
-                        "DataLen": total_len,
-                        "Section": {
-                            "DataLen": current_chunk_size,
-                            "StartPos": start_pos
-                        },
-                        "UserName": "",  # 可选参数
-                        "Wxid": bot.wxid
-                    }
-
-                    logger.info(
-                        f"调用下载文件API: AttachId={attach_id}, 起始位置: {start_pos}, 大小: {current_chunk_size}")
-                    response = await session.post(
-                        url,
-                        json=json_param,
-                        timeout=timeout
-                    )
-
-                    # 处理响应
-                    try:
-                        json_resp = await response.json()
-
-                        if json_resp.get("Success"):
-                            data = json_resp.get("Data")
-
-                            # 尝试从不同的响应格式中获取文件数据
-                            chunk_data = None
-                            if isinstance(data, dict):
-                                if "buffer" in data:
-                                    chunk_data = base64.b64decode(data["buffer"])
-                                elif "data" in data and isinstance(data["data"], dict) and "buffer" in data[
-                                    "data"]:
-                                    chunk_data = base64.b64decode(data["data"]["buffer"])
-                                else:
-                                    try:
-                                        chunk_data = base64.b64decode(str(data))
-                                    except:
-                                        logger.error(f"无法解析文件数据: {data}")
-                            elif isinstance(data, str):
-                                try:
-                                    chunk_data = base64.b64decode(data)
-                                except:
-                                    logger.error(f"无法解析文件数据字符串")
-
-                            if chunk_data:
-                                # 将分段数据添加到完整文件中
-                                file_data.extend(chunk_data)
-                                logger.info(
-                                    f"第 {i + 1}/{chunks} 段下载成功，大小: {len(chunk_data)} 字节")
-                            else:
-                                logger.warning(f"第 {i + 1}/{chunks} 段数据为空")
-                                break
-                        else:
-                            error_msg = json_resp.get("Message", "Unknown error")
-                            logger.error(f"第 {i + 1}/{chunks} 段下载失败: {error_msg}")
-                            break
-                    except Exception as e:
-                        logger.error(f"解析第 {i + 1}/{chunks} 段响应失败: {e}")
-                        break
-
-            # 检查文件是否下载完整
-            if len(file_data) > 0:
-                logger.info(f"文件下载成功: AttachId={attach_id}, 实际大小: {len(file_data)} 字节")
-                download_success = True
-                break
-            else:
-                logger.warning("文件数据为空，尝试下一个API端点")
-
-        return download_success, file_data
+        file_data = await self.downloader.download(f"http://{bot.ip}:{bot.port}", bot.wxid, attach_id,
+                                                   int(total_len or 0), app_id=app_id)
+        if file_data is None:
+            return False, bytearray()
+        return True, file_data
 
     @on_xml_message(priority=98)  # 使用高优先级确保先处理
     async def handle_xml_file(self, bot: WechatAPIClient, message: dict):
@@ -3463,108 +3318,9 @@ class DifyPlus(PluginBase):
                                         # 方法2: 使用Tools/DownloadFile API分段下载文件
                                         logger.debug(f"尝试使用Tools/DownloadFile API分段下载文件")
 
-                                        # 分段下载大文件
-                                        chunk_size = 64 * 1024  # 64KB
-                                        chunks = (total_len + chunk_size - 1) // chunk_size  # 向上取整
-                                        file_data_bytes = bytearray()
-                                        download_success = False
-
-                                        # 尝试两个不同的API端点
-                                        urls = [
-                                            f'http://{bot.ip}:{bot.port}/api/Tools/DownloadFile',
-                                            f'http://{bot.ip}:{bot.port}/VXAPI/Tools/DownloadFile'
-                                        ]
-
-                                        # 尝试每个API端点
-                                        for url in urls:
-                                            if download_success:
-                                                break
-
-                                            logger.info(
-                                                f"尝试使用 {url} 分段下载文件，总大小: {total_len} 字节，分 {chunks} 段下载")
-                                            file_data_bytes.clear()  # 清空之前的数据
-
-                                            try:
-                                                async with aiohttp.ClientSession() as session:
-                                                    # 分段下载
-                                                    for i in range(chunks):
-                                                        start_pos = i * chunk_size
-                                                        # 最后一段可能不足 chunk_size
-                                                        current_chunk_size = min(chunk_size, total_len - start_pos)
-
-                                                        logger.debug(
-                                                            f"下载第 {i + 1}/{chunks} 段，起始位置: {start_pos}，大小: {current_chunk_size} 字节")
-
-                                                        # 构造请求参数
-                                                        json_param = {
-                                                            "AppID": "",  # 可选参数
-                                                            "AttachId": attach_id,
-                                                            "DataLen": total_len,
-                                                            "Section": {
-                                                                "DataLen": current_chunk_size,
-                                                                "StartPos": start_pos
-                                                            },
-                                                            "UserName": "",  # 可选参数
-                                                            "Wxid": bot.wxid
-                                                        }
-
-                                                        # 设置较长的超时时间
-                                                        timeout = aiohttp.ClientTimeout(total=60)  # 1分钟
-
-                                                        # 发送请求
-                                                        try:
-                                                            async with session.post(url, json=json_param,
-                                                                                    timeout=timeout) as resp:
-                                                                if resp.status == 200:
-                                                                    resp_json = await resp.json()
-                                                                    if resp_json.get("Success"):
-                                                                        data = resp_json.get("Data")
-                                                                        if isinstance(data, str):
-                                                                            try:
-                                                                                chunk_data = base64.b64decode(data)
-                                                                                file_data_bytes.extend(chunk_data)
-                                                                                logger.debug(
-                                                                                    f"第 {i + 1}/{chunks} 段下载成功，大小: {len(chunk_data)} 字节")
-                                                                            except Exception as e:
-                                                                                logger.error(f"Base64解码失败: {e}")
-                                                                                break
-                                                                        elif isinstance(data,
-                                                                                        dict) and "buffer" in data:
-                                                                            try:
-                                                                                chunk_data = base64.b64decode(
-                                                                                    data["buffer"])
-                                                                                file_data_bytes.extend(chunk_data)
-                                                                                logger.debug(
-                                                                                    f"第 {i + 1}/{chunks} 段下载成功，大小: {len(chunk_data)} 字节")
-                                                                            except Exception as e:
-                                                                                logger.error(
-                                                                                    f"Buffer Base64解码失败: {e}")
-                                                                                break
-                                                                        else:
-                                                                            logger.warning(f"无法解析响应数据: {data}")
-                                                                            break
-                                                                    else:
-                                                                        logger.warning(f"API返回错误: {resp_json}")
-                                                                        break
-                                                                else:
-                                                                    logger.warning(f"API请求失败: {resp.status}")
-                                                                    break
-                                                        except Exception as e:
-                                                            logger.error(f"下载第 {i + 1}/{chunks} 段时出错: {e}")
-                                                            break
-
-                                                    # 检查文件是否下载完整
-                                                    if len(file_data_bytes) > 0:
-                                                        logger.info(
-                                                            f"文件分段下载成功，实际大小: {len(file_data_bytes)} 字节")
-                                                        file_data = base64.b64encode(file_data_bytes).decode('utf-8')
-                                                        download_success = True
-                                                        break
-                                                    else:
-                                                        logger.warning(f"文件下载失败，数据为空")
-                                            except Exception as e:
-                                                logger.error(f"尝试使用 {url} 分段下载文件时出错: {e}")
-                                                logger.error(traceback.format_exc())
+                                        file_data = await self.downloader.download(
+                                            f"http://{bot.ip}:{bot.port}", bot.wxid, attach_id, total_len)
+                                        download_success = file_data is not None
 
                                         # 如果所有尝试都失败
                                         if not download_success:
@@ -3576,7 +3332,9 @@ class DifyPlus(PluginBase):
 
                                 if file_data:
                                     # 如果返回的是base64字符串，解码为二进制
-                                    if isinstance(file_data, str):
+                                    if isinstance(file_data, (bytes, bytearray)):
+                                        file_content = bytes(file_data)
+                                    elif isinstance(file_data, str):
                                         try:
                                             file_content = base64.b64decode(file_data)
                                         except Exception as e:
@@ -0,0 +1,131 @@
+import re
+import xml.etree.ElementTree as ET
+from typing import Iterable, Optional, Tuple
+
+from loguru import logger
+
+
+def _alternation(names: Iterable[str], prefix: str = "") -> Optional[re.Pattern]:
+    names = list(names)
+    if not names:
+        return None
+    # 长名称在前，"@机器人助手" 不会被 "@机器人" 截断
+    return re.compile(prefix + "(?:" + "|".join(map(re.escape, names)) + ")", re.IGNORECASE)
+
+
+class MentionMatcher:
+    """群消息@机器人检测
+
+    配置加载时把所有机器人名称编译为一个忽略大小写的正则，每条消息只需一次搜索即可判断是否@了机器人，
+    并用同一结果去掉消息开头的@前缀得到查询内容。机器人昵称是运行时获取的，单独编译并在昵称变化时重建。
+    """
+
+    def __init__(self, robot_names: Iterable[str]):
+        """
+        Args:
+            robot_names: 机器人名称列表（config.toml 中的 robot-names）
+        """
+        names = sorted({name for name in robot_names if name}, key=len, reverse=True)
+        self.robot_names = names
+        self._names = {name.casefold() for name in names}
+        self._at_pattern = _alternation(names, "@")
+        self._name_pattern = _alternation(names)
+        self._nickname = None
+        self._nickname_pattern = None
+
+    def _nickname_at(self, bot_nickname: Optional[str]) -> Optional[re.Pattern]:
+        if bot_nickname != self._nickname:
+            self._nickname = bot_nickname
+            self._nickname_pattern = _alternation([bot_nickname], "@") if bot_nickname else None
+        return self._nickname_pattern
+
+    def find(self, content: str) -> Optional[re.Match]:
+        """查找内容中第一个@机器人名称"""
+        return self._at_pattern.search(content) if self._at_pattern else None
+
+    def is_at(self, message: dict, bot_wxid: str = None, bot_nickname: str = None) -> bool:
+        """检查群消息是否@了机器人，支持普通消息和引用消息"""
+        if not message["IsGroup"]:
+            return False
+        content = message["Content"]
+
+        mention = self.find(content)
+        if mention:
+            logger.debug(f"在消息内容中发现{mention.group()}")
+            return True
+
+        quote = message.get("Quote")
+        msg_type = message.get("MsgType")
+        if quote is not None and content.startswith('@'):
+            # "@小球 xxx" 可能是 "@小球子" 的简写
+            space_index = content.find(' ')
+            if space_index > 0:
+                at_name = content[1:space_index].strip().casefold()
+                if any(name.startswith(at_name) for name in self._names):
+                    logger.info(f"@名称匹配机器人名称: {at_name}")
+                    return True
+
+        if msg_type in (49, 57) or quote is not None:
+            if quote:
+                # 引用了机器人的消息，或引用的消息中@了机器人
+                if quote.get("Nickname", "").casefold() in self._names:
+                    logger.debug(f"引用了机器人 '{quote.get('Nickname')}' 的消息")
+                    return True
+                if self.find(quote.get("Content", "")):
+                    logger.debug("在引用的消息内容中发现@机器人")
+                    return True
+
+            # 引用消息内容中包含机器人名称（不带@符号）
+            if self._name_pattern and self._name_pattern.search(content):
+                logger.debug("在引用消息内容中发现机器人名称")
+                return True
+
+            # 引用消息的标题中@了机器人
+            if "OriginalContent" in message and self._at_pattern:
+                try:
+                    title = ET.fromstring(message.get("OriginalContent", "")).find("appmsg/title")
+                    if title is not None and title.text and self.find(title.text):
+                        logger.debug("在引用消息标题中发现@机器人")
+                        return True
+                except Exception as e:
+                    logger.debug(f"解析引用消息 XML 失败: {e}")
+
+        # 消息的Ats字段是直接的@标记
+        if bot_wxid and message.get("Ats") and bot_wxid in message["Ats"]:
+            logger.debug(f"在Ats字段中发现机器人的wxid: {bot_wxid}")
+            return True
+
+        nickname_pattern = self._nickname_at(bot_nickname) if bot_wxid else None
+        if nickname_pattern and nickname_pattern.search(content):
+            logger.debug(f"在消息中发现@了bot的NickName: @{bot_nickname}")
+            return True
+
+        return False
+
+    def strip(self, content: str, bot_nickname: str = None) -> str:
+        """去掉@机器人部分，返回查询内容"""
+        if not content.startswith('@'):
+            return self._at_pattern.sub("", content).strip() if self._at_pattern else content
+
+        # 先检查是否是@机器人，再检查是否@了bot的昵称
+        prefix = self._at_pattern.match(content) if self._at_pattern else None
+        if prefix is None and self._nickname_at(bot_nickname):
+            prefix = self._nickname_pattern.match(content)
+        if prefix:
+            return content[prefix.end():].strip()
+
+        # @的不是机器人（如Ats字段命中），去掉第一个空格前的@名称
+        space_index = content.find(' ')
+        if space_index > 0:
+            return content[space_index + 1:].strip()
+        return content.lstrip('@ ').strip()
+
+    def match(self, message: dict, content: str, bot_wxid: str = None,
+              bot_nickname: str = None) -> Tuple[bool, str]:
+        """
+        Returns:
+            (True, 去掉@后的查询内容) 或 (False, 原内容)
+        """
+        if self.is_at(message, bot_wxid, bot_nickname):
+            return True, self.strip(content, bot_nickname)
+        return False, content
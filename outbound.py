@@ -0,0 +1,165 @@
+import asyncio
+import time
+from collections import deque
+from dataclasses import dataclass, field
+from typing import Awaitable, Callable, Deque, Dict, List, Optional
+
+from loguru import logger
+
+TEXT = "text"
+AT = "at"
+QUOTE = "quote"
+
+
+@dataclass
+class OutboundMessage:
+    """一条待发送的文本消息"""
+    to_wxid: str
+    content: str
+    kind: str = TEXT  # text: 普通文本, at: @消息, quote: 引用回复
+    at_list: List[str] = field(default_factory=list)
+    quote: Optional[dict] = None  # 引用回复的参数，见 DifyPlus.send_quote_message
+    coalesce: bool = True  # 是否可以与相邻消息合并
+    prefix: str = ""  # 发送时加在内容前的标题，合并后只出现一次
+
+    def can_merge(self, other: "OutboundMessage", max_length: int, separator: str) -> bool:
+        return (self.coalesce and other.coalesce and self.kind == other.kind and self.kind != QUOTE and
+                self.at_list == other.at_list and self.prefix == other.prefix and
+                len(self.prefix) + len(self.content) + len(separator) + len(other.content) <= max_length)
+
+
+def coalesce(messages: List[OutboundMessage], max_length: int, separator: str = "\n\n") -> List[OutboundMessage]:
+    """把相邻的短消息合并为一条，合并后不超过 max_length 个字符；max_length 为0时不合并"""
+    if max_length <= 0:
+        return list(messages)
+    merged: List[OutboundMessage] = []
+    for message in messages:
+        if merged and merged[-1].can_merge(message, max_length, separator):
+            last = merged[-1]
+            merged[-1] = OutboundMessage(last.to_wxid, last.content + separator + message.content, last.kind,
+                                         last.at_list, prefix=last.prefix)
+        else:
+            merged.append(message)
+    return merged
+
+
+class _Batch:
+    def __init__(self, messages: List[OutboundMessage], deliver: Callable[[OutboundMessage], Awaitable],
+                 stop_on_error: bool):
+        self.messages = messages
+        self.deliver = deliver
+        self.stop_on_error = stop_on_error
+        self.future = asyncio.get_running_loop().create_future()
+
+
+class _Destination:
+    def __init__(self):
+        self.batches: Deque[_Batch] = deque()
+        self.pending = 0  # 排队中的消息数
+        self.next_send = 0.0
+        self.worker: Optional[asyncio.Task] = None
+
+
+class OutboundQueue:
+    """按接收方排队发送消息
+
+    每个接收方（群聊或私聊对象）一个发送队列，同一次回复的消息作为一批连续发送，
+    不同回复之间不会交错；同一接收方两次发送之间至少间隔 1/rate 秒，不同接收方并行发送。
+    入队前由 prepare() 把同一批中相邻的短消息合并为一条，合并后不超过 max_length 个字符。
+    """
+
+    def __init__(self, rate: float = 2, max_length: int = 2000, separator: str = "\n\n"):
+        """
+        Args:
+            rate: 每个接收方每秒最多发送的消息数，0表示不限制
+            max_length: 合并后单条消息的最大长度，0表示不合并
+            separator: 合并消息时的分隔符
+        """
+        self.interval = 1 / rate if rate > 0 else 0.0
+        self.max_length = max_length
+        self.separator = separator
+        self._destinations: Dict[str, _Destination] = {}
+        self.sent = 0
+        self.merged = 0
+
+    def depth(self, to_wxid: str) -> int:
+        """接收方排队中的消息数"""
+        destination = self._destinations.get(to_wxid)
+        return destination.pending if destination else 0
+
+    def prepare(self, messages: List[OutboundMessage]) -> List[OutboundMessage]:
+        """合并一批消息中相邻的短消息，返回实际要发送的消息列表"""
+        batch_messages = coalesce(messages, self.max_length, self.separator)
+        self.merged += len(messages) - len(batch_messages)
+        return batch_messages
+
+    async def send(self, messages: List[OutboundMessage], deliver: Callable[[OutboundMessage], Awaitable],
+                   stop_on_error: bool = False) -> int:
+        """
+        把一批发给同一接收方的消息加入队列，等待发送完成
+
+        Args:
+            messages: prepare() 返回的消息列表，按原样依次发送
+            deliver: 实际发送一条消息的协程函数
+            stop_on_error: 一条消息发送失败时是否放弃这批中剩余的消息（由发件箱稍后重发）
+
+        Returns:
+            int: 成功发送的消息数
+        """
+        if not messages:
+            return 0
+        to_wxid = messages[0].to_wxid
+        batch_messages = list(messages)
+        batch = _Batch(batch_messages, deliver, stop_on_error)
+
+        destination = self._destinations.get(to_wxid)
+        if destination is None:
+            destination = self._destinations[to_wxid] = _Destination()
+        destination.batches.append(batch)
+        destination.pending += len(batch_messages)
+        if destination.pending > len(batch_messages):
+            logger.debug(f"发往 {to_wxid} 的消息排队中，队列长度: {destination.pending}")
+        if destination.worker is None:
+            destination.worker = asyncio.create_task(self._run(to_wxid, destination))
+        # 调用方被取消时消息仍然发送完
+        return await asyncio.shield(batch.future)
+
+    async def _run(self, to_wxid: str, destination: _Destination):
+        try:
+            while destination.batches:
+                batch = destination.batches[0]
+                sent = 0
+                for index, message in enumerate(batch.messages):
+                    wait = destination.next_send - time.monotonic()
+                    if wait > 0:
+                        await asyncio.sleep(wait)
+                    try:
+                        await batch.deliver(message)
+                        sent += 1
+                    except Exception as e:
+                        logger.error(f"发送消息到 {to_wxid} 失败: {e}")
+                        if batch.stop_on_error:
+                            skipped = len(batch.messages) - index - 1
+                            destination.pending -= skipped
+                            if skipped:
+                                logger.warning(f"放弃发往 {to_wxid} 的剩余 {skipped} 条消息，等待发件箱重发")
+                            break
+                    finally:
+                        destination.pending -= 1
+                        destination.next_send = time.monotonic() + self.interval
+                self.sent += sent
+                destination.batches.popleft()
+                if not batch.future.done():
+                    batch.future.set_result(sent)
+        finally:
+            # 队列被取消时通知仍在等待的调用方
+            for batch in destination.batches:
+                if not batch.future.done():
+                    batch.future.cancel()
+            if self._destinations.get(to_wxid) is destination:
+                del self._destinations[to_wxid]
+
+    def stats(self) -> dict:
+        return {"destinations": len(self._destinations),
+                "pending": sum(destination.pending for destination in self._destinations.values()),
+                "sent": self.sent, "merged": self.merged}
@@ -0,0 +1,122 @@
+import asyncio
+import json
+import sqlite3
+import threading
+import time
+from dataclasses import asdict
+from typing import List, Optional, Tuple
+
+from loguru import logger
+
+from plugins.DifyPlus.outbound import OutboundMessage
+
+
+class Outbox:
+    """已生成回复的本地发件箱（SQLite）
+
+    每批回复在发送前先写入发件箱，每发送一条消息记录一次进度，全部发送后标记为完成。
+    插件重启后 pending() 返回未发送完的回复，从中断处继续发送，Dify生成的回复不会因重启丢失；
+    写入超过 retention 秒仍未发送完的回复已经过时，不再补发，直接删除。
+    键由收到的消息的MsgId生成，同一个键只会写入一次，重复处理同一条消息时不会重复发送；
+    完成的记录保留 retention 秒后由 purge() 删除。
+    """
+
+    def __init__(self, path: str, retention: float = 86400):
+        """
+        Args:
+            path: SQLite数据库文件路径
+            retention: 已完成记录的保留时间（秒），在此期间同一个键不会再次发送；
+                       未发送完的记录超过这个时间不再补发
+        """
+        self.path = path
+        self.retention = retention
+        # 只重发本次启动之前写入的记录，本进程正在发送的回复不会被重复发送
+        self.opened = time.time()
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS outbox ("
+            "key TEXT PRIMARY KEY, to_wxid TEXT NOT NULL, messages TEXT NOT NULL, "
+            "total INTEGER NOT NULL, delivered INTEGER NOT NULL DEFAULT 0, "
+            "created REAL NOT NULL, completed REAL)"
+        )
+        self._conn.execute("CREATE INDEX IF NOT EXISTS outbox_completed ON outbox (completed)")
+
+    def _journal(self, key: str, messages: List[OutboundMessage]) -> bool:
+        data = json.dumps([asdict(message) for message in messages], ensure_ascii=False)
+        with self._lock:
+            cursor = self._conn.execute(
+                "INSERT OR IGNORE INTO outbox (key, to_wxid, messages, total, created) VALUES (?, ?, ?, ?, ?)",
+                (key, messages[0].to_wxid, data, len(messages), time.time()))
+            return cursor.rowcount == 1
+
+    def _advance(self, key: str):
+        with self._lock:
+            self._conn.execute(
+                "UPDATE outbox SET delivered = delivered + 1, "
+                "completed = CASE WHEN delivered + 1 >= total THEN ? ELSE completed END WHERE key = ?",
+                (time.time(), key))
+
+    def _cutoff(self) -> float:
+        return time.time() - self.retention
+
+    def _pending(self) -> List[Tuple[str, List[OutboundMessage]]]:
+        cutoff = self._cutoff()
+        with self._lock:
+            expired = self._conn.execute(
+                "SELECT key, to_wxid, total - delivered FROM outbox "
+                "WHERE completed IS NULL AND created < ?", (min(cutoff, self.opened),)).fetchall()
+            if expired:
+                self._conn.execute("DELETE FROM outbox WHERE completed IS NULL AND created < ?",
+                                   (min(cutoff, self.opened),))
+            rows = self._conn.execute(
+                "SELECT key, messages, delivered FROM outbox WHERE completed IS NULL AND created < ? ORDER BY created",
+                (self.opened,)).fetchall()
+        for key, to_wxid, remaining in expired:
+            logger.warning(f"发件箱记录 {key} 已超过 {self.retention} 秒，放弃补发发往 {to_wxid} 的 {remaining} 条消息")
+        pending = []
+        for key, data, delivered in rows:
+            try:
+                messages = [OutboundMessage(**item) for item in json.loads(data)]
+            except (TypeError, ValueError) as e:
+                logger.error(f"发件箱记录 {key} 无法解析，已跳过: {e}")
+                continue
+            pending.append((key, messages[delivered:]))
+        return pending
+
+    def _purge(self) -> int:
+        with self._lock:
+            cursor = self._conn.execute("DELETE FROM outbox WHERE completed < ?", (self._cutoff(),))
+            return cursor.rowcount
+
+    async def journal(self, key: str, messages: List[OutboundMessage]) -> bool:
+        """
+        在发送前记录一批消息
+
+        Returns:
+            bool: 是否为新记录；为假表示这个键已经记录过（已发送或等待重发），不应再次发送
+        """
+        return await asyncio.to_thread(self._journal, key, messages)
+
+    async def advance(self, key: str):
+        """记录一条消息已发送成功，发送失败的消息不调用，记录保持未完成以便重发"""
+        await asyncio.to_thread(self._advance, key)
+
+    async def pending(self) -> List[Tuple[str, List[OutboundMessage]]]:
+        """按写入顺序返回本次启动前未发送完、且未超过保留时间的记录 [(键, 剩余消息), ...]"""
+        return await asyncio.to_thread(self._pending)
+
+    async def purge(self) -> int:
+        """删除超过保留时间的已完成记录，返回删除的记录数"""
+        return await asyncio.to_thread(self._purge)
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
+
+    @staticmethod
+    def key(to_wxid: str, msg_id, seq: int = 0) -> Optional[str]:
+        """由接收方、收到的消息的MsgId和回复中的批次序号生成键，没有MsgId时返回 None"""
+        return f"{to_wxid}:{msg_id}:{seq}" if msg_id else None
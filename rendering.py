@@ -0,0 +1,81 @@
+import re
+from typing import List, Tuple
+
+from loguru import logger
+
+# 行：内容 + 换行符（最后一行可能没有换行符）
+_LINE = re.compile(r'([^\r\n]*)(\r\n|\r|\n|$)')
+# Markdown链接和图片 [文件名](URL)、![文件名](URL)
+_LINK = re.compile(r'!?\[(.*?)\]\((.*?)\)')
+# 只由标点组成的行（分隔线、表格分隔行、孤立的强调符号等）
+_PUNCTUATION_LINE = re.compile(r'[\u2000-\u206F\u2E00-\u2E7F\'!"#$%&()*+,\-./:;<=>?@[\]^_`{|}~]+')
+# 行首的引用、标题和列表标记
+_LINE_PREFIX = re.compile(r'(?:> )?(?:#+\s*|[*+\-] )?')
+# 整行的水平线
+_RULE = re.compile(r'(?:> )?[-*_]{3,}\s*')
+# 行内的粗斜体、粗体、斜体、行内代码，按最左匹配一次替换，代码内容保持原样
+_INLINE = re.compile(r'\*\*\*(.*?)\*\*\*|\*\*(.*?)\*\*|\*(.*?)\*|`(.*?)`')
+_ITALIC = re.compile(r'\*(.*?)\*')
+_FENCE = "```"
+
+
+def _inline_text(match: re.Match) -> str:
+    if match.group(2) is not None:
+        # 粗体中的斜体
+        return _ITALIC.sub(r'\1', match.group(2))
+    return next(group for group in match.groups() if group is not None)
+
+
+class ReplyRenderer:
+    """把Dify返回的Markdown转换为微信纯文本，并提取其中的文件链接
+
+    逐行处理一遍：代码块内的内容原样保留（只去掉 ``` 围栏行），其他行提取并移除链接、
+    去掉只由标点组成的行、行首的引用/标题/列表标记和行内的粗体/斜体/代码标记。
+    每行只做固定次数的匹配，耗时与回复长度成正比。
+    代码块状态在多次 render() 之间保留，流式发送时同一回复的各个片段使用同一个实例。
+    """
+
+    def __init__(self):
+        self.in_fence = False
+
+    def render(self, text: str) -> Tuple[str, List[Tuple[str, str]]]:
+        """
+        Returns:
+            tuple: (处理后的文本, [(文件名, URL), ...])
+        """
+        output = []
+        links = []
+        for line, newline in _LINE.findall(text):
+            if line.lstrip().startswith(_FENCE):
+                self.in_fence = not self.in_fence
+                continue
+            if self.in_fence:
+                output.append(line + newline)
+                continue
+
+            if "](" in line:
+                line_links = _LINK.findall(line)
+                if line_links:
+                    links.extend(line_links)
+                    # 移除所有链接文本，以免重复显示
+                    line = _LINK.sub('', line)
+            if newline and _PUNCTUATION_LINE.fullmatch(line):
+                continue
+            if _RULE.fullmatch(line):
+                line = ""
+            else:
+                line = line[_LINE_PREFIX.match(line).end():]
+            if '*' in line or '`' in line:
+                line = _INLINE.sub(_inline_text, line)
+            output.append(line + newline)
+
+        if links:
+            logger.info(f"[文件处理] 在回复中找到 {len(links)} 个文件链接")
+            for i, (filename, url) in enumerate(links):
+                logger.info(f"[文件处理] 链接 {i + 1}: 文件名='{filename}', URL='{url}'")
+        return "".join(output), links
+
+
+def render_reply(text: str) -> Tuple[str, List[Tuple[str, str]]]:
+    """转换一段完整的回复，见 ReplyRenderer"""
+    return ReplyRenderer().render(text)
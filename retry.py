@@ -0,0 +1,99 @@
+import random
+import time
+from datetime import datetime, timezone
+from email.utils import parsedate_to_datetime
+from typing import Iterable, Mapping, Optional
+
+from loguru import logger
+
+
+def parse_retry_after(headers: Optional[Mapping[str, str]]) -> Optional[float]:
+    """解析 Retry-After 响应头（秒数或HTTP日期），没有或无法解析时返回 None"""
+    value = (headers or {}).get("Retry-After")
+    if not value:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        when = parsedate_to_datetime(value)
+    except (TypeError, ValueError):
+        return None
+    if when.tzinfo is None:
+        when = when.replace(tzinfo=timezone.utc)
+    return max(0.0, (when - datetime.now(timezone.utc)).total_seconds())
+
+
+class RetryPolicy:
+    """Dify调用的重试策略
+
+    只重试 retry_statuses 中的状态码（默认 429 和网关错误）以及连接失败（请求未发出），
+    每次调用最多尝试 max_attempts 次，两次尝试之间按指数退避并加入随机抖动，
+    服务端返回 Retry-After 时至少等待该时间；等待后会超过总期限 deadline 时不再重试。
+    """
+
+    def __init__(self, max_attempts: int = 3, base_delay: float = 0.5, max_delay: float = 8, deadline: float = 60,
+                 retry_statuses: Iterable[int] = (429, 502, 503, 504)):
+        """
+        Args:
+            max_attempts: 最多尝试次数（包含第一次）
+            base_delay: 第一次重试前的退避上限（秒），之后每次翻倍
+            max_delay: 单次退避上限（秒）
+            deadline: 从第一次尝试开始的总期限（秒）
+            retry_statuses: 可重试的HTTP状态码
+        """
+        self.max_attempts = max(1, max_attempts)
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.deadline = deadline
+        self.retry_statuses = frozenset(retry_statuses)
+
+    def begin(self, name: str) -> "Retry":
+        """开始一次调用的重试计数，name 用于日志"""
+        return Retry(self, name)
+
+
+class Retry:
+    """一次调用的重试状态，由 RetryPolicy.begin() 创建"""
+
+    def __init__(self, policy: RetryPolicy, name: str):
+        self.policy = policy
+        self.name = name
+        self.attempt = 1
+        self.deadline = time.monotonic() + policy.deadline
+
+    def delay(self, retry_after: Optional[float] = None) -> Optional[float]:
+        """
+        消耗一次重试机会并计算等待时间
+
+        Returns:
+            下次尝试前应等待的秒数；次数已用完或等待后会超过期限时返回 None
+        """
+        policy = self.policy
+        if self.attempt >= policy.max_attempts:
+            return None
+        # 完全抖动：在 [0, 退避上限] 内随机，避免大量请求同时重试
+        delay = random.uniform(0, min(policy.max_delay, policy.base_delay * 2 ** (self.attempt - 1)))
+        if retry_after is not None:
+            delay = max(delay, retry_after)
+        if time.monotonic() + delay > self.deadline:
+            return None
+        self.attempt += 1
+        return delay
+
+    def on_status(self, status: int, headers: Optional[Mapping[str, str]] = None) -> Optional[float]:
+        """响应状态码可重试且还有重试机会时返回等待时间，否则返回 None"""
+        if status not in self.policy.retry_statuses:
+            return None
+        delay = self.delay(parse_retry_after(headers))
+        if delay is not None:
+            logger.warning(f"{self.name}返回 HTTP {status}，{delay:.1f}秒后第{self.attempt}次尝试")
+        return delay
+
+    def on_error(self, error: Exception) -> Optional[float]:
+        """连接失败且还有重试机会时返回等待时间，否则返回 None"""
+        delay = self.delay()
+        if delay is not None:
+            logger.warning(f"{self.name}连接失败: {error}，{delay:.1f}秒后第{self.attempt}次尝试")
+        return delay
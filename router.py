@@ -0,0 +1,153 @@
+from collections import deque
+from typing import Dict, Iterable, List, Mapping, NamedTuple, Optional, Tuple
+
+
+class AhoCorasick:
+    """多模式匹配自动机，一次扫描找出文本中所有模式的出现位置"""
+
+    def __init__(self, patterns: Iterable[str]):
+        self.patterns: List[str] = []
+        self._goto: List[Dict[str, int]] = [{}]
+        self._fail: List[int] = [0]
+        self._output: List[List[int]] = [[]]
+        for pattern in patterns:
+            if pattern and pattern not in self.patterns:
+                self._add(pattern)
+        self._build()
+
+    def _add(self, pattern: str):
+        node = 0
+        for ch in pattern:
+            nxt = self._goto[node].get(ch)
+            if nxt is None:
+                nxt = len(self._goto)
+                self._goto[node][ch] = nxt
+                self._goto.append({})
+                self._fail.append(0)
+                self._output.append([])
+            node = nxt
+        self._output[node].append(len(self.patterns))
+        self.patterns.append(pattern)
+
+    def _build(self):
+        queue = deque(self._goto[0].values())
+        while queue:
+            node = queue.popleft()
+            for ch, nxt in self._goto[node].items():
+                queue.append(nxt)
+                fail = self._fail[node]
+                while fail and ch not in self._goto[fail]:
+                    fail = self._fail[fail]
+                self._fail[nxt] = self._goto[fail].get(ch, 0)
+                self._output[nxt] = self._output[nxt] + self._output[self._fail[nxt]]
+
+    def iter(self, text: str):
+        """依次产出 (起始位置, 模式)"""
+        node = 0
+        for i, ch in enumerate(text):
+            while node and ch not in self._goto[node]:
+                node = self._fail[node]
+            node = self._goto[node].get(ch, 0)
+            for index in self._output[node]:
+                pattern = self.patterns[index]
+                yield i - len(pattern) + 1, pattern
+
+
+class Route(NamedTuple):
+    model_name: str
+    query: str
+    is_switch: bool
+    word: str  # 命中的触发词或唤醒词
+
+
+class ModelRouter:
+    """触发词/唤醒词路由索引，配置加载时构建一次
+
+    把所有触发词和唤醒词（小写）编译进一个 Aho-Corasick 自动机，并预先计算每个群聊允许的智能体集合，
+    每条消息只需扫描一次。匹配优先级与 get_model_from_message 原有的逐个检查顺序一致：
+    切换命令 > 唤醒词 > 触发词，同一步骤内按配置文件中智能体和词的顺序。
+    """
+
+    def __init__(self, models: Mapping[str, object], group_models: Mapping[str, Iterable[str]]):
+        """
+        Args:
+            models: 智能体名称 -> 智能体配置（需要有 trigger_words 和 wakeup_words）
+            group_models: 群聊ID -> 该群聊允许的智能体名称
+        """
+        # 小写模式 -> [(配置顺序, 原始词, 智能体名称)]，唤醒词共享时对应多个智能体
+        self._trigger_index: Dict[str, List[Tuple[int, str, str]]] = {}
+        self._wakeup_index: Dict[str, List[Tuple[int, str, List[str]]]] = {}
+        wakeup_models: Dict[str, List[str]] = {}
+        priority = 0
+        for model_name, model_config in models.items():
+            for trigger in model_config.trigger_words:
+                if trigger:
+                    self._trigger_index.setdefault(trigger.lower(), []).append((priority, trigger, model_name))
+                    priority += 1
+            for wakeup_word in model_config.wakeup_words:
+                if wakeup_word:
+                    wakeup_models.setdefault(wakeup_word, []).append(model_name)
+        for priority, (wakeup_word, model_names) in enumerate(wakeup_models.items()):
+            self._wakeup_index.setdefault(wakeup_word.lower(), []).append((priority, wakeup_word, model_names))
+
+        self._automaton = AhoCorasick(list(self._trigger_index) + list(self._wakeup_index))
+        self._allowed: Dict[str, frozenset] = {
+            group_id: frozenset(name for name in names if name in models)
+            for group_id, names in group_models.items()
+        }
+
+    def is_allowed(self, group_id: Optional[str], model_name: str) -> bool:
+        """智能体是否可用于该群聊，私聊不受限制"""
+        if group_id is None:
+            return True
+        return model_name in self._allowed.get(group_id, ())
+
+    def _scan(self, content: str) -> Dict[str, Tuple[int, int]]:
+        """扫描一次小写内容，返回 模式 -> (首次出现位置, 首次出现在开头或空格之后的位置，没有则为-1)"""
+        hits: Dict[str, Tuple[int, int]] = {}
+        for pos, pattern in self._automaton.iter(content):
+            first, spaced = hits.get(pattern, (pos, -1))
+            if spaced < 0 and (pos == 0 or content[pos - 1] == " "):
+                spaced = pos
+            hits[pattern] = (first, spaced)
+        return hits
+
+    def route(self, content: str, group_id: Optional[str] = None) -> Optional[Route]:
+        """
+        根据消息内容选择智能体
+
+        Returns:
+            Route: 命中切换命令、唤醒词或触发词时返回，否则返回 None（使用用户默认智能体）
+        """
+        original_content = content
+        content = content.lower()
+        hits = self._scan(content)
+        if not hits:
+            return None
+
+        # 1. 切换命令：以触发词开头并以"切换"结尾
+        if content.endswith("切换"):
+            candidates = sorted(entry for pattern, (first, _) in hits.items() if first == 0
+                                for entry in self._trigger_index.get(pattern, ()))
+            for _, trigger, model_name in candidates:
+                if self.is_allowed(group_id, model_name):
+                    return Route(model_name, original_content, True, trigger)
+
+        # 2. 唤醒词：在开头或空格之后出现
+        candidates = sorted((entry[0], pos, entry) for pattern, (_, pos) in hits.items() if pos >= 0
+                            for entry in self._wakeup_index.get(pattern, ()))
+        for _, pos, (_, wakeup_word, model_names) in candidates:
+            model_name = next((name for name in model_names if self.is_allowed(group_id, name)), None)
+            if model_name is None:
+                continue  # 没有可用智能体
+            original_wakeup = original_content[pos:pos + len(wakeup_word.lower())]
+            query = original_content.replace(original_wakeup, "", 1).strip()
+            return Route(model_name, query, False, wakeup_word)
+
+        # 3. 触发词：出现在任意位置
+        candidates = sorted(entry for pattern in hits for entry in self._trigger_index.get(pattern, ()))
+        for _, trigger, model_name in candidates:
+            if self.is_allowed(group_id, model_name):
+                query = original_content.replace(trigger, "", 1).strip()
+                return Route(model_name, query, False, trigger)
+        return None
@@ -0,0 +1,181 @@
+import asyncio
+import contextvars
+import time
+from contextlib import asynccontextmanager
+from typing import Awaitable, Callable, Dict, Hashable, Mapping, Optional, Tuple
+
+from loguru import logger
+
+
+class ConversationScheduler:
+    """按会话串行执行Dify请求
+
+    同一会话（群聊或私聊对象）的请求按到达顺序依次执行，避免并发请求读到同一个会话ID又各自写回；
+    不同会话之间并行。supersede 为真时，同一用户在同一会话中发送新消息会取消他尚未完成的旧请求。
+    """
+
+    def __init__(self, supersede: bool = False):
+        """
+        Args:
+            supersede: 是否用新消息取消同一用户在同一会话中的旧请求
+        """
+        self.supersede = supersede
+        self._locks: Dict[Hashable, asyncio.Lock] = {}
+        self._waiting: Dict[Hashable, int] = {}  # 会话 -> 排队和执行中的请求数，为0时回收锁
+        self._latest: Dict[Tuple[Hashable, Hashable], asyncio.Task] = {}
+
+    def pending(self, key: Hashable) -> int:
+        """会话中排队和执行中的请求数"""
+        return self._waiting.get(key, 0)
+
+    async def run(self, key: Hashable, owner: Hashable, func: Callable[..., Awaitable], *args, **kwargs):
+        """
+        在会话 key 中排队执行 func(*args, **kwargs)
+
+        Args:
+            key: 会话键
+            owner: 发起请求的用户，用于取消同一用户的旧请求
+
+        Returns:
+            func 的返回值，被新请求取代时返回 None
+        """
+        previous = self._latest.get((key, owner))
+        if self.supersede and previous is not None and not previous.done():
+            logger.info(f"会话 {key} 中 {owner} 发送了新消息，取消旧请求")
+            previous.cancel()
+
+        task = asyncio.create_task(self._run_serialized(key, func, *args, **kwargs))
+        self._latest[(key, owner)] = task
+        try:
+            return await task
+        except asyncio.CancelledError:
+            if not task.done():
+                # 调用方自身被取消，同时取消请求
+                task.cancel()
+                raise
+            if task.cancelled() and not asyncio.current_task().cancelling():
+                logger.info(f"会话 {key} 中 {owner} 的请求已被新消息取代")
+                return None
+            raise
+        finally:
+            if self._latest.get((key, owner)) is task:
+                del self._latest[(key, owner)]
+
+    async def _run_serialized(self, key: Hashable, func: Callable[..., Awaitable], *args, **kwargs):
+        lock = self._locks.get(key)
+        if lock is None:
+            lock = self._locks[key] = asyncio.Lock()
+        self._waiting[key] = self._waiting.get(key, 0) + 1
+        try:
+            if lock.locked():
+                logger.debug(f"会话 {key} 有请求正在处理，排队等待，当前 {self._waiting[key]} 个请求")
+            async with lock:
+                return await func(*args, **kwargs)
+        finally:
+            self._waiting[key] -= 1
+            if not self._waiting[key]:
+                del self._waiting[key]
+                del self._locks[key]
+
+
+class AdmissionRejected(Exception):
+    """排队已满或等待超时，请求被拒绝"""
+
+
+class _Bulkhead:
+    """带等待队列上限的并发限制"""
+
+    def __init__(self, name: str, limit: int, max_queue: int):
+        self.name = name
+        self.limit = limit
+        self.max_queue = max_queue
+        self._semaphore = asyncio.Semaphore(limit)
+        self.active = 0
+        self.waiting = 0
+        self.rejected = 0
+
+    async def acquire(self, deadline: float):
+        if not self._semaphore.locked():
+            # 有空闲名额且无人排队，立即取得
+            await self._semaphore.acquire()
+        else:
+            if self.waiting >= self.max_queue:
+                self.rejected += 1
+                raise AdmissionRejected(f"{self.name} 排队已满（{self.waiting} 个请求）")
+            self.waiting += 1
+            try:
+                await asyncio.wait_for(self._semaphore.acquire(), max(0.0, deadline - time.monotonic()))
+            except asyncio.TimeoutError:
+                self.rejected += 1
+                raise AdmissionRejected(f"{self.name} 等待超时")
+            finally:
+                self.waiting -= 1
+        self.active += 1
+
+    def release(self):
+        self.active -= 1
+        self._semaphore.release()
+
+    def stats(self) -> dict:
+        return {"limit": self.limit, "active": self.active, "waiting": self.waiting, "rejected": self.rejected}
+
+
+# 当前任务是否已取得执行名额，请求内部的上传、语音合成等调用不重复占用名额
+_admitted: contextvars.ContextVar[bool] = contextvars.ContextVar("dify_admitted", default=False)
+
+
+class AdmissionController:
+    """Dify调用的准入控制
+
+    每个智能体有独立的并发上限（舱壁隔离），另有全局并发上限；名额用完时请求排队，
+    队列已满或等待超过 queue_timeout 秒则抛出 AdmissionRejected。上限为0表示不限制。
+    """
+
+    def __init__(self, global_limit: int = 0, model_limits: Optional[Mapping[str, int]] = None,
+                 max_queue: int = 100, queue_timeout: float = 30):
+        """
+        Args:
+            global_limit: 全局并发上限
+            model_limits: 智能体名称 -> 并发上限
+            max_queue: 每个限制的最大排队数
+            queue_timeout: 最长排队时间（秒）
+        """
+        self.queue_timeout = queue_timeout
+        self._global = _Bulkhead("全局", global_limit, max_queue) if global_limit > 0 else None
+        self._models: Dict[str, _Bulkhead] = {
+            name: _Bulkhead(f"智能体 {name}", limit, max_queue)
+            for name, limit in (model_limits or {}).items() if limit > 0
+        }
+
+    @asynccontextmanager
+    async def slot(self, model_name: str):
+        """取得一个执行名额，先占智能体名额再占全局名额，两者共享同一个等待期限"""
+        if _admitted.get():
+            yield
+            return
+
+        deadline = time.monotonic() + self.queue_timeout
+        acquired = []
+        try:
+            for bulkhead in (self._models.get(model_name), self._global):
+                if bulkhead is not None:
+                    await bulkhead.acquire(deadline)
+                    acquired.append(bulkhead)
+        except BaseException:
+            for bulkhead in acquired:
+                bulkhead.release()
+            raise
+
+        token = _admitted.set(True)
+        try:
+            yield
+        finally:
+            _admitted.reset(token)
+            for bulkhead in acquired:
+                bulkhead.release()
+
+    def stats(self) -> dict:
+        stats = {name: bulkhead.stats() for name, bulkhead in self._models.items()}
+        if self._global is not None:
+            stats["*"] = self._global.stats()
+        return stats
@@ -0,0 +1,313 @@
+import asyncio
+import codecs
+import json
+import re
+import time
+from typing import AsyncIterator, Awaitable, Callable, List
+
+from loguru import logger
+
+THINK_OPEN = "<think>"
+THINK_CLOSE = "</think>"
+PARAGRAPH_SEPARATOR = "//n"
+SENTENCE_ENDINGS = "。！？!?；;\n"
+_BACKTICKS = re.compile(r"`+")
+
+
+def _partial_tag_length(data: str, tag: str, start: int) -> int:
+    """返回 data 末尾与 tag 前缀重合的长度，用于保留跨数据块的半截标签"""
+    for k in range(min(len(tag) - 1, len(data) - start), 0, -1):
+        if data.endswith(tag[:k]):
+            return k
+    return 0
+
+
+class ThinkFilter:
+    """增量过滤 <think>...</think> 思考内容
+
+    标签可以被拆分在多个数据块中。与 re.sub(r'<think>.*?</think>', '', text, flags=re.DOTALL)
+    的结果一致：未闭合的 <think> 及其后的内容在 flush() 时原样输出。
+    """
+
+    def __init__(self):
+        self._in_think = False
+        self._pending = ""  # 可能是半截标签的尾部
+        self._think_parts: List[str] = []  # 未闭合思考块的内容，流结束时需要还原
+
+    def feed(self, chunk: str) -> str:
+        """输入一个数据块，返回可以输出的文本"""
+        data = self._pending + chunk
+        self._pending = ""
+        output = []
+        pos = 0
+        while True:
+            tag = THINK_CLOSE if self._in_think else THINK_OPEN
+            idx = data.find(tag, pos)
+            if idx < 0:
+                keep = _partial_tag_length(data, tag, pos)
+                end = len(data) - keep
+                if self._in_think:
+                    self._think_parts.append(data[pos:end])
+                else:
+                    output.append(data[pos:end])
+                self._pending = data[end:]
+                break
+            if self._in_think:
+                self._think_parts.clear()
+            else:
+                output.append(data[pos:idx])
+            pos = idx + len(tag)
+            self._in_think = not self._in_think
+        return "".join(output)
+
+    def flush(self) -> str:
+        """流结束时调用，返回剩余的文本"""
+        rest = self._pending
+        if self._in_think:
+            rest = THINK_OPEN + "".join(self._think_parts) + rest
+        self._in_think = False
+        self._pending = ""
+        self._think_parts = []
+        return rest
+
+
+class StreamChunker:
+    """把流式答案切分为可以立即发送的片段
+
+    每个完整的 //n 段落立即输出；设置了 min_chars 或 max_interval 时，当前段落超过长度或
+    距上次输出超过时间阈值，会在最后一个句末标点处切出一个片段提前发送。
+    未输出的文本按数据块保存，每次只扫描新增的数据块，记录最后一个句末标点的位置和之前的代码块围栏数，
+    总耗时与答案长度成正比。
+    """
+
+    def __init__(self, min_chars: int = 0, max_interval: float = 0, clock: Callable[[], float] = time.monotonic):
+        """
+        Args:
+            min_chars: 段落内按句切分的长度阈值，0 表示不按长度切分
+            max_interval: 段落内按句切分的时间阈值（秒），0 表示不按时间切分
+            clock: 时钟函数，便于替换
+        """
+        self.min_chars = min_chars
+        self.max_interval = max_interval
+        self._clock = clock
+        self._last_flush = clock()
+        self._reset()
+
+    def _reset(self):
+        self._parts: List[str] = []
+        self._length = 0
+        self._tail = ""  # 末尾可能是半截段落分隔符的字符
+        self._fences = 0  # 已结束的反引号串中的 ``` 数
+        self._run = 0  # 末尾反引号串的长度
+        self._cut = 0  # 最后一个句末标点之后的位置
+        self._fences_at_cut = 0  # 该位置之前的 ``` 数
+
+    def _append(self, text: str):
+        """追加文本，只扫描新增部分"""
+        base = self._length
+        cut = max(text.rfind(ch) for ch in SENTENCE_ENDINGS) + 1
+        fences_at_cut = None
+        for match in _BACKTICKS.finditer(text):
+            start, stop = match.span()
+            if cut and fences_at_cut is None and start >= cut:
+                fences_at_cut = self._fences + self._run // 3
+            if start == 0:
+                self._run += stop
+            else:
+                self._fences += self._run // 3
+                self._run = stop - start
+        if text and not text.endswith("`"):
+            self._fences += self._run // 3
+            self._run = 0
+        if cut:
+            self._cut = base + cut
+            self._fences_at_cut = fences_at_cut if fences_at_cut is not None else self._fences + self._run // 3
+        self._parts.append(text)
+        self._length += len(text)
+        self._tail = (self._tail + text)[-(len(PARAGRAPH_SEPARATOR) - 1):]
+
+    def _take(self, end: int) -> str:
+        """取出前 end 个字符，剩余文本的句末位置和围栏数相应前移"""
+        pending = "".join(self._parts)
+        self._parts = [pending[end:]] if end < len(pending) else []
+        self._length -= end
+        self._fences -= self._fences_at_cut
+        self._cut = 0
+        self._fences_at_cut = 0
+        return pending[:end]
+
+    def feed(self, text: str) -> List[str]:
+        """输入增量文本，返回已经完整、可以发送的片段"""
+        now = self._clock()
+        segments = []
+        if PARAGRAPH_SEPARATOR in self._tail + text:
+            # 分隔符只会出现在上次的末尾和新增文本中，剩余部分都来自新增文本
+            parts = "".join(self._parts + [text]).split(PARAGRAPH_SEPARATOR)
+            rest = parts.pop()
+            segments.extend(parts)
+            self._reset()
+            self._append(rest)
+            self._last_flush = now
+        elif text:
+            self._append(text)
+
+        if self._length and ((self.min_chars and self._length >= self.min_chars) or
+                             (self.max_interval and now - self._last_flush >= self.max_interval)):
+            # 代码块未闭合时不切分
+            if self._cut and not self._fences_at_cut % 2:
+                segments.append(self._take(self._cut))
+                self._last_flush = now
+        return [segment for segment in segments if segment.strip()]
+
+    def flush(self) -> List[str]:
+        """流结束时调用，返回剩余的片段"""
+        rest = "".join(self._parts)
+        self._reset()
+        return [rest] if rest.strip() else []
+
+
+class StreamSender:
+    """在后台按顺序发送流式片段
+
+    读取SSE响应的循环只把完成的片段放入队列，由后台任务依次调用 send 发送，
+    微信发送排队限速时不会阻塞读取Dify的响应流。
+    """
+
+    def __init__(self, send: Callable[..., Awaitable]):
+        """
+        Args:
+            send: 发送一组片段的协程函数，参数与 put() 相同
+        """
+        self._send = send
+        self._queue: asyncio.Queue = asyncio.Queue()
+        self._task = asyncio.create_task(self._run())
+
+    def put(self, segments: List[str], *args):
+        """把片段放入发送队列，不等待发送"""
+        if segments:
+            self._queue.put_nowait((segments, *args))
+
+    async def _run(self):
+        while True:
+            item = await self._queue.get()
+            if item is None:
+                return
+            try:
+                await self._send(*item)
+            except Exception as e:
+                logger.error(f"发送流式片段失败: {e}")
+
+    async def close(self):
+        """等待队列中的片段全部发送完"""
+        self._queue.put_nowait(None)
+        await self._task
+
+    def cancel(self):
+        """出错时放弃未发送的片段"""
+        self._task.cancel()
+
+
+class AnswerBuffer:
+    """按数据块累积答案，同时增量过滤思考内容，避免字符串反复拼接和对全文重复执行正则"""
+
+    def __init__(self):
+        self._parts: List[str] = []
+        self._think = ThinkFilter()
+
+    def append(self, chunk: str) -> str:
+        """追加一个数据块，返回新增的可见文本"""
+        visible = self._think.feed(chunk)
+        if visible:
+            self._parts.append(visible)
+        return visible
+
+    def replace(self, text: str) -> str:
+        """message_replace 事件：丢弃已有内容，返回替换后的可见文本"""
+        self._parts = []
+        self._think = ThinkFilter()
+        return self.append(text)
+
+    def finish(self) -> str:
+        """流结束时调用，返回剩余的可见文本"""
+        rest = self._think.flush()
+        if rest:
+            self._parts.append(rest)
+        return rest
+
+    def getvalue(self) -> str:
+        return "".join(self._parts)
+
+
+class SSEParser:
+    """增量解析 text/event-stream
+
+    输入任意切分的字节块，UTF-8 多字节字符和行可以跨块；多行 data: 按规范以换行连接，
+    空行结束一个事件并解析为 JSON。不带字段名、以 { 开头的行按 data 处理。
+    """
+
+    def __init__(self):
+        self._decoder = codecs.getincrementaldecoder("utf-8")(errors="replace")
+        self._line: List[str] = []  # 未结束的行，收到换行符时才拼接
+        self._data: List[str] = []
+
+    def feed(self, chunk: bytes) -> List[dict]:
+        """输入一个字节块，返回其中完整的事件"""
+        text = self._decoder.decode(chunk)
+        if "\n" not in text:
+            if text:
+                self._line.append(text)
+            return []
+        lines = text.split("\n")
+        self._line.append(lines[0])
+        lines[0] = "".join(self._line)
+        rest = lines.pop()
+        self._line = [rest] if rest else []
+        events = []
+        for line in lines:
+            self._process_line(line.rstrip("\r"), events)
+        return events
+
+    def close(self) -> List[dict]:
+        """流结束时调用，返回剩余的事件"""
+        events = []
+        rest = "".join(self._line) + self._decoder.decode(b"", final=True)
+        self._line = []
+        if rest:
+            self._process_line(rest.rstrip("\r"), events)
+        self._dispatch(events)
+        return events
+
+    def _process_line(self, line: str, events: List[dict]):
+        if not line:
+            self._dispatch(events)
+        elif line.startswith("{"):
+            # 非SSE格式的JSON行，单独作为一个事件
+            self._dispatch(events)
+            self._data.append(line)
+            self._dispatch(events)
+        elif not line.startswith(":"):
+            field, _, value = line.partition(":")
+            if field == "data":
+                self._data.append(value[1:] if value.startswith(" ") else value)
+
+    def _dispatch(self, events: List[dict]):
+        if not self._data:
+            return
+        data, self._data = "\n".join(self._data), []
+        try:
+            event = json.loads(data)
+        except json.JSONDecodeError:
+            logger.error(f"Dify返回的JSON解析错误: {data}")
+            return
+        if isinstance(event, dict):
+            events.append(event)
+
+
+async def iter_sse_events(stream) -> AsyncIterator[dict]:
+    """逐个产出 aiohttp 响应流中的 SSE 事件"""
+    parser = SSEParser()
+    async for chunk in stream.iter_any():
+        for event in parser.feed(chunk):
+            yield event
+    for event in parser.close():
+        yield event
@@ -0,0 +1,83 @@
+import asyncio
+import shutil
+from typing import Optional, Sequence
+
+from loguru import logger
+
+
+class TranscodeError(Exception):
+    """ffmpeg 转码失败或超时"""
+
+
+class FfmpegTranscoder:
+    """基于 asyncio 子进程的 ffmpeg 转码
+
+    输入通过 stdin、输出通过 stdout 传递，不落临时文件；同时运行的 ffmpeg 进程数受 max_concurrency 限制，
+    单次转码超过 timeout 秒会被终止。
+    """
+
+    def __init__(self, max_concurrency: int = 2, timeout: float = 60, ffmpeg: str = "ffmpeg"):
+        """
+        Args:
+            max_concurrency: 同时运行的最大 ffmpeg 进程数
+            timeout: 单次转码超时时间（秒）
+            ffmpeg: ffmpeg 可执行文件
+        """
+        self.timeout = timeout
+        self.ffmpeg = ffmpeg
+        self._semaphore = asyncio.Semaphore(max(1, max_concurrency))
+
+    @property
+    def available(self) -> bool:
+        """是否找到 ffmpeg"""
+        return shutil.which(self.ffmpeg) is not None
+
+    @staticmethod
+    async def _kill(process: asyncio.subprocess.Process):
+        try:
+            process.kill()
+        except ProcessLookupError:
+            pass
+        await process.wait()
+
+    async def transcode(self, data: bytes, output_args: Sequence[str], input_args: Sequence[str] = (),
+                        timeout: Optional[float] = None) -> bytes:
+        """
+        转码音频数据
+
+        Args:
+            data: 输入数据
+            output_args: 输出参数，必须包含 -f 指定输出格式，如 ["-ar", "16000", "-ac", "1", "-f", "mp3"]
+            input_args: 输入参数，放在 -i 之前
+            timeout: 超时时间（秒），默认使用构造时的设置
+
+        Returns:
+            bytes: 转码后的数据
+
+        Raises:
+            TranscodeError: ffmpeg 返回错误或超时
+        """
+        timeout = timeout or self.timeout
+        async with self._semaphore:
+            process = await asyncio.create_subprocess_exec(
+                self.ffmpeg, "-hide_banner", "-loglevel", "error", "-y",
+                *input_args, "-i", "pipe:0", *output_args, "pipe:1",
+                stdin=asyncio.subprocess.PIPE,
+                stdout=asyncio.subprocess.PIPE,
+                stderr=asyncio.subprocess.PIPE
+            )
+            try:
+                stdout, stderr = await asyncio.wait_for(process.communicate(data), timeout)
+            except asyncio.TimeoutError:
+                await self._kill(process)
+                raise TranscodeError(f"ffmpeg 转码超过 {timeout} 秒，已终止")
+            except asyncio.CancelledError:
+                await self._kill(process)
+                raise
+
+        if process.returncode != 0:
+            raise TranscodeError(f"ffmpeg 执行失败({process.returncode}): {stderr.decode('utf-8', 'ignore').strip()}")
+        if not stdout:
+            raise TranscodeError("ffmpeg 输出为空")
+        logger.debug(f"ffmpeg 转码完成: {len(data)} -> {len(stdout)} 字节")
+        return stdout